@@ -31,6 +31,7 @@ from ECMWF_N import ECMWF
 from mki2d import tohyb
 
 from io107 import readpart107, readidx107
+from idxmatch import idxmatch
 p0 = 100000.
 I_DEAD = 0x200000
 I_HIT = 0x400000
@@ -258,8 +259,7 @@ def main():
         After the launch of the earliest parcel along the flight track, there
         should not be any member in new.
         """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+        kept_a, kept_p = idxmatch(partante['idx_back'],partpost['idx_back'])
         #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
         print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
 
@@ -28,6 +28,7 @@ import geosat
 import constants as cst
 
 from io107 import readpart107, readidx107
+from idxmatch import idxmatch
 p0 = 100000.
 I_DEAD = 0x200000
 I_HIT = 0x400000
@@ -304,8 +305,7 @@ def main():
         """
         # This complication to manage the beginning of the run with empty part files and avoid problems in the sequel
         try:
-            kept_a = np.in1d(partante['idx_back']-partante['idx_orgn'],partpost['idx_back']-partpost['idx_orgn'],assume_unique=True)
-            kept_p = np.in1d(partpost['idx_back']-partpost['idx_orgn'],partante['idx_back']-partante['idx_orgn'],assume_unique=True)
+            kept_a, kept_p = idxmatch(partante['idx_back']-partante['idx_orgn'],partpost['idx_back']-partpost['idx_orgn'])
         except:
             kept_a = np.array([])
             if partpost['nact']>0:
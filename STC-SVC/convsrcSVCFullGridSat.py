@@ -25,6 +25,7 @@ import deepdish as dd
 import geosat
 #import constants as cst
 from io107 import readpart107, readidx107
+from idxmatch import idxmatch
 
 p0 = 100000.
 I_DEAD = 0x200000
@@ -266,8 +267,7 @@ def main():
         should not be any member in new
         The parcels
         """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+        kept_a, kept_p = idxmatch(partante['idx_back'],partpost['idx_back'])
         #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
         print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
 
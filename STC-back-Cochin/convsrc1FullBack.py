@@ -30,6 +30,7 @@ import argparse
 import psutil
 
 from io107 import readpart107, readidx107
+from idxmatch import idxmatch, idxin
 p0 = 100000.
 I_DEAD = 0x200000
 I_HIT = 0x400000
@@ -280,8 +281,7 @@ def main():
         ketp_a is a logical field with same length as partante
         kept_p is a logical field with same length as partpost
         """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+        kept_a, kept_p = idxmatch(partante['idx_back'],partpost['idx_back'])
         #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
         print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
         nnew += len(partpost['x'])-kept_p.sum()
@@ -305,7 +305,7 @@ def main():
             # ACHTUNG ACHTUNG : this works because IDX_ORGN=1, FIX THAT
             idx_theor = np.arange(idx1,numpart_s+IDX_ORGN)
             # Find the missing indexes in idx_act (make a single line after validation)
-            kept_borne = np.in1d(idx_theor,idx_act,assume_unique=True)
+            kept_borne = idxin(idx_theor,idx_act)
             idx_deadborne = idx_theor[~kept_borne]
             # Process these parcels by assigning exit at initial location
             prod0['flag_source'][idx_deadborne-IDX_ORGN] = prod0['flag_source'][idx_deadborne-IDX_ORGN] | I_DEAD+I_DBORNE
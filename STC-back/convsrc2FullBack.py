@@ -36,7 +36,8 @@ from scipy.interpolate import RegularGridInterpolator
 from ECMWF_N import ECMWF
 from mki2d import tohyb
 
-from io107 import readpart107, readidx107
+from io107 import readpart107, readidx107, iterpart107
+from idxmatch import idxmatch, idxin
 p0 = 100000.
 I_DEAD = 0x200000
 I_HIT = 0x400000
@@ -247,7 +248,8 @@ def main():
     print('Initialization completed')
 
     """ Main loop on the output time steps """
-    for hour in range(step,hmax+1,step):
+    # the part file of the next hour is read in background during the processing
+    for hour, part in iterpart107(range(step,hmax+1,step),ftraj,depth=1):
         pid = os.getpid()
         py = psutil.Process(pid)
         memoryUse = py.memory_info()[0]/2**30
@@ -255,7 +257,7 @@ def main():
         # Get rid of dictionary no longer used
         if hour >= 2*step: del partStep[hour-2*step]
         # Read the new data
-        partStep[hour] = readpart107(hour,ftraj,quiet=True)
+        partStep[hour] = part
         # Link the names
         partante = partStep[hour-step]
         partpost = partStep[hour]
@@ -271,8 +273,7 @@ def main():
         After the launch of the earliest parcel along the flight track, there
         should not be any member in new.
         """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+        kept_a, kept_p = idxmatch(partante['idx_back'],partpost['idx_back'])
         #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
         print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
         nnew += len(partpost['x'])-kept_p.sum()
@@ -297,7 +298,7 @@ def main():
             # Generate the list of indexes that should be found in this range
             idx_theor = np.arange(idx1,numpart_s+IDX_ORGN)
             # Find the missing indexes in idx_act (make a single line after validation)
-            kept_borne = np.in1d(idx_theor,idx_act,assume_unique=True)
+            kept_borne = idxin(idx_theor,idx_act)
             idx_deadborne = idx_theor[~kept_borne]
             # Process these parcels by assigning exit at initial location
             prod0['flag_source'][idx_deadborne-IDX_ORGN] = prod0['flag_source'][idx_deadborne-IDX_ORGN] | I_DEAD+I_DBORNE
@@ -424,9 +425,16 @@ def main():
                 nhits[0] += nr
        
             """ PROCESS THE (ADJOINT) DETRAINMENT """
+            # the density is only calculated on the columns crossed by the live parcels
+            touched = pathcells(datpart['xi'][indomain],datpart['yi'][indomain],
+                datpart['xf'][indomain],datpart['yf'][indomain],datpart['idx_back'][indomain],
+                prod0['flag_source'],datrean.attr['Lo1'],datrean.attr['La1'],datrean.attr['dlo'],datrean.attr['dla'],
+                datrean.var['SP'].shape)
+            jy, ix = np.nonzero(touched)
+            rho = datrean.columns('RHO',jy,ix)
             n1 = detrainer(datpart['itime'], 
                 datpart['xi'][indomain],datpart['yi'][indomain],datpart['pi'][indomain],datpart['tempi'][indomain],hyb,
-                datpart['xf'][indomain],datpart['yf'][indomain], datrean.var['UDR'], datpart['idx_back'][indomain],\
+                datpart['xf'][indomain],datpart['yf'][indomain], datrean.var['UDR'], rho, datpart['idx_back'][indomain],\
                 prod0['flag_source'],part0['ir_start'], prod0['chi'],prod0['passed'],\
                 prod0['src']['x'],prod0['src']['y'],prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],prod0['source'],\
                 datrean.attr['Lo1'],datrean.attr['La1'],datrean.attr['dlo'],datrean.attr['dla'],detr_offset)
@@ -491,6 +499,7 @@ def main():
     print('memory use before clean: {:4.2f} gb'.format(memoryUse))
     del partante
     del partpost
+    del part
     del live_a
     del live_p
     # reduction of the size of prod0 by converting float64 into float32
@@ -638,7 +647,7 @@ def radada(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start):
 Do not process segments with an extermity outside the ERA5 domain"""
 
 @jit(nopython=True,cache=True)
-def detrainer(itime, xi,yi,pi,ti,hyb,xf,yf, udr, idx_back,flag,ir_start,chi,passed,\
+def detrainer(itime, xi,yi,pi,ti,hyb,xf,yf, udr, rho, idx_back,flag,ir_start,chi,passed,\
               xc,yc,pc,tc,age,source,\
               Lo1,La1,dlo,dla,detr_offset):
     nhits = [0,0,0,0,0,0]
@@ -684,7 +693,7 @@ def detrainer(itime, xi,yi,pi,ti,hyb,xf,yf, udr, idx_back,flag,ir_start,chi,pass
 #                 if ll[j][1]<0 or ll[j][1]>680:
 #                     print('ll0 ',ll[j])
                 #@@ test    
-                detr += udr[hyb[i],ll[j][1],ll[j][0]]
+                detr += udr[hyb[i],ll[j][1],ll[j][0]]/rho[hyb[i],ll[j][1],ll[j][0]]
             detr = detr/len(ll)
             # erode the parcel
             if detr >= detr_offset:
@@ -742,6 +751,25 @@ def detrainer(itime, xi,yi,pi,ti,hyb,xf,yf, udr, idx_back,flag,ir_start,chi,pass
                             nhits[5] += 1
     return nhits
 
+@jit(nopython=True,cache=True)
+def pathcells(xi,yi,xf,yf,idx_back,flag,Lo1,La1,dlo,dla,shape):
+    """ Mask of the meshes on the paths of the live parcels, as used by detrainer """
+    touched = np.zeros(shape,dtype=np.bool_)
+    for i in range(len(xi)):
+        i0 = idx_back[i]-IDX_ORGN
+        if flag[i0] & I_DEAD ==0:
+            xig = int(math.floor((xi[i]-Lo1)/dlo+0.5))
+            yig = int(math.floor((yi[i]-La1)/dlo+0.5))
+            xfg = int(math.floor((xf[i]-Lo1)/dla+0.5))
+            yfg = int(math.floor((yf[i]-La1)/dla+0.5))
+            if (xig<0) or (xfg<0) or (xig>680) or (xfg >680) or (yig<0) or (yfg<0) or (yig>200) or (yfg>200):
+                continue
+            ll = line(xig,yig,xfg,yfg)
+            for j in range(len(ll)):
+                if (ll[j][1]<shape[0]) and (ll[j][0]<shape[1]):
+                    touched[ll[j][1],ll[j][0]] = True
+    return touched
+
 #%%
 """ Function related to ECMWF read """
 
@@ -752,7 +780,9 @@ def read_ECMWF(date):
     This is quite OK for UDR as this quantity is defined as a mean/accumuation over
     this one-hour period.
     Cloud-cover is from analysis, therefore as an instantaneous map, but varies less rapidly 
-    than the UDR. """
+    than the UDR.
+    The density needed to convert UDR is not calculated here but only on the columns
+    crossed by the parcels (see pathcells and ECMWF.columns). """
     dat = ECMWF('STC',date)
     dat._get_var('T')
     dat.attr['dlo'] = (dat.attr['lons'][-1] - dat.attr['lons'][0]) / (dat.nlon-1)
@@ -765,9 +795,6 @@ def read_ECMWF(date):
     #@@ end test
     dat._get_var('UDR')
     #dat._get_var('CC')
-    dat._mkp()
-    dat._mkrho()
-    dat.var['UDR'] /= dat.var['RHO']
     dat.close()
     return dat
 
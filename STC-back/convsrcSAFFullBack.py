@@ -33,7 +33,8 @@ import deepdish as dd
 import SAFNWCnc
 import geosat
 
-from io107 import readpart107, readidx107
+from io107 import readpart107, readidx107, iterpart107
+from idxmatch import idxmatch, idxin
 p0 = 100000.
 I_DEAD = 0x200000
 I_HIT = 0x400000
@@ -269,7 +270,8 @@ def main():
     print('Initialization completed')
 
     """ Main loop on the output time steps """
-    for hour in range(step,hmax+1,step):
+    # the part file of the next hour is read in background during the processing
+    for hour, part in iterpart107(range(step,hmax+1,step),ftraj,depth=1):
         pid = os.getpid()
         py = psutil.Process(pid)
         memoryUse = py.memory_info()[0]/2**30
@@ -278,7 +280,7 @@ def main():
         if hour >= 2*step: del partStep[hour-2*step]
         
         # Read the new data
-        partStep[hour] = readpart107(hour,ftraj,quiet=True)
+        partStep[hour] = part
         # Link the names as views
         partante = partStep[hour-step]
         partpost = partStep[hour]
@@ -302,8 +304,7 @@ def main():
         After the launch of the earliest parcel along the flight track, there
         should not be any member in new.
         """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+        kept_a, kept_p = idxmatch(partante['idx_back'],partpost['idx_back'])
         #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
         print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
         nnew += len(partpost['x'])-kept_p.sum()
@@ -327,7 +328,7 @@ def main():
             # ACHTUNG ACHTUNG : this works because IDX_ORGN=1, FIX THAT
             idx_theor = np.arange(idx1,numpart_s+IDX_ORGN)
             # Find the missing indexes in idx_act (make a single line after validation)
-            kept_borne = np.in1d(idx_theor,idx_act,assume_unique=True)
+            kept_borne = idxin(idx_theor,idx_act)
             idx_deadborne = idx_theor[~kept_borne]
             # Process these parcels by assigning exit at initial location
             prod0['flag_source'][idx_deadborne-IDX_ORGN] = prod0['flag_source'][idx_deadborne-IDX_ORGN] | I_DEAD+I_DBORNE
@@ -486,6 +487,7 @@ def main():
     print('memory use before clean: {:4.2f} gb'.format(memoryUse))
     del partante
     del partpost
+    del part
     del live_a
     del live_p
     del datpart
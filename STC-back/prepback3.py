@@ -43,6 +43,7 @@ import numpy as np
 #import pygrib
 from scipy.interpolate import RectBivariateSpline
 import io107
+import ECMWF_N
 from ECMWF_N import ECMWF
 import argparse
 pref = 101325.
@@ -121,6 +122,7 @@ if __name__ == '__main__':
     parser.add_argument("-m","--month",type=int,choices=1+np.arange(12),help="month")
     parser.add_argument("-l","--level",type=float,help="theta level")
     parser.add_argument("-q","--quiet",type=str,choices=["y","n"],help="quiet (y) or not (n)")
+    parser.add_argument("-cs","--cache_size",type=int,help="size in MB of the cache of the ECMWF fields (0, default, disables it)")
     
     # Default values
     base_year = 2017
@@ -141,6 +143,8 @@ if __name__ == '__main__':
             quiet=True
         else:
             quiet=False
+    # the cache only saves decoding when the same date is read again in the process
+    if args.cache_size is not None: ECMWF_N.cache.set_limit(args.cache_size << 20)
     
     # Derived parameters defining the run
     # Pressure
@@ -167,7 +167,8 @@ thets['nstep'] = nstep
 
 l=0
 for step in range(step_start,hmax + step_inc ,step_inc):
-    data = io107.readpart107(step,run_dir,quiet=True)
+    # x and y are only read when the domain filter is used
+    data = io107.readpart107(step,run_dir,quiet=True,fields=['p','t','idx_back'],lazy=True)
     data['thet'] = data['t'] * (cst.p0/data['p'])**cst.kappa
     y0t = y0[data['idx_back']-IDX_ORGN]   
     ages = step - startime[data['idx_back']-IDX_ORGN]
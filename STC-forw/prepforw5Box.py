@@ -68,6 +68,7 @@ import pickle,gzip
 #import pygrib
 #from scipy.interpolate import RectBivariateSpline
 import io107
+import ECMWF_N
 from ECMWF_N import ECMWF
 import argparse
 #import constants as cst
@@ -102,6 +103,7 @@ if __name__ == '__main__':
     #parser.add_argument("-q","--quiet",type=str,choices=["y","n"],help="quiet (y) or not (n)")
     parser.add_argument("-c","--cut",type=float,help="pressure cut in hPa")
     parser.add_argument("-ct","--cloud_type",type=str,choices=["high","meanhigh","veryhigh"],help="type filter")                   
+    parser.add_argument("-cs","--cache_size",type=int,help="size in MB of the cache of the ECMWF fields (0, default, disables it)")
     
     # Default values
     base_year = 2017
@@ -124,6 +126,8 @@ if __name__ == '__main__':
     #    if args.quiet=='y': quiet=True
     if args.cloud_type is not None: cloud_type = args.cloud_type
     if args.cut is not None: cut_level = args.cut
+    # the cache only saves decoding when the same date is read again in the process
+    if args.cache_size is not None: ECMWF_N.cache.set_limit(args.cache_size << 20)
     
     # Needs to start at 0h next month to be on an EN date, avoids complicated adjustment
     # for negligible effect. 
@@ -75,17 +75,14 @@ for stream in streams:
     print(stream)
     # read the initial positions for thisi stream
     dir_in = join(init_dir,stream)
-    pos0 = readpart107(0,dir_in,quiet=True)
-     # extract the silviahigh selector
-    ct = pos0['flag'] >> 24
-    silviahigh = (ct == 9) | (ct == 13) | (ct == 8)
-    # selection of the high clouds
-    selec = silviahigh & (pos0['p']<27000)
-    yc = pos0['y'][selec]
-    xc = pos0['x'][selec]
-    pc = pos0['p'][selec]
-    tc = pos0['t'][selec]
-    ir = pos0['ir_start'][selec]
+    # only the silviahigh clouds (cloud types 8, 9, 13) below 270 hPa are read
+    pos0 = readpart107(0,dir_in,quiet=True,fields=['ir_start','x','y','p','t'],
+                       where={'cloud_type':[8,9,13],'p':(None,27000)})
+    yc = pos0['y']
+    xc = pos0['x']
+    pc = pos0['p']
+    tc = pos0['t']
+    ir = pos0['ir_start']
     theta = tc * (cst.p0/pc)**cst.kappa
     ix = np.clip(np.floor((xc-xlon0)/dlo).astype(np.int),0,nlon-1)
     jy = np.clip(np.floor((yc-ylat0)/dla).astype(np.int),0,nlat-1)
@@ -186,10 +186,10 @@ sources['live'][(sources['thet']>360) & (sources['y']>=40)] = False
 sources['live'][(sources['thet']>360) & (sources['y']>=35) & (sources['x']<40)] = False    
 
 # Loop on steps
-for step in range(step_start,hmax + step_inc ,step_inc):
+# The nactive parcels of the next step are read in background during the processing
+for step, data in io107.iterpart107(range(step_start,hmax + step_inc ,step_inc),run_dir,depth=1,
+                                    fields=['x','y','p','t','idx_back']):
     print("stat-forw> step "+str(step))
-    # Read the nactive parcels at current step
-    data = io107.readpart107(step,run_dir,quiet=True)
     # Get the list of indexes for the active parcels after removing the offset
     idxsel = data['idx_back']-IDX_ORGN
     # Generate the list of ages of active parcels from their launch (in days)
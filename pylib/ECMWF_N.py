@@ -24,12 +24,21 @@ calculate pressure field
 >> data._mkp()
 calculate potential temperature (requires to read T and calculate P before)
 >> data._mktheta()
+or calculate derived variables by name, their dependencies being read or
+calculated once (see DERIVED)
+>> PT, RHO = data.derive(['PT','RHO'],dtype=np.float32)
+or only on the columns (jy,ix) of the grid which are used, e.g. those touched by
+parcels (the other columns being calculated at the next calls if needed)
+>> RHO = data.columns('RHO',jy,ix)
 extract a subgrid
 >> data1 = data.extract(latRange=[lat1,lat2],lonRange=[lon1,lon2])
 plot a chart for the variable var and level lev (lev is the level number)
 >> data.chart(var,lev)
 interpolate in time (date2 must be between the dates of data0 and data1)
 >> data2 = data0.interpol-time(data1,date2)
+interpolate to parcels (lon x, lat y, pressure p) at times t (seconds from the date
+of data0), in space and time between data0 and data1
+>> values = data0.sample(x,y,p,t,data1,['T','UDR'])
 interpolate to pressure levels
 >> data1 = data.interpolP(pList,varList,latRange,lonRange)
 where pList is a pressure or a list of pressures, varList is a variable or a list of variables,
@@ -37,6 +46,11 @@ latRange and lonRange as in extract
 
 The ECMWF class is used to read the file corresponding to a date for several projects/
 The relevant projects are STC and VOLC
+The grib files are accessed through persistent indexes of their messages
+(see gribidx), built at the first opening of each file and shared by all the
+ECMWF objects of a process.
+The decoded and derived fields can be kept in a cache of the process (see cache
+below), which is off by default.
 
 The ECMWF_pure allows to define a template object without reading files.
 It can be used to modify data. It is produced as an output of the interpolation.
@@ -50,6 +64,8 @@ from datetime import datetime
 import numpy as np
 import math
 import pygrib
+from gribidx import opengrib
+from fieldcache import FieldCache
 import os
 #from cartopy import feature
 #from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
@@ -61,14 +77,41 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import socket
-from scipy.interpolate import interp1d,RegularGridInterpolator
-from mki2d import tohyb
+from scipy.interpolate import interp1d
 import constants as cst
 import gzip,pickle
-from numba import jit
+from numba import jit, prange
 #from copy import copy,deepcopy
 
 MISSING = -999
+# Decoded fields, and the fields derived from them (P, PT, RHO, Z), are kept
+# in a cache shared by all the ECMWF objects of the process, so that a field
+# requested again for the same project, date and variable is not decoded again.
+# The cache is bounded by CACHE_LIMIT bytes. It is disabled by default (0), as
+# most drivers read each date once, and the drivers which read the same fields
+# several times turn it on by ECMWF_N.cache.set_limit(nbytes) (option
+# --cache_size of prepback3 and prepforw5Box).
+# ECMWF_N.cache.stats() gives the hits and misses.
+# The cache holds copies of the fields, so that the fields of the ECMWF objects
+# can be modified freely. A field which is assigned again in self.var, e.g. by
+# dat.var['T'] += 1, is no more used to derive the cached fields; a field
+# modified in place through another reference must be assigned again as well.
+CACHE_LIMIT = 0
+cache = FieldCache(CACHE_LIMIT)
+# Derived variables: the variables they are calculated from and the method
+# calculating them (see ECMWF.derive). RHOQ is the moist density.
+DERIVED = {'P':(['SP'],'_calc_p'),
+           'PZ':(['SP'],'_calc_pz'),
+           'PT':(['T','P'],'_calc_pt'),
+           'RHO':(['T','P'],'_calc_rho'),
+           'RHOQ':(['T','P','Q'],'_calc_rhoq'),
+           'Z':(['T','P','SP'],'_calc_z'),
+           'PV':(['PT','P','U','V','VO'],'_calc_pv')}
+# derived variables which can be calculated column by column (see ECMWF.columns)
+COLUMNS = ['P','PZ','PT','RHO','RHOQ']
+# ground geopotential altitudes read by _calc_z, by file, with the modification
+# time of the file when it was read, so that a file which is replaced is read again
+_Z0 = {}
 # Physical constants
 # now in the package "constants"
 #R = 287.04 # or 287.053
@@ -95,6 +138,289 @@ mymap_sw=colors.ListedColormap(listcolors_sw)
 def strictly_increasing(L):
     return all(x<y for x, y in zip(L, L[1:]))
 
+@jit(nopython=True,cache=True,parallel=True)
+def _vweights(coord,targets):
+    """ Weights of the linear interpolation of the columns of a [nlev,ny,nx]
+    field to the targets values of the coordinate coord [nlev,ny,nx], as
+    np.interp does it on each column (values clamped outside the column).
+    The columns of coord are expected to increase with the level index; those
+    which do not are sorted (the same permutation applies to the fields).
+    Returns the level indexes i0, i1 and the weight w of i1, each [nt,ny,nx].
+    The targets must be increasing. The rows are processed in parallel. """
+    nlev, ny, nx = coord.shape
+    nt = len(targets)
+    i0 = np.empty((nt,ny,nx),dtype=np.int32)
+    i1 = np.empty((nt,ny,nx),dtype=np.int32)
+    w = np.empty((nt,ny,nx))
+    for jy in prange(ny):
+        order = np.empty(nlev,dtype=np.int64)
+        col = np.empty(nlev)
+        row = np.empty((nx,nlev))
+        # columns of the row made contiguous
+        for k in range(nlev):
+            for ix in range(nx):
+                row[ix,k] = coord[k,jy,ix]
+        for ix in range(nx):
+            sort = False
+            for k in range(nlev-1):
+                if row[ix,k+1] < row[ix,k]:
+                    sort = True
+                    break
+            if sort:
+                order[:] = np.argsort(row[ix],kind='mergesort')
+            else:
+                for k in range(nlev):
+                    order[k] = k
+            for k in range(nlev):
+                col[k] = row[ix,order[k]]
+            k = 0
+            for it in range(nt):
+                x = targets[it]
+                while (k < nlev) and (col[k] <= x):
+                    k += 1
+                if k == 0:
+                    i0[it,jy,ix] = order[0]
+                    i1[it,jy,ix] = order[0]
+                    w[it,jy,ix] = 0.
+                elif (k == nlev) or (col[k] == col[k-1]):
+                    i0[it,jy,ix] = order[k-1]
+                    i1[it,jy,ix] = order[k-1]
+                    w[it,jy,ix] = 0.
+                else:
+                    i0[it,jy,ix] = order[k-1]
+                    i1[it,jy,ix] = order[k]
+                    w[it,jy,ix] = (x-col[k-1])/(col[k]-col[k-1])
+    return i0, i1, w
+
+@jit(nopython=True,cache=True,parallel=True)
+def _vapply(field,i0,i1,w):
+    """ Applies the weights of _vweights to the [nlev,ny,nx] field """
+    nt, ny, nx = w.shape
+    out = np.empty((nt,ny,nx))
+    for jy in prange(ny):
+        for it in range(nt):
+            for ix in range(nx):
+                f0 = field[i0[it,jy,ix],jy,ix]
+                if w[it,jy,ix] == 0.:
+                    out[it,jy,ix] = f0
+                else:
+                    out[it,jy,ix] = f0 + w[it,jy,ix]*(field[i1[it,jy,ix],jy,ix]-f0)
+    return out
+
+def _vinterp(fields,coord,targets):
+    """ Interpolates the [nlev,ny,nx] fields (list) to the targets of coord
+    with the same weights for all the fields. Returns the list of the
+    [len(targets),ny,nx] interpolated fields. """
+    targets = np.asarray(targets,dtype=np.float64)
+    rank = np.argsort(targets,kind='mergesort')
+    i0, i1, w = _vweights(np.ascontiguousarray(coord,dtype=np.float64),targets[rank])
+    # back to the order of the targets
+    inv = np.empty(len(rank),dtype=int)
+    inv[rank] = np.arange(len(rank))
+    i0, i1, w = i0[inv], i1[inv], w[inv]
+    return [_vapply(np.ascontiguousarray(field),i0,i1,w) for field in fields]
+
+@jit(nopython=True,cache=True,parallel=True)
+def _coldlevel(T,lo,hi):
+    """ Level of the minimum of T between the levels lo and hi (excluded) in
+    each column, as np.argmin (first minimum, first NaN if any) """
+    nlev, ny, nx = T.shape
+    hi = min(hi,nlev)
+    nc = np.empty((ny,nx),dtype=np.int64)
+    for jy in prange(ny):
+        for ix in range(nx):
+            kc = lo
+            if not np.isnan(T[lo,jy,ix]):
+                for k in range(lo+1,hi):
+                    if np.isnan(T[k,jy,ix]):
+                        kc = k
+                        break
+                    if T[k,jy,ix] < T[kc,jy,ix]:
+                        kc = k
+            nc[jy,ix] = kc
+    return nc
+
+@jit(nopython=True,cache=True,parallel=True,error_model='numpy')
+def _wmolevel(lapse,dz,T,offsets,highbnd,thicktrop):
+    """ Level of the WMO tropopause in each column, -1 if not found.
+    lapse[i] is the lapse rate at the level highbnd+1+i, dz[i] the thickness
+    between the levels i and i+1 and offsets[jy] the lapse rate threshold of
+    the row jy. The candidates are explored from the bottom. """
+    nl, ny, nx = lapse.shape
+    ndz = dz.shape[0]
+    nlev = T.shape[0]
+    lev0s = np.empty((ny,nx),dtype=np.int64)
+    for jy in prange(ny):
+        offset = offsets[jy]
+        for ix in range(nx):
+            lev0s[jy,ix] = -1
+            for test in range(nl-1,-1,-1):
+                if not (lapse[test,jy,ix] > offset):
+                    continue
+                # candidate tropopause, the lapse rate must be maintained over thicktrop
+                lev0 = test+1+highbnd
+                lev = lev0-1
+                Deltaz = dz[lev,jy,ix]
+                search = True
+                # negative levels are taken from the bottom as in the Python version
+                while (Deltaz < thicktrop) and (lev > -ndz):
+                    lev -= 1
+                    Deltaz += dz[lev % ndz,jy,ix]
+                    if (T[lev % nlev,jy,ix]-T[lev0,jy,ix])/Deltaz < offset:
+                        search = False
+                        break
+                if search:
+                    lev0s[jy,ix] = lev0
+                    break
+    return lev0s
+
+@jit(nopython=True,cache=True,parallel=True,error_model='numpy')
+def _lzrhlevel(csh,P,T,ASSWR,ASLWR,levbnd,p0,kappa):
+    """ Pressure, potential temperature and all sky heating at the level of
+    zero clear sky heating csh in each column, and mask of the columns without
+    crossing. When there are several crossings, the one closest to the mean
+    of the values of the previous row (same and next longitude) is chosen,
+    so that the rows are processed in sequence and the columns in parallel. """
+    n, ny, nx = csh.shape
+    plzrh = np.full((ny,nx),np.nan)
+    ptlzrh = np.full((ny,nx),np.nan)
+    aslzrh = np.full((ny,nx),np.nan)
+    mask = np.zeros((ny,nx),dtype=np.bool_)
+    for jy in range(ny):
+        pos = np.empty((nx,max(n,1)),dtype=np.int64)
+        px = np.empty((nx,max(n,1)))
+        pzk = np.empty((nx,max(n,1)))
+        for ix in prange(nx):
+            # crossings of zero heating from positive values above
+            npos = 0
+            for l in range(n-1):
+                if (csh[l,jy,ix] > 0) and not (csh[l+1,jy,ix] > 0):
+                    pos[ix,npos] = l
+                    npos += 1
+            # heating in the stratosphere is required to eliminate the folds
+            cmax = -np.inf
+            for l in range(min(levbnd,n)):
+                if np.isnan(csh[l,jy,ix]) or (csh[l,jy,ix] > cmax):
+                    cmax = csh[l,jy,ix]
+                    if np.isnan(cmax):
+                        break
+            if (npos == 0) or (cmax < 0):
+                mask[jy,ix] = True
+                continue
+            for m in range(npos):
+                l0 = pos[ix,m]
+                px[ix,m] = csh[l0,jy,ix]/(csh[l0,jy,ix]-csh[l0+1,jy,ix])
+                pzk[ix,m] = math.exp(px[ix,m]*math.log(P[l0+1,jy,ix])+(1-px[ix,m])*math.log(P[l0,jy,ix]))
+            k = 0
+            if (npos > 1) and (jy > 0):
+                if mask[jy-1,ix] or ((ix < nx-1) and mask[jy-1,ix+1]):
+                    # undefined mean: the first two crossings are ranked in order
+                    k2 = 1
+                else:
+                    if ix < nx-1:
+                        avpzt = (plzrh[jy-1,ix] + plzrh[jy-1,ix+1])/2
+                    else:
+                        avpzt = plzrh[jy-1,ix]/1
+                    k2 = -1
+                    for m in range(npos):
+                        d = (pzk[ix,m]-avpzt)**2
+                        if d < (pzk[ix,k]-avpzt)**2:
+                            k = m
+                    for m in range(npos):
+                        if m == k:
+                            continue
+                        if (k2 < 0) or ((pzk[ix,m]-avpzt)**2 < (pzk[ix,k2]-avpzt)**2):
+                            k2 = m
+                # correction of some rare artefacts near the tropopause (empirical)
+                if (pzk[ix,k] < 9500) and (pzk[ix,k2] > 12000):
+                    k = k2
+            l0 = pos[ix,k]
+            plzrh[jy,ix] = pzk[ix,k]
+            tz = px[ix,k]*T[l0+1,jy,ix] + (1-px[ix,k])*T[l0,jy,ix]
+            ptlzrh[jy,ix] = tz * (p0/pzk[ix,k])**kappa
+            aslzrh[jy,ix] = px[ix,k]*ASSWR[l0+1,jy,ix] + (1-px[ix,k])*ASSWR[l0,jy,ix] \
+                          + px[ix,k]*ASLWR[l0+1,jy,ix] + (1-px[ix,k])*ASLWR[l0,jy,ix]
+    return plzrh, ptlzrh, aslzrh, mask
+
+@jit(nopython=True,cache=True)
+def _addsample(fields,sp,am,bm,jy,ix,ix1,py,px,p,wt,out,k):
+    """ Adds wt times the values of the fields (tuple of [nlev,ny,nx] arrays) at
+    the point k of pressure p located in the mesh (jy,ix) with weights (py,px)
+    to out[:,k], ix1 being the next longitude index. The surface pressure is interpolated linearly in log and the
+    level is located as in mki2d from the coefficients am, bm of the levels.
+    Returns False if the point is not within the levels. """
+    ps = math.exp((1-px)*(1-py)*math.log(sp[jy,ix]) + (1-px)*py*math.log(sp[jy+1,ix])
+                  + px*(1-py)*math.log(sp[jy,ix1]) + px*py*math.log(sp[jy+1,ix1]))
+    nlev = len(am)
+    if not ((p >= am[0] + bm[0]*ps) and (p <= am[nlev-1] + bm[nlev-1]*ps)):
+        return False
+    k0 = 0
+    k1 = nlev-1
+    while k1-k0 > 1:
+        km = (k0+k1)//2
+        if am[km] + bm[km]*ps <= p:
+            k0 = km
+        else:
+            k1 = km
+    p0 = am[k0] + bm[k0]*ps
+    hc = math.log(p/p0)/math.log((am[k1] + bm[k1]*ps)/p0)
+    for v in range(len(fields)):
+        f = fields[v]
+        vhigh = (1-px)*(1-py)*f[k0,jy,ix] + (1-px)*py*f[k0,jy+1,ix] \
+              + px*(1-py)*f[k0,jy,ix1] + px*py*f[k0,jy+1,ix1]
+        vlow  = (1-px)*(1-py)*f[k1,jy,ix] + (1-px)*py*f[k1,jy+1,ix] \
+              + px*(1-py)*f[k1,jy,ix1] + px*py*f[k1,jy+1,ix1]
+        out[v,k] += wt*((1-hc)*vhigh + hc*vlow)
+    return True
+
+@jit(nopython=True,cache=True,parallel=True)
+def _sample(fields0,sp0,fields1,sp1,am,bm,x,y,p,w,Lo1,La1,dlo,dla,periodic,missing):
+    """ Values of the fields of two snapshots at the points (x,y,p),
+    interpolated linearly in time with the weights w of the second snapshot
+    (between 0 and 1). The longitudes wrap around if periodic is True (global
+    grid). Returns an array [nfields,npoints], set to missing for the points
+    outside the grid, the levels or the time interval. """
+    nlat, nlon = sp0.shape
+    n = len(x)
+    out = np.zeros((len(fields0),n))
+    # tolerance for the parcels just on the edges, which are clipped
+    eps = 1.e-6
+    for k in prange(n):
+        fx = (x[k]-Lo1)/dlo
+        fy = (y[k]-La1)/dla
+        valid = (w[k] >= 0.) and (w[k] <= 1.) and (fy > -eps) and (fy < nlat-1+eps)
+        if periodic:
+            fx = fx - nlon*math.floor(fx/nlon)
+            ix = min(int(math.floor(fx)),nlon-1)
+            ix1 = (ix+1) % nlon
+        else:
+            valid = valid and (fx > -eps) and (fx < nlon-1+eps)
+            fx = min(max(fx,0.),nlon-1.)
+            ix = min(int(math.floor(fx)),nlon-2)
+            ix1 = ix+1
+        fy = min(max(fy,0.),nlat-1.)
+        jy = min(int(math.floor(fy)),nlat-2)
+        px = fx - ix
+        py = fy - jy
+        if valid and (w[k] < 1.):
+            valid = _addsample(fields0,sp0,am,bm,jy,ix,ix1,py,px,p[k],1.-w[k],out,k)
+        if valid and (w[k] > 0.):
+            valid = _addsample(fields1,sp1,am,bm,jy,ix,ix1,py,px,p[k],w[k],out,k)
+        if not valid:
+            for v in range(len(fields0)):
+                out[v,k] = missing
+    return out
+
+def _fieldtuple(fields):
+    # tuple of fields of the same array type, as required by _sample
+    dtype = np.result_type(*fields)
+    fields = [np.ascontiguousarray(field,dtype=dtype) for field in fields]
+    if not all([field.flags.writeable for field in fields]):
+        # read-only fields (e.g. memory-mapped) are only kept if all are so
+        if any([field.flags.writeable for field in fields]):
+            fields = [field if field.flags.writeable else field.copy() for field in fields]
+    return tuple(fields)
+
 # Second order estimate of the first derivative dy/dx for non uniform spacing of x
 d = lambda x,y:(1/(x[2:,:,:]-x[:-2,:,:]))\
                 *((y[2:,:,:]-y[1:-1,:,:])*(x[1:-1,:,:]-x[:-2,:,:])/(x[2:,:,:]-x[1:-1,:,:])\
@@ -420,6 +746,50 @@ class ECMWF_pure(object):
         ix = np.abs(self.attr['lons']-x).argmin()
         return self.var[var][lev,jy,ix]
 
+    def sample(self,x,y,p,t=0.,other=None,varList='All'):
+        """ Interpolates the variables to the points (x,y,p) (lon, lat, Pa) at
+        the times t (seconds from self.date, scalar or array) between self and the
+        snapshot other, using trilinear interpolation in each snapshot as
+        interpol_part and linear interpolation in time. All the variables and
+        points are processed in one compiled pass, without building any
+        interpolator. other is not needed if all the points are at self.date.
+        The longitudes wrap around on a global grid (nlon*dlo = 360).
+        Returns a dictionary of arrays, set to MISSING for the points outside
+        the grid, the levels or the time interval. """
+        if varList == 'All':
+            varList = [var for var in self.var.keys() if var not in ['SP','P']]
+        elif type(varList) == str:
+            varList = [varList,]
+        snaps = [self] if other is None else [self,other]
+        for dat in snaps:
+            for var in varList+['SP']:
+                if var not in dat.var.keys():
+                    print(var,' not defined')
+                    return
+        if len(self.attr['levs']) < 2:
+            print('at least two levels are needed')
+            return
+        levs = self.attr['levs']-1
+        x = np.ascontiguousarray(x,dtype=np.float64).ravel()
+        y = np.ascontiguousarray(y,dtype=np.float64).ravel()
+        p = np.ascontiguousarray(p,dtype=np.float64).ravel()
+        if other is None:
+            w = np.zeros(len(x))
+            other = self
+        else:
+            if other.var[varList[0]].shape != self.var[varList[0]].shape:
+                print('the two snapshots must have the same grid')
+                return
+            w = np.asarray(t,dtype=np.float64)/(other.date-self.date).total_seconds()
+            w = np.ascontiguousarray(np.broadcast_to(w,x.shape))
+        dlo = self.attr['dlo']
+        periodic = abs(self.var['SP'].shape[1]*abs(dlo) - 360.) < 0.5*abs(dlo)
+        out = _sample(_fieldtuple([self.var[var] for var in varList]),self.var['SP'],
+                      _fieldtuple([other.var[var] for var in varList]),other.var['SP'],
+                      self.attr['am'][levs],self.attr['bm'][levs],x,y,p,w,
+                      self.attr['Lo1'],self.attr['La1'],dlo,self.attr['dla'],periodic,MISSING)
+        return dict(zip(varList,out))
+
     def interpol_time(self,other,date):
         # This code interpolate in time between two ECMWF objects with same vars
         # check the date
@@ -501,27 +871,12 @@ class ECMWF_pure(object):
         new.attr['levtype'] = 'pressure'
         new.attr['plev'] = p
         new.attr['levs'] = p
-        pmin = np.min(p)
-        pmax = np.max(p)
-        for var in varList:
-            new.var[var] = np.empty(shape=(len(p),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of p in the column
-                    npmin = np.abs(self.var['P'][:,jys,ixs]-pmin).argmin()
-                    npmax = np.abs(self.var['P'][:,jys,ixs]-pmax).argmin()+1
-                    npmin = max(npmin - 3,0)
-                    npmax = min(npmax + 3,self.nlev)
-                    # Better version than the linear interpolation but much too slow
-                    #fint = PchipInterpolator(np.log(self.var['P'][npmin:npmax,jys,ixs]),
-                    #                     self.var[var][npmin:npmax,jys,ixs])
-                    #new.var[var][:,jyt,ixt] = fint(np.log(p))
-                    new.var[var][:,jyt,ixt] = np.interp(np.log(p),np.log(self.var['P'][npmin:npmax,jys,ixs]),self.var[var][npmin:npmax,jys,ixs])
-                    ixt += 1
-                jyt += 1
+        # linear interpolation in log(p) over all the columns at once, with the same
+        # weights for all the variables
+        box = (slice(None),slice(nlatmin,nlatmax),slice(nlonmin,nlonmax))
+        fields = _vinterp([self.var[var][box] for var in varList],np.log(self.var['P'][box]),np.log(p))
+        for var, field in zip(varList,fields):
+            new.var[var] = field
         return new
 
     def interpolZ(self,z,varList='All',latRange=None,lonRange=None):
@@ -568,28 +923,12 @@ class ECMWF_pure(object):
         new.nlev = len(z)
         new.attr['levtype'] = 'altitude'
         new.attr['levs'] = z
-        zmin = np.min(z)
-        zmax = np.max(z)
-        for var in varList:
-            new.var[var] = np.empty(shape=(len(z),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of z in the column
-                    nzmin = np.abs(self.var['Z'][:,jys,ixs]-zmin).argmin()
-                    nzmax = np.abs(self.var['Z'][:,jys,ixs]-zmax).argmin()+1
-                    nzmin = max(nzmin + 3,self.nlev-1)
-                    nzmax = min(nzmax - 3,0)
-                    # Better version than the linear interpolation but much too slow
-                    #fint = PchipInterpolator(np.log(self.var['P'][npmin:npmax,jys,ixs]),
-                    #                     self.var[var][npmin:npmax,jys,ixs])
-                    #new.var[var][:,jyt,ixt] = fint(np.log(p))
-                    fint = interp1d(-self.var['Z'][nzmax:nzmin,jys,ixs],self.var[var][nzmax:nzmin,jys,ixs])
-                    new.var[var][:,jyt,ixt] =  [fint(-zz) for zz in z]
-                    ixt += 1
-                jyt += 1
+        # linear interpolation in -z (increasing from top to bottom) over all the
+        # columns at once, the values being clamped outside the columns
+        box = (slice(None),slice(nlatmin,nlatmax),slice(nlonmin,nlonmax))
+        fields = _vinterp([self.var[var][box] for var in varList],-self.var['Z'][box],-np.array(z,dtype=float))
+        for var, field in zip(varList,fields):
+            new.var[var] = field
         return new
 
     def interpolPT(self,pt,varList='All',latRange=None,lonRange=None):
@@ -641,86 +980,18 @@ class ECMWF_pure(object):
         new.attr['levtype'] = 'potential temperature'
         new.attr['levs'] = pt
         new.attr['plev'] = MISSING
-        thetmin = np.min(pt)
-        thetmax = np.max(pt)
-        for var in varList:
-            new.var[var] = np.empty(shape=(len(pt),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of pt in the column assumed ordered from top to bottom
-                    npup = np.abs(self.var['PT'][:,jys,ixs]-thetmax).argmin()
-                    npbot = np.abs(self.var['PT'][:,jys,ixs]-thetmin).argmin()+1
-                    npup = max(npup - 1,0)
-                    npbot = min(npbot + 1,self.nlev)
-                    #if jyt == 20 : print(npup,npbot)
-                    # Test sorting and interpolation with reverse potential temperature to ensure growth
-                    # along x-axis
-                    if np.any(self.var['PT'][npup+1:npbot,jys,ixs]-self.var['PT'][npup:npbot-1,jys,ixs]>0):
-                        #print('sort for ',ixt,jyt)
-                        pts = np.sort(-self.var['PT'][npup:npbot,jys,ixs])
-                        #print(pts)
-                    else:
-                        pts = -self.var['PT'][npup:npbot,jys,ixs]
-                    new.var[var][:,jyt,ixt] = np.interp(ptrev,pts,self.var[var][npup:npbot,jys,ixs])
-                    ixt += 1
-                jyt += 1
+        # linear interpolation in -theta over all the columns at once; the columns
+        # with inversions are sorted in theta together with the variables
+        box = (slice(None),slice(nlatmin,nlatmax),slice(nlonmin,nlonmax))
+        fields = _vinterp([self.var[var][box] for var in varList],-self.var['PT'][box],ptrev)
+        for var, field in zip(varList,fields):
+            new.var[var] = field
         return new
 
     def interpol_part(self,p,x,y,varList='All'):
-        """ Interpolate the variables to the location of particles given by [p,y,x] using trilinear method."""
-        if 'P' not in self.var.keys():
-            self._mkp()
-        if varList == 'All':
-            varList = list(self.var.keys())
-            varList.remove('SP')
-            varList.remove('P')
-        elif type(varList) == str:
-            varList = [varList,]
-        for var in varList:
-            if var not in self.var.keys():
-                print(var,' not defined')
-                return
-        # Defines output dictionary
-        result = {}
-        # test whether fhyb already attached to the instance
-        if not hasattr(self,'fhyb'):
-            self.fhyb,void = tohyb()
-        # generate the 2D interpolator of the surface pressure
-        lsp = RegularGridInterpolator((self.attr['lats'],self.attr['lons']),-np.log(self.var['SP']))
-        lspi = lsp(np.transpose([y,x]))
-        # define -log sigma = -log(p) - -log(ps)
-        lsig = - np.log(p) - lspi
-        # find the non integer hybrib level with offset due to the truncation of levels
-        hyb = self.fhyb(np.transpose([lsig,lspi]))-self.attr['levs'][0]+1
-        lhyb = np.floor(hyb).astype(np.int64)
-        # flag non valid parcels outside the domain (see discussion in convsrc2)
-        # notive that hyb == 100 not flagged as invalid, but clipped below
-        non_valid = np.where(hyb>100)[0]
-        # clip lhyb to remove out of bounds problems due to non valid parcels
-        lhyb = np.clip(lhyb,0,99)
-        #@@ test the extreme values of sigma end ps
-        if np.min(lsig) < - np.log(0.95):
-            print('large sigma detected ',np.exp(-np.min(lsig)))
-        if np.max(lspi) > -np.log(45000):
-            print('small ps detected ',np.exp(-np.max(lspi)))
-        # Horizontal interpolation
-        # clipping to avoid boundary effects for parcels just on the edges (especially on the eastern edge)
-        ix = np.clip(np.floor((x-self.attr['Lo1'])/self.attr['dlo']).astype(np.int64),0,self.nlon-2)
-        jy = np.clip(np.floor((y-self.attr['La1'])/self.attr['dla']).astype(np.int64),0,self.nlat-2)
-        px = ((x - self.attr['Lo1']) %  self.attr['dlo'])/self.attr['dlo']
-        py = ((y - self.attr['La1']) %  self.attr['dla'])/self.attr['dla']
-        for var in varList:
-            vhigh = (1-px)*(1-py)*self.var[var][lhyb,jy,ix] + (1-px)*py*self.var[var][lhyb,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb,jy,ix+1] + px*py*self.var[var][lhyb,jy+1,ix+1]
-            vlow  = (1-px)*(1-py)*self.var[var][lhyb+1,jy,ix] + (1-px)*py*self.var[var][lhyb+1,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb+1,jy,ix+1] + px*py*self.var[var][lhyb+1,jy+1,ix+1]
-            hc = hyb - lhyb
-            result[var] = (1-hc)*vhigh + hc*vlow
-            result[var][non_valid] = MISSING
-        return result
+        """ Interpolate the variables to the location of particles given by [p,y,x] using trilinear method.
+        The points outside the grid or the levels are set to MISSING (see sample). """
+        return self.sample(x,y,p,varList=varList)
 
     def _CPT(self):
         """ Calculate the cold point tropopause """
@@ -728,29 +999,22 @@ class ECMWF_pure(object):
             print('T or P undefined')
             return
         levbnd = {'FULL-EA':[30,90],'FULL-EI':[15,43],'STC':[10,90]}
-        # TODO: find a way to avoid the big loop
-        self.d2d['pcold'] = np.empty(shape=(self.nlat,self.nlon))
-        self.d2d['Tcold'] = np.empty(shape=(self.nlat,self.nlon))
-        if 'Z' in self.var.keys():
-            self.d2d['zcold'] = np.empty(shape=(self.nlat,self.nlon))
         # Calculate the cold point in the discrete profile
         # TO DO: make a smoother version with vertical interpolation
-        nc = np.argmin(self.var['T'][levbnd[self.project][0]:levbnd[self.project][1],...],axis=0)\
-           + levbnd[self.project][0]
-        for jy in range(self.nlat):
-            for ix in range(self.nlon):
-                self.d2d['pcold'][jy,ix] = self.var['P'][nc[jy,ix],jy,ix]
-                self.d2d['Tcold'][jy,ix] = self.var['T'][nc[jy,ix],jy,ix]
-        if  'Z' in self.var.keys():
-            for jy in range(self.nlat):
-                for ix in range(self.nlon):
-                    self.d2d['zcold'][jy,ix] = self.var['Z'][nc[jy,ix],jy,ix]
+        nc = _coldlevel(self.var['T'],levbnd[self.project][0],levbnd[self.project][1])[np.newaxis,...]
+        self.d2d['pcold'] = np.take_along_axis(self.var['P'],nc,axis=0)[0]
+        self.d2d['Tcold'] = np.take_along_axis(self.var['T'],nc,axis=0)[0]
+        if 'Z' in self.var.keys():
+            self.d2d['zcold'] = np.take_along_axis(self.var['Z'],nc,axis=0)[0]
         return
 
     def _lzrh(self):
         """ Calculate the clear sky LZRH. Translated from LzrnN.m
         Not yet validated. Use with caution.
         Add the calculation of the all sky LZRH
+        plzrh, ptlzrh and aslzrh are masked arrays, masked in the columns
+        without crossing of zero heating, where their data are NaN (the former
+        loop left them undefined).
         """
         if not set(['P','ASSWR','ASLWR','CSSWR','CSLWR']).issubset(self.var.keys()):
             print('P or heating rate missing')
@@ -760,104 +1024,28 @@ class ECMWF_pure(object):
         # Restrict the column (top at 60 hPa)
         ntop1 = 60 - self.attr['levs'][0]
         nbot1 = self.attr['levs'][-1] - 30
-        self.d2d['plzrh'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        self.d2d['ptlzrh'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        self.d2d['aslzrh'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        uniq = np.empty(shape=(self.nlat,self.nlon))
-        for jy in range(self.nlat):
-            for ix in range(self.nlon):
-                #print(jy,ix)
-                # Clear sky heating in the column
-                csh = self.var['CSSWR'][ntop1:nbot1,jy,ix] + self.var['CSLWR'][ntop1:nbot1,jy,ix]
-                # Define location of positive heating
-                lp = (csh>0).astype(np.int64)
-                # Find position of vertical crossings of zero heating
-                pos = np.where(lp[1:]-lp[:-1]==-1)[0]
-                # Number of crossings
-                uniq[jy,ix] = len(pos)
-                # Select column with at least one crossing and make sure there is heating
-                # in the strato higher than 66 hpa level to eliminate tropopause folds in the subtropics
-                #
-                if (len(pos)==0) | (np.max(csh[:levbnd[self.project]])<0) :
-                    self.d2d['plzrh'][jy,ix] = np.ma.masked
-                    self.d2d['ptlzrh'][jy,ix] = np.ma.masked
-                    self.d2d['aslzrh'][jy,ix] = np.ma.masked
-                    continue
-                # Calculate pressure at each crossing
-                pzk = []
-                px = []
-                for k in range(len(pos)):
-                    id = pos[k]
-                    #@@ Temporary test
-                    if (csh[id]*csh[id+1]>0) | (csh[id]<0):
-                        print('ERROR: localization')
-                        return
-                    px.append(csh[id]/(csh[id]-csh[id+1]))
-                    # Interopolate to get intersection
-                    pzk.append(math.exp(px[k]*math.log(self.var['P'][id+1,jy,ix])+(1-px[k])*math.log(self.var['P'][id,jy,ix])))
-                # Now we test the best continuity for pressure
-                # Collect neighbour values of the LZRH pressure already calculated
-                # and find intersections in the current column which is closest to these values
-
-                if len(pos)==1:
-                    k=0
-                else:
-                    if jy>0 & ix>0:
-                        if ix<self.nlon-1:
-                            pzt = list(self.d2d['plzrh'][jy-1,ix-1:ix+2])
-                            pzt.append(self.d2d['plzrh'][jy,ix-1])
-                        else:
-                            pzt = list(self.d2d['plzrh'][jy-1,ix-1:ix+1])
-                            pzt.append(self.d2d['plzrh'][jy,ix-1])
-                    elif jy==0 & ix>0:
-                        pzt = [self.d2d['plzrh'][jy,ix-1],]
-                    elif jy>0 & ix==0:
-                        pzt = list(self.d2d['plzrh'][jy-1,ix:ix+2])
-                    else:
-                        pzt = []
-                    if len(pzt)>0:
-                        avpzt = sum(pzt)/len(pzt)
-                        k = np.argmin((np.array(pzk)-avpzt)**2)
-                        # This patch corrects some rare artefacts near the tropopause
-                        # (empirical)
-                        if pzk[k] < 9500:
-                            print(jy,ix,len(pzk),avpzt,len(pzt),pzt,type(pzt))
-                            idx = np.argsort((np.array(pzk)-avpzt)**2)
-                            if pzk[idx[1]]>12000:
-                                k=idx[1]
-                    else:
-                        k=0
-                try:
-                    self.d2d['plzrh'][jy,ix] = pzk[k]
-                except:
-                    print('ERROR')
-                    print(self.d2d['plzrh'].shape,jy,ix)
-                    print(len(pzk),k)
-                # test
-                if jy==166 & ix==0:
-                    print(k,pzk[k])
-                # Calculate potential temperature and all sky heating at the LZRH
-                tz = px[k]*self.var['T'][pos[k]+1,jy,ix] + (1-px[k])*self.var['T'][pos[k],jy,ix]
-                self.d2d['ptlzrh'][jy,ix] = tz * (cst.p0/pzk[k])**cst.kappa
-                self.d2d['aslzrh'][jy,ix] = px[k]*self.var['ASSWR'][pos[k]+1,jy,ix] + (1-px[k])*self.var['ASSWR'][pos[k],jy,ix] \
-                                          + px[k]*self.var['ASLWR'][pos[k]+1,jy,ix] + (1-px[k])*self.var['ASLWR'][pos[k],jy,ix]
+        # Clear sky heating in the restricted columns
+        csh = self.var['CSSWR'][ntop1:nbot1,...] + self.var['CSLWR'][ntop1:nbot1,...]
+        # Crossings of zero heating, interpolated in log(p), and choice among
+        # several crossings by continuity with the previous row (compiled kernel)
+        plzrh, ptlzrh, aslzrh, mask = _lzrhlevel(csh,self.var['P'],self.var['T'],
+                              self.var['ASSWR'],self.var['ASLWR'],levbnd[self.project],cst.p0,cst.kappa)
+        self.d2d['plzrh'] = np.ma.array(plzrh,mask=mask)
+        self.d2d['ptlzrh'] = np.ma.array(ptlzrh,mask=mask)
+        self.d2d['aslzrh'] = np.ma.array(aslzrh,mask=mask)
         return
 
-    @jit
     def _WMO(self,highlatOffset=False):
         """ Calculate the WMO tropopause
         When highlatoffset is true the 2K/km criterion is replaced by a 3K/km
-        at high latitudes latitudes above 60S or 60N """
+        at high latitudes latitudes above 60S or 60N
+        pwmo and Twmo are masked where no tropopause is found, and zwmo
+        (calculated if Z is available), which is a plain array, is NaN there
+        (as np.ma.masked assigned to a float array). """
         if not set(['T','P']).issubset(self.var.keys()):
             print('T or P undefined')
             return
-        self.d2d['pwmo'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        self.d2d['Twmo'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        if 'Z' in self.var.keys():
-            self.d2d['zwmo'] = np.empty(shape=(self.nlat,self.nlon))
-            zwmo = True
-        else:
-            zwmo = False
+        zwmo = 'Z' in self.var.keys()
         levbnd = {'FULL-EA':[30,90],'FULL-EI':[15,43],'STC':[10,85]}
         highbnd = levbnd[self.project][0]
         lowbnd =  levbnd[self.project][1]
@@ -877,100 +1065,30 @@ class ECMWF_pure(object):
                        (self.var['T'][highbnd:lowbnd-1,...] - self.var['T'][highbnd+1:lowbnd,...]) / \
                        (logp[highbnd:lowbnd-1,...]-logp[highbnd+1:lowbnd,...])
 
-        for jy in range(self.nlat):
-            # standard wmo criterion
-            offset = - 0.002
-            thicktrop = 2000
-            # adaptation of the WMO offset at high latitude
-            if highlatOffset & (abs(self.attr['lats'][jy]) > 60): offset = -0.003
-            for ix in range(self.nlon):
-                # location of lapse rate exceeding the threshod
-                slope = list(np.where(lapse[:,jy,ix] > offset)[0])
-                Deltaz = 0.
-                found = False
-                # explore slope to find the first case where the slope is maintained
-                # over two km
-                # This is required to avoid shallow inversion layers to be confused with
-                # the tropopause
-                while not found:
-                    if len(slope)>0: # should be done with try but forbidden with numba
-                        # candidate tropopause
-                        test = slope.pop()
-                    else:
-                        # if all slopes have been processed without finding a suitable tropopause, mask loc
-                        self.d2d['pwmo'][jy,ix] = np.ma.masked
-                        self.d2d['Twmo'][jy,ix] = np.ma.masked
-                        if zwmo: self.d2d['zwmo'][jy,ix] = np.ma.masked
-                        found = True
-                        break
-                    # location of the basis of the interval
-                    # +1 to account for the shift of the finite difference
-                    lev0 = test+1+highbnd
-                    lev = lev0-1
-                    Deltaz = dz[lev,jy,ix]
-                    # performs search above the candidate tropopause
-                    search = True
-                    while Deltaz < thicktrop:
-                        lev -= 1
-                        Deltaz += dz[lev,jy,ix]
-                        # mean slope over the considered layer
-                        if (self.var['T'][lev,jy,ix]-self.var['T'][lev0,jy,ix])/Deltaz < offset:
-                            search = False
-                            break
-                    if search:
-                        found = True
-                        self.d2d['pwmo'][jy,ix] = self.var['P'][lev0,jy,ix]
-                        self.d2d['Twmo'][jy,ix] = self.var['T'][lev0,jy,ix]
-                        if zwmo: self.d2d['zwmo'][jy,ix] = self.var['Z'][lev0,jy,ix]
+        # standard wmo criterion
+        offsets = np.full(self.nlat,-0.002)
+        thicktrop = 2000
+        # adaptation of the WMO offset at high latitude
+        if highlatOffset:
+            offsets[np.abs(self.attr['lats']) > 60] = -0.003
+        # explore the levels where the lapse rate exceeds the threshold from the bottom
+        # to find the first one where the slope is maintained over two km
+        # This is required to avoid shallow inversion layers to be confused with
+        # the tropopause (compiled kernel)
+        lev0 = _wmolevel(lapse,dz,self.var['T'],offsets,highbnd,thicktrop)
+        mask = lev0 < 0
+        lev0 = np.where(mask,0,lev0)[np.newaxis,...]
+        self.d2d['pwmo'] = np.ma.array(np.take_along_axis(self.var['P'],lev0,axis=0)[0],mask=mask)
+        self.d2d['Twmo'] = np.ma.array(np.take_along_axis(self.var['T'],lev0,axis=0)[0],mask=mask)
+        if zwmo:
+            self.d2d['zwmo'] = np.take_along_axis(self.var['Z'],lev0,axis=0)[0]
+            self.d2d['zwmo'][mask] = np.nan
         return
 
     def interpol_track(self,p,x,y,varList='All'):
         """ Writing in progress. For the moment, this is a copy of interpol_part.
         Calculate the distance to the cold point and to the LZRH ."""
-        if 'P' not in self.var.keys():
-            self._mkp()
-        if varList == 'All':
-            varList = list(self.var.keys())
-            varList.remove('SP')
-            varList.remove('P')
-        elif type(varList) == str:
-            varList = [varList,]
-        for var in varList:
-            if var not in self.var.keys():
-                print(var,' not defined')
-                return
-        # Defines output dictionary
-        result = {}
-        # test whether fhyb already attached to the instance
-        if not hasattr(self,'fhyb'):
-            self.fhyb,void = tohyb()
-        # generate the 2D interpolator of the surface pressure
-        lsp = RegularGridInterpolator((self.attr['lats'],self.attr['lons']),-np.log(self.var['SP']))
-        lspi = lsp(np.transpose([y,x]))
-        # define -log sigma = -log(p) - -log(ps)
-        lsig = - np.log(p) - lspi
-        # find the non integer hybrib level
-        hyb = self.fhyb(np.transpose([lsig,lspi]))-self.attr['levs'][0]+1
-        lhyb = np.floor(hyb).astype(np.int64)
-        #@@ test the extreme values of sigma end ps
-        if np.min(lsig) < - np.log(0.95):
-            print('large sigma detected ',np.exp(-np.min(lsig)))
-        if np.max(lspi) > -np.log(45000):
-            print('small ps detected ',np.exp(-np.max(lspi)))
-        # Horizontal interpolation
-        ix = np.floor((x-self.attr['Lo1'])/self.attr['dlo']).astype(np.int64)
-        jy = np.floor((y-self.attr['La1'])/self.attr['dla']).astype(np.int64)
-        px = ((x - self.attr['Lo1']) %  self.attr['dlo'])/self.attr['dlo']
-        py = ((y - self.attr['La1']) %  self.attr['dla'])/self.attr['dla']
-        for var in varList:
-            vhigh = (1-px)*(1-py)*self.var[var][lhyb,jy,ix] + (1-px)*py*self.var[var][lhyb,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb,jy,ix+1] + px*py*self.var[var][lhyb,jy+1,ix+1]
-            vlow  = (1-px)*(1-py)*self.var[var][lhyb+1,jy,ix] + (1-px)*py*self.var[var][lhyb+1,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb+1,jy,ix+1] + px*py*self.var[var][lhyb+1,jy+1,ix+1]
-            hc = hyb % 1
-            result[var] = (1-hc)*vhigh + hc*vlow
-            del hc; del vhigh; del vlow
-        return result
+        return self.sample(x,y,p,varList=varList)
 
     def interpol_orbit(self,x,y,varList='All',var2='All'):
         """ Generate an interpolation to an orbit curtain in 2d """
@@ -1005,6 +1123,29 @@ class ECMWF_pure(object):
                         + px*(1-py)*self.var[var][lev,jy,ix1] + px*py*self.var[var][lev,jy+1,ix1]
         return sect
 
+class _MetaDict(dict):
+    """ Dictionary of the attributes or variables of an ECMWF object whose
+    missing keys trigger the reading of the metadata (grid, hybrid coefficients
+    and surface pressure) if not already done """
+    def __init__(self,readmeta):
+        dict.__init__(self)
+        self.readmeta = readmeta
+        # keys assigned since the field was read (see ECMWF._keep)
+        self.modified = set()
+    def __setitem__(self,key,value):
+        dict.__setitem__(self,key,value)
+        self.modified.add(key)
+    def update(self,*args,**kwargs):
+        for key, value in dict(*args,**kwargs).items():
+            self[key] = value
+    def __missing__(self,key):
+        self.readmeta()
+        if dict.__contains__(self,key):
+            return dict.__getitem__(self,key)
+        raise KeyError(key)
+    def copy(self):
+        return dict(self)
+
 # standard class to read data
 class ECMWF(ECMWF_pure):
     # to do: raise exception in case of an error
@@ -1200,7 +1341,7 @@ class ECMWF(ECMWF_pure):
                      'CSSWR':['mttswrcs','Mean temperature tendency due to short-wave radiation, clear sky','K s**-1'],
                      'CSLWR':['mttlwrcs','Mean temperature tendency due to long-wave radiation, clear sky','K s**-1'],
                      'PHR':['mttpm','Mean temperature tendency due to parametrerizations','K s**-1'],}
-                self.dname == date.strftime('ERA5DI%Y%m%d')
+                self.dname = date.strftime('ERA5DI%Y%m%d')
             else:
                 # for ERA5: tendencies over 1-hour intervals following file date
                 self.DIvar = {'ASSWR':['mttswr','Mean temperature tendency due to short-wave radiation','K s**-1'],
@@ -1252,55 +1393,110 @@ class ECMWF(ECMWF_pure):
                           'QR':['crwc','Specific rain water content:kg kg**-1'],
                           'QS':['cswc','Specific snow water content:kg kg**-1']}
             self.qnname = date.strftime('ERA5QN%Y%m%d.grb')
-        # opening first the DI file as it might be needed to get pressure for hours not multiple of 3
+        # Location of the streams, which are opened at the first use of one of
+        # their variables (see _stream). The surface pressure message, which
+        # also provides the grid and the hybrid coefficients, is read at the
+        # first need of these metadata (see _readmeta).
+        self.paths = {'EN':[os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname),
+                            os.path.join(self.rootdir,path1,date.strftime('%Y'),self.fname)]}
         if self.DI_expected:
-            try:
-                self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
-                self.DI_open = True
-            except:
-                try:
-                    self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
-                    self.DI_open = True
-                except:
-                    print('cannot open '+os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
-        # opening the main EN file
-        try:
-            self.grb = pygrib.open(os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname))
-        except:
-            try:
-                self.grb = pygrib.open(os.path.join(self.rootdir,path1,date.strftime('%Y'),self.fname))
-            except:
-                print('cannot open '+os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname))
-                return
+            self.paths['DI'] = [os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname),
+                                os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname)]
+        if self.WT_expected:
+            self.paths['WT'] = [os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname)]
+        if self.VD_expected:
+            self.paths['VD'] = [os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname)]
+        if self.DE_expected:
+            self.paths['DE'] = [os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename)]
+        if self.x4I_expected:
+            self.paths['x4I'] = [os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname)]
+        if self.VOZ_expected:
+            self.paths['VOZ'] = [os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname)]
+        if self.QN_expected:
+            self.paths['QN'] = [os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname)]
+        self.rb = {}
+        for name in ['EN','DI','WT','VD','DE','x4I','VOZ','QN']:
+            setattr(self,name+'_open',False)
+        self.step = step
+        self.meta_read = False
+        # key of the fields of this object in the cache of the process, and
+        # fields as read from the files or the cache, the derived fields being
+        # only cached if calculated from such fields
+        if project == 'OPZFCST':
+            self.cachekey = None
+        else:
+            self.cachekey = (project,date,tuple(exp) if isinstance(exp,list) else exp)
+        self._loaded = {}
+        # derived variables calculated on part of the columns, and the columns
+        # where they are calculated (see columns)
+        self.colvar = {}
+        self.coldone = {}
+        self.var = _MetaDict(self._readmeta)
+        self.attr = _MetaDict(self._readmeta)
+
+    def __getattr__(self,name):
+        # the grid sizes are defined when the metadata are read
+        if (name in ['nlon','nlat']) and not self.__dict__.get('meta_read',True):
+            self._readmeta()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _stream(self,name):
+        """ Opens the stream name (EN, DI, WT, VD, DE, x4I, VOZ, QN) at its
+        first use and returns its GribIndex, or None if it cannot be opened
+        The indexes are taken from the pool shared by all the ECMWF objects
+        of the process (see gribidx.opengrib). """
+        if name not in self.rb:
+            self.rb[name] = None
+            if name in self.paths:
+                for path in self.paths[name]:
+                    try:
+                        self.rb[name] = opengrib(path)
+                        break
+                    except:
+                        pass
+                if self.rb[name] is None:
+                    print('cannot open '+self.paths[name][0])
+            setattr(self,name+'_open',self.rb[name] is not None)
+        return self.rb[name]
+
+    def _readmeta(self):
+        """ Reads the surface pressure message and gets from it the grid,
+        the dates, the hybrid coefficients and the surface pressure """
+        if self.meta_read:
+            return
+        self.meta_read = True
+        grb = self._stream('EN')
+        if grb is None:
+            return
+        project = self.project
+        step = self.step
         # Define searched valid date and time, and step
         validityDate = int(self.date.strftime('%Y%m%d'))
         validityTime = int(self.date.strftime('%H%M'))
-        self.EN_open = True
-        step
         try:
-            sp = self.grb.select(name='Logarithm of surface pressure',validityTime=validityTime)[0]
+            sp = grb.select(name='Logarithm of surface pressure',validityTime=validityTime)[0]
             logp = True
         except:
             try:
                 if self.project=='OPZFCST':
-                    sp = self.grb.select(name='Logarithm of surface pressure',validityTime=validityTime,step=step)[0]
+                    sp = grb.select(name='Logarithm of surface pressure',validityTime=validityTime,step=step)[0]
                     logp = True
-                elif (self.project == 'FULL-EA') & self.DI_open:
-                    sp = self.drb.select(name='Logarithm of surface pressure',validityTime=validityTime)[0]
+                elif (self.project == 'FULL-EA') & (self._stream('DI') is not None):
+                    sp = self._stream('DI').select(name='Logarithm of surface pressure',validityTime=validityTime)[0]
                     logp = True
                 else:
-                    sp = self.grb.select(name='Surface pressure',validityTime=validityTime)[0]
+                    sp = grb.select(name='Surface pressure',validityTime=validityTime)[0]
                     logp = False
             except:
                 print('no surface pressure in '+self.fname)
-                self.grb.close()
                 return
         # Check date matching (should be)
         if (sp['validityDate'] != validityDate) & (self.project!='OPZFCST'):
             print('WARNING: dates do not match')
             print('called date    ',self.date.strftime('%Y%m%d %H%M'))
             print('date from file ',sp['validityDate'],sp['validityTime'])
-            self.grb.close()
             return
         # Get general info from this message
         self.attr['Date'] = sp['dataDate']
@@ -1349,71 +1545,52 @@ class ECMWF(ECMWF_pure):
         self.attr['lats'] = self.attr['lats'][::-1]
         self.var['SP']   = self.var['SP'][::-1,:]
         self.attr['dla'] = -  self.attr['dla']
-        # Opening of the other files
-        self.DI_open = False
-        self.WT_open = False
-        self.VD_open = False
-        self.DE_open = False
-        self.x4I_open = False
-        self.VOZ_open = False
-        self.QN_open = False
-        if self.DI_expected:
-            try:
-                self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
-                self.DI_open = True
-            except:
-                try:
-                    self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
-                    self.DI_open = True
-                except:
-                    print('cannot open '+os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
-        if self.WT_expected:
-            try:
-                self.wrb = pygrib.open(os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname))
-                self.WT_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname))
-        if self.VD_expected:
-            try:
-                self.vrb = pygrib.open(os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname))
-                self.VD_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname))
-        if self.DE_expected:
-            try:
-                self.derb = pygrib.open(os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename))
-                self.DE_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename))
-        if self.x4I_expected:
-            try:
-                self.x4Irb = pygrib.open(os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname))
-                self.x4I_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname))
-        if self.VOZ_expected:
-            try:
-                self.vozrb = pygrib.open(os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname))
-                self.VOZ_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname))
-        if self.QN_expected:
-            try:
-                self.qnrb = pygrib.open(os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname))
-                self.QN_open = True
-            except:
-                print('cannot open '+os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname))
+        if self._caching():
+            self._keep('SP',self.var['SP'])
+
+    def _caching(self):
+        # True if the fields of this object go through the cache of the process
+        return (self.cachekey is not None) and (cache.limit > 0)
+
+    def _keep(self,name,field):
+        # records field as read from the files or the cache
+        self._loaded[name] = field
+        self.var.modified.discard(name)
+
+    def _pristine(self,inputs):
+        # True if the fields inputs are those read from the files or the cache
+        # and have not been assigned again since
+        return all([(v in self.var.keys()) and (self._loaded.get(v) is dict.get(self.var,v))
+                    and (v not in self.var.modified) for v in inputs])
+
+    def _fromcache(self,names,inputs,key=None):
+        """ Gets the fields names (derived from the fields inputs) from the
+        cache of the process, if available and if the inputs are those read
+        from the files. key defaults to the first name. Returns True on success. """
+        if not self._caching() or not self._pristine(inputs):
+            return False
+        fields = cache.get(self.cachekey+(key or names[0],))
+        if fields is None:
+            return False
+        for name, field in zip(names,fields):
+            self.var[name] = field
+            self._keep(name,field)
+        return True
+
+    def _tocache(self,names,inputs,key=None):
+        """ Stores the fields names in the cache of the process if they
+        have been derived from the fields inputs as read from the files """
+        if not self._caching() or not self._pristine(inputs):
+            return
+        cache.put(self.cachekey+(key or names[0],),tuple([self.var[name] for name in names]))
+        for name in names:
+            self._keep(name,self.var[name])
 
     def close(self):
-        self.grb.close()
-        try: self.drb.close()
-        except: pass
-        try: self.wrb.close()
-        except: pass
-        try: self.derb.close()
-        except: pass
-        try: self.vrb.close()
-        except: pass
+        # the indexes stay in the pool of the process for the next hours
+        self.rb = {}
+        for name in ['EN','DI','WT','VD','DE','x4I','VOZ','QN']:
+            setattr(self,name+'_open',False)
 
 # short cut for some common variables
     def _get_T(self):
@@ -1428,61 +1605,73 @@ class ECMWF(ECMWF_pure):
         self._get_var('Q')
 
 # get a variable from the archive
-    def _get_var(self,var,step=None):
-        if (var in self.var.keys()) & (self.project != 'OPZFCST'):
-            return
+    def _select(self,var,step=None,**keys):
+        """ Selects the messages of var in the stream which contains it.
+        keys are additional selection keys, e.g. level=[1,2,3]
+        Returns the list of messages, or None if var is not found. """
+        self._readmeta()
         get = False
         try:
-            if self.EN_open:
-                if var in self.ENvar.keys():
+            if var in self.ENvar.keys():
+                if self._stream('EN') is not None:
                     if self.project=='OPZFCST':
                         if step is not None:
                             stepi = step
                             self.attr['step'] = step
                         else: stepi = self.attr['step']
-                        TT = self.grb.select(shortName=self.ENvar[var][0],validityTime=self.attr['valTime'],step=stepi)
+                        TT = self._stream('EN').select(shortName=self.ENvar[var][0],validityTime=self.attr['valTime'],step=stepi,**keys)
                     else:
-                        TT = self.grb.select(shortName=self.ENvar[var][0],validityTime=self.attr['valTime'])
+                        TT = self._stream('EN').select(shortName=self.ENvar[var][0],validityTime=self.attr['valTime'],**keys)
                     get = True
-            if ~get & self.DI_open:
-                if var in self.DIvar.keys():
-                    TT = self.drb.select(shortName=self.DIvar[var][0],validityTime=(self.attr['valTime']+self.offd) % 2400)
+            if (not get) & self.DI_expected:
+                if (var in self.DIvar.keys()) and (self._stream('DI') is not None):
+                    TT = self._stream('DI').select(shortName=self.DIvar[var][0],validityTime=(self.attr['valTime']+self.offd) % 2400,**keys)
                     get = True
-            if ~get & self.WT_open:
-                if var in self.WTvar.keys():
-                    TT = self.wrb.select(shortName=self.WTvar[var][0],validityTime=self.attr['valTime'])
+            if (not get) & self.WT_expected:
+                if (var in self.WTvar.keys()) and (self._stream('WT') is not None):
+                    TT = self._stream('WT').select(shortName=self.WTvar[var][0],validityTime=self.attr['valTime'],**keys)
                     get = True
-            if ~get & self.VD_open:
-                if var in self.VDvar.keys():
-                    TT = self.vrb.select(shortName=self.VDvar[var][0],validityTime=self.attr['valTime'])
+            if (not get) & self.VD_expected:
+                if (var in self.VDvar.keys()) and (self._stream('VD') is not None):
+                    TT = self._stream('VD').select(shortName=self.VDvar[var][0],validityTime=self.attr['valTime'],**keys)
                     get = True
-            if ~get & self.DE_open:
-                if var in self.DEvar.keys():
+            if (not get) & self.DE_expected:
+                if (var in self.DEvar.keys()) and (self._stream('DE') is not None):
                     # Shift of validity time due to ERA-I convention
-                    TT = self.derb.select(shortName=self.DEvar[var][0],validityTime=(self.attr['valTime']+self.offd) % 2400)
+                    TT = self._stream('DE').select(shortName=self.DEvar[var][0],validityTime=(self.attr['valTime']+self.offd) % 2400,**keys)
                     get = True
-            if ~get & self.x4I_open:
-                if var in self.x4Ivar.keys():
+            if (not get) & self.x4I_expected:
+                if (var in self.x4Ivar.keys()) and (self._stream('x4I') is not None):
                     # sum of the four partial increments
                     TT = {}
                     print('TT created')
                     for i in range(4):
-                        TT[i] = self.x4Irb.select(shortName=self.x4Ivar[var][0],validityTime=self.attr['valTime']+300,iterationNumber=i)
+                        TT[i] = self._stream('x4I').select(shortName=self.x4Ivar[var][0],validityTime=self.attr['valTime']+300,iterationNumber=i,**keys)
                         print('exit',i)
                     get = True
-            if ~get & self.VOZ_open:
-                if var in self.VOZvar.keys():
-                    TT = self.vozrb.select(shortName=self.VOZvar[var][0],validityTime=self.attr['valTime'])
+            if (not get) & self.VOZ_expected:
+                if (var in self.VOZvar.keys()) and (self._stream('VOZ') is not None):
+                    TT = self._stream('VOZ').select(shortName=self.VOZvar[var][0],validityTime=self.attr['valTime'],**keys)
                     get = True
-            if ~get & self.QN_open:
-                if var in self.QNvar.keys():
-                    TT = self.qnrb.select(shortName=self.QN.var[var][0],validityTime=self.attr['valTime'])
+            if (not get) & self.QN_expected:
+                if (var in self.QNvar.keys()) and (self._stream('QN') is not None):
+                    TT = self._stream('QN').select(shortName=self.QNvar[var][0],validityTime=self.attr['valTime'],**keys)
                     get = True
             if get == False:
                     print(var+' not found')
-                    return
+                    return None
         except:
             print(var+' not found or read error')
+            return None
+        return TT
+
+    def _get_var(self,var,step=None):
+        if (var in self.var.keys()) & (self.project != 'OPZFCST'):
+            return
+        if self._fromcache_var(var):
+            return
+        TT = self._select(var,step)
+        if TT is None:
             return
         # Process each message corresponding to a level
         # Special case of the 4D var increment first
@@ -1494,7 +1683,7 @@ class ECMWF(ECMWF_pure):
             self.var[var] = np.zeros(shape=[self.nlev,self.nlat,self.nlon])
             for i in range(4):
                for l in range(len(TT[i])):
-                   self.var[var][l,:,:] += TT[i][l]['values']
+                   self.var[var][l,:,:] += TT[i][l]['values'][::-1,:]
             readlev = False
         # Common case
         else:
@@ -1511,9 +1700,11 @@ class ECMWF(ECMWF_pure):
             self.var[var] = np.empty(shape=[self.nlev,self.nlat,self.nlon])
             #print(np.isfortran(self.var[var]))
             # assuming levels are stored from top to bottom
+            # the latitudes are reverted from North -> South to South -> North
+            # while filling the array
             offset = TT[0]['level']
             for l in range(len(TT)):
-                self.var[var][TT[l]['level']-offset,:,:] = TT[l]['values']
+                self.var[var][TT[l]['level']-offset,:,:] = TT[l]['values'][::-1,:]
                 if readlev:
                     try:
                         lev = TT[l]['lev']
@@ -1530,31 +1721,241 @@ class ECMWF(ECMWF_pure):
         if readlev:
             if not strictly_increasing(self.attr['levs']):
                 self.warning.append('NOT STRICTLY INCREASING LEVELS')
-        # Reverting North -> South to South to North
-        #print(np.isfortran(self.var[var]))
-        self.var[var] = self.var[var][:,::-1,:]
-        #print(np.isfortran(self.var[var]))
+        if self._caching() and not x4ISpecial:
+            cache.put(self.cachekey+(var,),(self.var[var],self.attr['levs'],self.attr['plev']))
+            self._keep(var,self.var[var])
         return None
 
-    def get_var(self,var):
-        self._get_var(var)
-        return self.var['var' ]
+    def _fromcache_var(self,var):
+        """ Gets var from the cache of the process with the levels read with
+        it if no level has been read before. Returns True on success. """
+        if not self._caching():
+            return False
+        self._readmeta()
+        hit = cache.get(self.cachekey+(var,))
+        if hit is None:
+            return False
+        field, levs, plev = hit
+        if 'levs' not in self.attr.keys():
+            self.nlev = len(levs)
+            self.attr['levs'] = levs
+            self.attr['plev'] = plev
+        self.var[var] = field
+        self._keep(var,field)
+        return True
+
+    def _get_steps(self,var,steps):
+        """ Reads var for several forecast steps of the run of an OPZFCST file
+        in one pass over the file. Returns a dictionary of [nlev,nlat,nlon]
+        arrays indexed by step, with latitudes from South to North. """
+        self._readmeta()
+        grb = self._stream('EN')
+        if (grb is None) or (var not in self.ENvar.keys()):
+            print(var+' not found')
+            return {}
+        try:
+            TT = grb.select(shortName=self.ENvar[var][0],dataDate=self.attr['Date'],
+                            dataTime=self.attr['Time'],step=list(steps))
+        except:
+            print(var+' not found or read error')
+            return {}
+        bystep = {}
+        for msg in TT:
+            bystep.setdefault(msg['step'],[]).append(msg)
+        fields = {}
+        for step in steps:
+            if step not in bystep:
+                print(var+' not found for step '+str(step))
+                continue
+            fields[step] = np.empty(shape=[len(bystep[step]),self.nlat,self.nlon])
+            offset = bystep[step][0]['level']
+            for msg in bystep[step]:
+                fields[step][msg['level']-offset,:,:] = msg['values'][::-1,:]
+        return fields
+
+    def _window(self,latRange=None,lonRange=None):
+        """ Index ranges [j0,j1) of the latitudes and [i0,i1) of the longitudes
+        of the box latRange x lonRange, with the same bounds as extract """
+        lats = self.attr['lats']
+        lons = self.attr['lons']
+        if (latRange is None) or (len(latRange) == 0):
+            j0, j1 = 0, len(lats)
+        else:
+            j0 = max(np.searchsorted(lats,latRange[0],side='right')-1,0)
+            j1 = np.searchsorted(lats,latRange[1],side='right')
+        if (lonRange is None) or (len(lonRange) == 0):
+            i0, i1 = 0, len(lons)
+        else:
+            i0 = max(np.searchsorted(lons,lonRange[0],side='right')-1,0)
+            i1 = min(np.searchsorted(lons,lonRange[1],side='left')+1,len(lons))
+        return j0, j1, i0, i1
+
+    def get_var(self,var,latRange=None,lonRange=None,levs=None,dtype=None,step=None):
+        """ Returns the field var (latitudes from South to North) restricted to
+        the box latRange x lonRange, with the same bounds as extract, and to the
+        model levels levs (list of level numbers as in attr['levs'], returned in
+        the order of the file), as an array of type dtype (default float64).
+        The corresponding latitudes are attr['lats'][j0:j1] and longitudes
+        attr['lons'][i0:i1], with j0, j1, i0, i1 = self._window(latRange,lonRange).
+        Only the messages of the selected levels are decoded and only the box is
+        stored. The field is kept in self.var when no box, levels or dtype is
+        requested, as with _get_var. """
+        if (latRange is None) & (lonRange is None) & (levs is None) & (dtype is None):
+            self._get_var(var,step)
+            return self.var.get(var)
+        if dtype is None:
+            dtype = np.float64
+        self._readmeta()
+        j0, j1, i0, i1 = self._window(latRange,lonRange)
+        # fields already read or cached, and 4D-var increments which are sums of messages
+        if (var in self.var.keys()) | (self.x4I_expected and (var in self.x4Ivar.keys())) \
+           | (self._caching() and (self.cachekey+(var,) in cache)):
+            self._get_var(var,step)
+            if var not in self.var.keys():
+                return None
+            if levs is None:
+                ls = slice(None)
+            else:
+                ls = np.sort([list(self.attr['levs']).index(lev) for lev in levs])
+            return np.array(self.var[var][ls,j0:j1,i0:i1],dtype=dtype)
+        if levs is None:
+            TT = self._select(var,step)
+        else:
+            TT = self._select(var,step,level=list(levs))
+        if TT is None:
+            return None
+        nlat = self.nlat
+        field = np.empty(shape=[len(TT),j1-j0,i1-i0],dtype=dtype)
+        for l in range(len(TT)):
+            field[l,:,:] = TT[l]['values'][nlat-j1:nlat-j0,i0:i1][::-1,:]
+        return field
+
+    def derive(self,names,dtype=np.float64,out=None):
+        """ Returns the derived variable names (see DERIVED), or the list of
+        the derived variables for a list of names, calculating them and the
+        variables they depend on if not yet done. The variables which are not
+        derived are read. All the results are kept in self.var, so that each
+        variable is calculated once for the object.
+        dtype is the precision of the calculated fields and out an optional
+        dictionary of arrays in which they are written, e.g. the fields of
+        another date which are no more used. Returns None for a variable which
+        cannot be obtained. """
+        if out is None:
+            out = {}
+        if isinstance(names,str):
+            return self._derive(names,np.dtype(dtype),out)
+        return [self._derive(name,np.dtype(dtype),out) for name in names]
+
+    def _derive(self,name,dtype,out):
+        self._readmeta()
+        if name in self.var.keys():
+            return self.var[name]
+        if name not in DERIVED:
+            self._get_var(name)
+            return dict.get(self.var,name)
+        inputs, calc = DERIVED[name]
+        for var in inputs:
+            if self._derive(var,dtype,out) is None:
+                print(var+' undefined, cannot calculate '+name)
+                return None
+        names = [name,'Z0'] if name == 'Z' else [name]
+        key = name if dtype == np.float64 else name+'-'+dtype.name
+        if self._fromcache(names,inputs,key):
+            return self.var[name]
+        if name in ['P','PZ']:
+            shape = (len(self.attr['levs']),)+self.var['SP'].shape
+        else:
+            shape = self.var[inputs[0]].shape
+        buf = out.get(name)
+        if (buf is None) or (buf.shape != shape) or (buf.dtype != dtype):
+            buf = np.empty(shape=shape,dtype=dtype)
+        if getattr(self,calc)(buf) is False:
+            return None
+        self.var[name] = buf
+        self._tocache(names,inputs,key)
+        return buf
+
+    def columns(self,name,jy,ix):
+        """ Returns the derived variable name (see COLUMNS) calculated only on
+        the columns (jy[k],ix[k]) of the grid which have not yet been calculated
+        for this object, e.g. the columns touched by the parcels during a time
+        slice. The result is an array [nlev,nlat,nlon] which is only valid on the
+        columns calculated so far, the other columns being NaN. It is kept in self.colvar, so that the next
+        calls only calculate the new columns. The variables which are not
+        derived are read entirely. """
+        self._readmeta()
+        if name in self.var.keys():
+            return self.var[name]
+        if name not in COLUMNS:
+            print(name+' cannot be calculated by columns')
+            return None
+        # each column once
+        shape = self.var['SP'].shape
+        cols = np.unique(np.ravel_multi_index((np.ravel(jy),np.ravel(ix)),shape))
+        jy, ix = np.unravel_index(cols,shape)
+        if self._colfill(name,jy,ix) is None:
+            return None
+        return self.colvar[name]
+
+    def _colfill(self,name,jy,ix):
+        # calculates name on the columns (jy,ix) where it is not yet done and
+        # returns its values on these columns as an array [nlev,n,1], the
+        # columns being seen as a grid of n x 1 points by the _calc methods
+        if (name not in COLUMNS) or (name in self.var.keys()):
+            field = self._derive(name,np.dtype(np.float64),{})
+            if field is None:
+                return None
+            return field[...,jy,ix][...,np.newaxis]
+        if name in self.colvar:
+            new = ~self.coldone[name][jy,ix]
+        else:
+            new = np.ones(len(jy),dtype=bool)
+        if new.any():
+            inputs, calc = DERIVED[name]
+            view = ECMWF_pure()
+            view.attr = self.attr
+            for var in inputs:
+                values = self._colfill(var,jy[new],ix[new])
+                if values is None:
+                    print(var+' undefined, cannot calculate '+name)
+                    return None
+                view.var[var] = values
+            buf = np.empty(shape=(len(self.attr['levs']),np.count_nonzero(new),1))
+            getattr(ECMWF,calc)(view,buf)
+            if name not in self.colvar:
+                self.colvar[name] = np.full((len(self.attr['levs']),)+self.var['SP'].shape,np.nan)
+                self.coldone[name] = np.zeros(shape=self.var['SP'].shape,dtype=bool)
+            self.colvar[name][:,jy[new],ix[new]] = buf[...,0]
+            self.coldone[name][jy[new],ix[new]] = True
+        return self.colvar[name][:,jy,ix][...,np.newaxis]
+
+    def _remake(self,name,var=None):
+        # calculation of name (stored as var) by the former _mk methods,
+        # which recalculate the variable but not its dependencies
+        self.var.pop(name,None)
+        self._loaded.pop(name,None)
+        self.colvar.pop(name,None)
+        if self.derive(name) is not None and (var is not None):
+            self.var[var] = self.var.pop(name)
+            self._loaded.pop(name,None)
 
     def _mkp(self):
         # Calculate the pressure field
-        self.var['P'] =  np.empty(shape=(self.nlev,self.nlat,self.nlon))
-        for i in range(self.nlev):
-            lev = self.attr['levs'][i]
-            self.var['P'][i,:,:] = self.attr['am'][lev-1] \
-                                 + self.attr['bm'][lev-1]*self.var['SP']
+        self._remake('P')
 
     def _mkpz(self):
         # Calculate pressure field for w (check)
-        self.var['PZ'] =  np.empty(shape=(self.nlev,self.nlat,self.nlon))
-        for i in range(self.nlev):
-            lev = self.attr['levs'][i]
-            self.var['PZ'][i,:,:] = self.attr['ai'][lev-1] \
-                                  + self.attr['bi'][lev-1]*self.var['SP']
+        self._remake('PZ')
+
+    def _calc_p(self,buf):
+        levs = self.attr['levs']-1
+        np.multiply(self.attr['bm'][levs,np.newaxis,np.newaxis],self.var['SP'][np.newaxis,...],out=buf)
+        buf += self.attr['am'][levs,np.newaxis,np.newaxis]
+
+    def _calc_pz(self,buf):
+        levs = self.attr['levs']-1
+        np.multiply(self.attr['bi'][levs,np.newaxis,np.newaxis],self.var['SP'][np.newaxis,...],out=buf)
+        buf += self.attr['ai'][levs,np.newaxis,np.newaxis]
 
     def _mkpscale(self):
         # Define the standard pressure scale for this vertical grid
@@ -1575,25 +1976,38 @@ class ECMWF(ECMWF_pure):
 
     def _mkthet(self):
         # Calculate the potential temperature
-        if not set(['T','P']).issubset(self.var.keys()):
-            print('T or P undefined')
-            return
-        self.var['PT'] = self.var['T'] * (cst.p0/self.var['P'])**cst.kappa
+        self._remake('PT')
 
     def _mkrho(self):
         # Calculate the dry density
-        if not set(['T','P']).issubset(self.var.keys()):
-            print('T or P undefined')
-            return
-        self.var['RHO'] = (1/cst.R) * self.var['P'] / self.var['T']
+        self._remake('RHO')
 
     def _mkrhoq(self):
-        # Calculate the moist density
-        if not set(['T','P','Q']).issubset(self.var.keys()):
-            print('T, P or Q undefined')
-            return
-        pcor = 230.617*self.var['Q']*np.exp(17.5043*self.var['Q']/(241.2+self.var['Q']))
-        self.var['RHO'] = (1/cst.R) * (self.var['P'] - pcor) / self.var['T']
+        # Calculate the moist density (stored as RHO)
+        self._remake('RHOQ','RHO')
+
+    def _calc_pt(self,buf):
+        np.divide(cst.p0,self.var['P'],out=buf)
+        np.power(buf,cst.kappa,out=buf)
+        buf *= self.var['T']
+
+    def _calc_rho(self,buf):
+        np.multiply(1/cst.R,self.var['P'],out=buf)
+        buf /= self.var['T']
+
+    def _calc_rhoq(self,buf):
+        Q = self.var['Q']
+        # vapour pressure correction
+        tmp = 17.5043*Q
+        np.add(241.2,Q,out=buf)
+        np.divide(tmp,buf,out=buf)
+        np.exp(buf,out=buf)
+        np.multiply(230.617,Q,out=tmp)
+        buf *= tmp
+        del tmp
+        np.subtract(self.var['P'],buf,out=buf)
+        np.multiply(1/cst.R,buf,out=buf)
+        buf /= self.var['T']
 
     def _checkThetProfile(self):
         # Check that the potential temperature is always increasing with height
@@ -1608,76 +2022,89 @@ class ECMWF(ECMWF_pure):
 
     def _mkz(self):
         """ Calculate the geopotential altitude (m) without taking moisture into account """
-        if not set(['T','P']).issubset(self.var.keys()):
-            print('T or P undefined')
-            return
-        try:
-            with gzip.open(os.path.join(self.rootdir,'EN-true','Z0_'+self.project+'.pkl')) as f:
-                Z0 = pickle.load(f)
-        except:
-            print('Cannot read ground geopotential altitude')
+        self._remake('Z')
+
+    def _calc_z(self,buf):
+        path = os.path.join(self.rootdir,'EN-true','Z0_'+self.project+'.pkl')
         try:
-            self.var['Z0'] = Z0.var['Z0']
-        except:
-            self.var['Z0'] = Z0
-        self.var['Z'] =  np.empty(shape=self.var['T'].shape)
-        uu = - np.log(self.var['P'])
-        uusp = -np.log(self.var['SP'])
-        self.var['Z'][self.nlev-1,:,:] = self.var['Z0'] \
-               + (cst.R/cst.g) * self.var['T'][self.nlev-1,:,:] \
-               * (uu[self.nlev-1,:,:]-uusp)
-        for i in range(self.nlev-2,-1,-1):
-             self.var['Z'][i,:,:] = self.var['Z'][i+1,:,:] + 0.5*(cst.R/cst.g) \
-                    * (self.var['T'][i,:,:] + self.var['T'][i+1,:,:])\
-                    * (uu[i,:,:]-uu[i+1,:,:])
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if (path not in _Z0) or (_Z0[path][0] != mtime):
+            try:
+                with gzip.open(path) as f:
+                    Z0 = pickle.load(f)
+            except:
+                print('Cannot read ground geopotential altitude')
+                return False
+            try:
+                _Z0[path] = (mtime,Z0.var['Z0'])
+            except:
+                _Z0[path] = (mtime,Z0)
+        self.var['Z0'] = _Z0[path][1].copy()
+        T = self.var['T']
+        nlev = T.shape[0]
+        # log(p) differences between levels, the integration is made from the ground
+        np.log(self.var['P'],out=buf)
+        zbot = self.var['Z0'] + (cst.R/cst.g) * T[nlev-1,...] \
+             * (np.log(self.var['SP'])-buf[nlev-1,...])
+        np.subtract(buf[1:,...],buf[:-1,...],out=buf[:-1,...])
+        buf[nlev-1,...] = zbot
+        tmp = T[:-1,...] + T[1:,...]
+        tmp *= 0.5*(cst.R/cst.g)
+        buf[:-1,...] *= tmp
+        del tmp
+        np.cumsum(buf[::-1,...],axis=0,out=buf[::-1,...])
 
     def _mkpv(self):
         """ Calculate the potential vorticity using the isentropic formula """
-        if not set(['PT','P','U','V','VO']).issubset(self.var.keys()):
-            print('at least one of P, PT, U, V or VO is undefined')
-            return
+        self._remake('PV')
+
+    def _calc_pv(self,buf):
+        PT = self.var['PT']
+        P = self.var['P']
+        dtype = buf.dtype
+        # vertical derivatives in p, the values at the ground and the top level
+        # are not of any interest and are copied from the neighbour levels
+        logP = np.log(P)
+        dp = P[1:-1,...]*(logP[2:,...]-logP[:-2,...])
+        del logP
+        def ddp(F):
+            dFdP = np.empty(shape=F.shape,dtype=dtype)
+            dFdP[1:-1,...] = (F[2:,...]-F[:-2,...])/dp
+            dFdP[0,...] = dFdP[1,...]
+            dFdP[-1,...] = dFdP[-2,...]
+            return dFdP
+        flat = 2*cst.Omega * np.sin(np.deg2rad(self.attr['lats']))
+        np.multiply(ddp(PT),self.var['VO'] + flat[np.newaxis,:,np.newaxis],out=buf)
         # Calculation of the correction to the vorticity assuming that the grid is global
         dlat = np.deg2rad(self.attr['dla'])*cst.REarth
-        dPTdPhi = np.empty(shape = self.var['PT'].shape)
-        dPTdPhi[:,1:-1,:] = 0.5*(self.var['PT'][:,2:,:]-self.var['PT'][:,:-2,:])/dlat
-        dPTdPhi[:,0,:] = (self.var['PT'][:,1,:]-self.var['PT'][:,0,:])/dlat
-        dPTdPhi[:,-1,:] = (self.var['PT'][:,-1,:]-self.var['PT'][:,-2,:])/dlat
+        dPTdPhi = np.empty(shape=PT.shape,dtype=dtype)
+        dPTdPhi[:,1:-1,:] = 0.5*(PT[:,2:,:]-PT[:,:-2,:])/dlat
+        dPTdPhi[:,0,:] = (PT[:,1,:]-PT[:,0,:])/dlat
+        dPTdPhi[:,-1,:] = (PT[:,-1,:]-PT[:,-2,:])/dlat
+        dPTdPhi *= ddp(self.var['U'])
+        buf += dPTdPhi
+        del dPTdPhi
         dlon = np.deg2rad(self.attr['dlo'])*cst.REarth
         coslat = np.cos(np.deg2rad(self.attr['lats']))
-        dPTdLam = np.empty(shape = self.var['PT'].shape)
+        dPTdLam = np.empty(shape=PT.shape,dtype=dtype)
         if self.globalGrid:
-            dPTdLam[:,1:-1,1:-1] = 0.5*(self.var['PT'][:,1:-1,2:]-self.var['PT'][:,1:-1,:-2])/dlon
-            dPTdLam[:,1:-1,0] = 0.5*(self.var['PT'][:,1:-1,1]-self.var['PT'][:,1:-1,-1])/dlon
-            dPTdLam[:,1:-1,-1] = 0.5*(self.var['PT'][:,1:-1,0]-self.var['PT'][:,1:-1,-2])/dlon
+            dPTdLam[:,1:-1,1:-1] = 0.5*(PT[:,1:-1,2:]-PT[:,1:-1,:-2])/dlon
+            dPTdLam[:,1:-1,0] = 0.5*(PT[:,1:-1,1]-PT[:,1:-1,-1])/dlon
+            dPTdLam[:,1:-1,-1] = 0.5*(PT[:,1:-1,0]-PT[:,1:-1,-2])/dlon
             dPTdLam[:,1:-1,:] /= coslat[np.newaxis,1:-1,np.newaxis]
             dPTdLam[:,0,:] = dPTdLam[:,1,:]
             dPTdLam[:,-1,:] = dPTdLam[:,-2,:]
         else: # it is assumed that the non global grid does not contain poles
-            dPTdLam[...,1:-1] = 0.5*(self.var['PT'][...,2:]-self.var['PT'][...,:-2])/dlon
-            dPTdLam[...,0] = (self.var['PT'][...,1]-self.var['PT'][...,0])/dlon
-            dPTdLam[...,-1] = (self.var['PT'][...,-1]-self.var['PT'][...,-2])/dlon
+            dPTdLam[...,1:-1] = 0.5*(PT[...,2:]-PT[...,:-2])/dlon
+            dPTdLam[...,0] = (PT[...,1]-PT[...,0])/dlon
+            dPTdLam[...,-1] = (PT[...,-1]-PT[...,-2])/dlon
             dPTdLam /= coslat[np.newaxis,:,np.newaxis]
-        logP = np.log(self.var['P'])
-        dudP = np.empty(shape = self.var['U'].shape)
-        dvdP = np.empty(shape = self.var['V'].shape)
-        dPTdP = np.empty(shape = self.var['PT'].shape)
-        dudP[1:-1,...] = (self.var['U'][2:,...]-self.var['U'][:-2,...])/\
-                             (self.var['P'][1:-1,...]*(logP[2:,...]-logP[:-2,...]))
-        dvdP[1:-1,...] = (self.var['V'][2:,...]-self.var['V'][:-2,...])/\
-                            (self.var['P'][1:-1,...]*(logP[2:,...]-logP[:-2,...]))
-        dPTdP[1:-1,...] = (self.var['PT'][2:,...]-self.var['PT'][:-2,...])/\
-                             (self.var['P'][1:-1,...]*(logP[2:,...]-logP[:-2,...]))
-        # Do not loose time as PV at the ground or the top levl is not of any interest
-        dudP[0,...] = dudP[1,...]
-        dvdP[0,...] = dvdP[1,...]
-        dPTdP[0,...] = dPTdP[1,...]
-        dudP[-1,...] = dudP[-2,...]
-        dvdP[-1,...] = dvdP[-2,...]
-        dPTdP[-1,...] = dPTdP[-2,...]
-        flat = 2*cst.Omega * np.sin(np.deg2rad(self.attr['lats']))
-        self.var['PV'] = - cst.g * (dPTdP * (self.var['VO'] + flat[np.newaxis,:,np.newaxis]) \
-                                       + dudP * dPTdPhi - dvdP * dPTdLam)
-        del dPTdPhi, dPTdLam, logP, dudP, dvdP, dPTdP
+        dPTdLam *= ddp(self.var['V'])
+        buf -= dPTdLam
+        del dPTdLam
+        buf *= - cst.g
 
 if __name__ == '__main__':
     date = datetime(2017,8,11,18)
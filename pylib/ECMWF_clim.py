@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Climatologies of ECMWF fields reduced in parallel
+
+climato(project, variables, date_start, date_end, levtype, levels) reads the
+snapshots of the period every dt, interpolates the variables to the levels of
+levtype ('P' pressure in Pa, 'PT' potential temperature in K, 'Z' altitude in m,
+or None for the model levels) and accumulates at each grid point the number of
+valid values, the mean, the variance, the min and the max, and optionally
+histograms with given bin edges. The NaN values are skipped.
+
+The period is split in chunks of consecutive dates which are reduced by a pool
+of nproc processes. Each process holds one snapshot and the accumulators of
+its chunk, updated in place by a compiled kernel (Welford's algorithm), and
+the partial results are merged as they come with the pairwise formula of Chan
+et al. for the variance. The memory does not depend on the length of the
+period and the reduction scales with the number of processes as long as
+reading the files is not the bottleneck.
+
+The result is an ECMWF_pure object where var[var] is the mean (so that it can
+be plotted with show or chart) and stat[var] a dictionary of the other
+statistics: n, var (variance, normalised by n), min, max and, if requested,
+hist [nbins,nlev,nlat,nlon] and bins. attr['missing'] lists the dates which
+could not be read.
+
+Usage:
+    clim = climato('FULL-EA', ['PV'], datetime(2017,6,1), datetime(2017,8,31,23), 'PT', [380.], nproc=8)
+    clim.var['PV'], clim.stat['PV']['var'], clim.stat['PV']['max']
+    clim = climato(..., hist={'PV':np.arange(0,20.1,0.5)*1.e-6})
+or
+    python ECMWF_clim.py FULL-EA -d0 20170601 -d1 20170831 -v PV -lt PT -l 380 -n 8 -o PV380-JJA.pkl
+which saves the result (pickle with gzip).
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+from datetime import timedelta
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from numba import jit, prange
+import ECMWF_N
+from ECMWF_N import ECMWF, ECMWF_pure
+
+# interpolation method for each type of level
+LEVTYPES = {'P':'interpolP', 'PT':'interpolPT', 'Z':'interpolZ'}
+# number of chunks per process, for the balance of the load
+CHUNKS_PER_PROC = 4
+
+@jit(nopython=True,cache=True,parallel=True)
+def _accumulate(n,mean,m2,vmin,vmax,hist,bins,field):
+    """ Adds the field to the accumulators (flattened), skipping NaN.
+    hist [nbins,size] counts the values in the bins defined by the edges bins,
+    the last one being closed as in np.histogram (no histogram if len(bins) < 2). """
+    nb = len(bins)-1
+    for i in prange(len(field)):
+        x = field[i]
+        if np.isnan(x):
+            continue
+        n[i] += 1
+        delta = x - mean[i]
+        mean[i] += delta/n[i]
+        m2[i] += delta*(x - mean[i])
+        if x < vmin[i]:
+            vmin[i] = x
+        if x > vmax[i]:
+            vmax[i] = x
+        if (nb > 0) and (x >= bins[0]) and (x <= bins[nb]):
+            k = min(np.searchsorted(bins,x,side='right')-1,nb-1)
+            hist[k,i] += 1
+
+def newacc(size,bins=None):
+    """ Empty accumulators for size points """
+    bins = np.zeros(0) if bins is None else np.asarray(bins,dtype=np.float64)
+    return {'n':np.zeros(size,dtype=np.int64), 'mean':np.zeros(size), 'm2':np.zeros(size),
+            'min':np.full(size,np.inf), 'max':np.full(size,-np.inf), 'bins':bins,
+            'hist':np.zeros((max(len(bins)-1,0),size),dtype=np.int64)}
+
+def accumulate(acc,field):
+    """ Adds field to the accumulators acc """
+    _accumulate(acc['n'],acc['mean'],acc['m2'],acc['min'],acc['max'],acc['hist'],acc['bins'],
+                np.ascontiguousarray(field,dtype=np.float64).ravel())
+
+def merge(a,b):
+    """ Merges the accumulators b into a (Chan et al.) and returns a """
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    wb = np.zeros(len(n))
+    np.divide(b['n'],n,out=wb,where=n>0)
+    a['mean'] += delta*wb
+    a['m2'] += b['m2'] + delta**2*a['n']*wb
+    a['n'] = n
+    np.minimum(a['min'],b['min'],out=a['min'])
+    np.maximum(a['max'],b['max'],out=a['max'])
+    a['hist'] += b['hist']
+    return a
+
+def stats(acc,shape):
+    """ Statistics of the accumulators, as arrays of the given shape
+    (NaN where there is no value) """
+    n = acc['n']
+    empty = n == 0
+    mean = np.where(empty,np.nan,acc['mean'])
+    var = np.full(len(n),np.nan)
+    np.divide(acc['m2'],n,out=var,where=~empty)
+    stat = {'n':n.reshape(shape), 'mean':mean.reshape(shape), 'var':var.reshape(shape),
+            'min':np.where(empty,np.nan,acc['min']).reshape(shape),
+            'max':np.where(empty,np.nan,acc['max']).reshape(shape)}
+    if len(acc['bins']) > 1:
+        stat['hist'] = acc['hist'].reshape((len(acc['bins'])-1,)+shape)
+        stat['bins'] = acc['bins']
+    return stat
+
+######################
+def readlevels(date,project='FULL-EA',variables=['T'],levtype=None,levels=None,
+               latRange=None,lonRange=None,exp=[None]):
+    """ ECMWF_pure object with the variables (read or derived) at date on the
+    levels of levtype (see LEVTYPES) or on the model levels, or None """
+    dat = ECMWF(project,date,exp=exp)
+    for var in variables + ([levtype] if levtype in ['PT','Z'] else ['P'] if levtype == 'P' else []):
+        if dat.derive(var) is None:
+            dat.close()
+            return None
+    dat.close()
+    if levtype is None:
+        return dat.extract(latRange=latRange,lonRange=lonRange,varss=variables)
+    if levtype not in LEVTYPES:
+        print('unknown level type '+str(levtype))
+        return None
+    return getattr(dat,LEVTYPES[levtype])(list(levels),variables,latRange,lonRange)
+
+def _initworker():
+    # a worker reads each date once and runs on one core
+    from numba import set_num_threads
+    set_num_threads(1)
+    ECMWF_N.cache.set_limit(0)
+
+def _reduce(args):
+    """ Reduction of a chunk of dates, returns the accumulators, the grid,
+    the missing dates and the number of dates """
+    dates, variables, hist, reader = args
+    accs = None
+    attr = None
+    missing = []
+    for date in dates:
+        dat = reader(date)
+        if dat is None:
+            missing.append(date)
+            continue
+        if accs is None:
+            size = dat.var[variables[0]].size
+            accs = dict([(var, newacc(size,hist.get(var))) for var in variables])
+            attr = {'lats':dat.attr['lats'], 'lons':dat.attr['lons'],
+                    'levs':dat.attr.get('levs'), 'levtype':dat.attr.get('levtype'),
+                    'shape':dat.var[variables[0]].shape}
+        for var in variables:
+            accumulate(accs[var],dat.var[var])
+    return accs, attr, missing, len(dates)
+
+def climato(project,variables,date_start,date_end,levtype=None,levels=None,dt=timedelta(hours=1),
+            latRange=None,lonRange=None,hist=None,exp=[None],nproc=1,reader=None,quiet=False):
+    """ Climatology of the variables over the dates date_start to date_end
+    (included) every dt. hist is an optional dictionary of bin edges by
+    variable. reader is a function date -> ECMWF_pure with the variables on the
+    levels, by default readlevels for the other arguments; it must be
+    picklable if nproc > 1. Returns an ECMWF_pure object (see above). """
+    variables = list(variables)
+    hist = {} if hist is None else hist
+    if reader is None:
+        reader = partial(readlevels,project=project,variables=variables,levtype=levtype,
+                         levels=levels,latRange=latRange,lonRange=lonRange,exp=exp)
+    dates = []
+    date = date_start
+    while date <= date_end:
+        dates.append(date)
+        date += dt
+    if len(dates) == 0:
+        print('empty period')
+        return None
+    nchunk = min(len(dates),CHUNKS_PER_PROC*nproc)
+    chunks = [list(c) for c in np.array_split(np.array(dates,dtype=object),nchunk)]
+    args = [(chunk,variables,hist,reader) for chunk in chunks]
+    accs = None
+    attr = None
+    missing = []
+    ndone = 0
+    pool = Pool(nproc,initializer=_initworker) if nproc > 1 else None
+    try:
+        results = map(_reduce,args) if pool is None else pool.imap_unordered(_reduce,args)
+        for acc, att, miss, nd in results:
+            missing += miss
+            ndone += nd
+            if not quiet: print('climato {:d} / {:d} dates'.format(ndone,len(dates)))
+            if acc is None:
+                continue
+            if accs is None:
+                accs, attr = acc, att
+            else:
+                for var in variables:
+                    merge(accs[var],acc[var])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if accs is None:
+        print('no data read')
+        return None
+    clim = ECMWF_pure()
+    clim.project = project
+    clim.date = date_start
+    clim.attr.update({'lats':attr['lats'], 'lons':attr['lons'], 'levs':attr['levs'],
+                      'levtype':attr['levtype'], 'date_start':date_start, 'date_end':date_end,
+                      'dt':dt, 'missing':sorted(missing)})
+    clim.nlat = len(attr['lats'])
+    clim.nlon = len(attr['lons'])
+    if len(attr['shape']) == 3:
+        clim.nlev = attr['shape'][0]
+    clim.stat = {}
+    for var in variables:
+        clim.stat[var] = stats(accs[var],attr['shape'])
+        clim.var[var] = clim.stat[var].pop('mean')
+    return clim
+
+if __name__ == '__main__':
+    import argparse
+    import gzip, pickle
+    from datetime import datetime
+    parser = argparse.ArgumentParser(description='parallel climatology of ECMWF fields')
+    parser.add_argument('project', help='project as in ECMWF_N')
+    parser.add_argument('-d0', '--date_start', required=True, help='first date (yyyymmdd or yyyymmddhh)')
+    parser.add_argument('-d1', '--date_end', required=True, help='last date (yyyymmdd or yyyymmddhh)')
+    parser.add_argument('-dt', '--dt', type=int, default=1, help='interval between dates (hours)')
+    parser.add_argument('-v', '--variables', nargs='+', default=['T'], help='variables, read or derived')
+    parser.add_argument('-lt', '--levtype', choices=list(LEVTYPES), help='type of levels (default: model levels)')
+    parser.add_argument('-l', '--levels', type=float, nargs='+', help='levels')
+    parser.add_argument('-lat', '--latRange', type=float, nargs=2, help='latitude range')
+    parser.add_argument('-lon', '--lonRange', type=float, nargs=2, help='longitude range')
+    parser.add_argument('-e', '--exp', nargs='+', default=[None], help='additional streams as in ECMWF_N')
+    parser.add_argument('-n', '--nproc', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('-o', '--output', required=True, help='output file')
+    args = parser.parse_args()
+    todate = lambda s: datetime.strptime(s, '%Y%m%d%H' if len(s) == 10 else '%Y%m%d')
+    clim = climato(args.project, args.variables, todate(args.date_start), todate(args.date_end),
+                   args.levtype, args.levels, timedelta(hours=args.dt), args.latRange, args.lonRange,
+                   exp=args.exp, nproc=args.nproc)
+    if clim is not None:
+        with gzip.open(args.output, 'wb') as f:
+            pickle.dump(clim, f, protocol=pickle.HIGHEST_PROTOCOL)
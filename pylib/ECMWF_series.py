@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Iteration over the hourly (or dt) ECMWF snapshots of a period with
+interpolation in time between the two snapshots which bracket the current date
+
+The series keeps two snapshots, dat0 at date0 and dat1 at date1 = date0 + dt.
+When it advances, dat1 becomes dat0 and only the new dat1 is read. This read
+is started in a background thread as soon as the previous one is done, so that
+it overlaps with the calculations made on the current bracket.
+The period can go backward in time (date_end < date_start), as in the
+backward runs; dt is then taken negative. A period of a single date gives a
+bracket where dat0 and dat1 are the same snapshot.
+
+interp(date) returns the fields linearly interpolated at any date of the
+current bracket (advancing the series if date is beyond it). The results are
+written in buffers allocated once and reused at each call, or in the arrays
+given by out, so that no new 3D array is allocated for each sub-step.
+
+Usage:
+    series = ECMWF_series('FULL-EA',datetime(2017,8,11,0),datetime(2017,8,1,0),['T','P','PT'])
+    for date in dates:           # sub-steps in the direction of the series
+        fields = series.interp(date)
+        ... fields['PT'] ...
+    series.close()
+or, bracket by bracket:
+    for bracket in series:
+        ... bracket.dat0, bracket.dat1, bracket.date0, bracket.date1 ...
+
+The snapshots are ECMWF objects read with read_snapshot, where the
+derived variables (see ECMWF_N.DERIVED) are calculated by ECMWF.derive, but
+any function date -> ECMWF_pure object can be given as reader, e.g.
+a Cube(cube_dir).snapshot (see era5cube).
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import numpy as np
+from ECMWF_N import ECMWF
+
+def read_snapshot(project,date,variables,step=0,exp=[None]):
+    """ ECMWF object at date with the variables read or derived """
+    dat = ECMWF(project,date,step,exp)
+    dat.derive(list(variables))
+    dat.close()
+    return dat
+
+class ECMWF_series(object):
+    """ Sliding bracket of two snapshots over the period date_start to date_end """
+    def __init__(self,project,date_start,date_end,variables,dt=timedelta(hours=1),
+                 step=0,exp=[None],reader=None,prefetch=True):
+        self.variables = list(variables)
+        if reader is None:
+            reader = lambda date: read_snapshot(project,date,self.variables,step,exp)
+        self.reader = reader
+        self.sign = 1 if date_end >= date_start else -1
+        self.dt = self.sign*abs(dt)
+        self.date_end = date_end
+        self.pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.next = None
+        self.buffers = {}
+        self.date1 = date_start
+        self.dat1 = self.reader(date_start)
+        self._prefetch(date_start+self.dt)
+        self.date0 = None
+        self.dat0 = None
+        if not self._advance():
+            # period of a single date
+            self.date0, self.dat0 = self.date1, self.dat1
+
+    def _prefetch(self,date):
+        """ Starts the read of the snapshot at date """
+        if self.sign*(date-self.date_end).total_seconds() > 0:
+            self.next = None
+        elif self.pool is None:
+            self.next = (date,None)
+        else:
+            self.next = (date,self.pool.submit(self.reader,date))
+
+    def _advance(self):
+        """ Moves the bracket by dt. Returns False at the end of the period. """
+        if self.next is None:
+            return False
+        date, future = self.next
+        dat = self.reader(date) if future is None else future.result()
+        self.date0, self.dat0 = self.date1, self.dat1
+        self.date1, self.dat1 = date, dat
+        self._prefetch(date+self.dt)
+        return True
+
+    def __iter__(self):
+        # the first bracket is the current one
+        yield self
+        while self._advance():
+            yield self
+
+    def interp(self,date,variables=None,out=None):
+        """ Fields at date (in the current bracket or later) interpolated
+        linearly in time. out is an optional dictionary of arrays receiving the
+        fields; by default the buffers of the series are used, which are
+        overwritten at the next call. Returns the dictionary of the fields,
+        or None if date is out of the period. """
+        if variables is None:
+            variables = self.variables
+        if self.sign*(date-self.date0).total_seconds() < 0:
+            print('error on date: ',date,' before ',self.date0)
+            return None
+        while self.sign*(date-self.date1).total_seconds() > 0:
+            if not self._advance():
+                print('error on date: ',date,' beyond ',self.date1)
+                return None
+        span = (self.date1-self.date0).total_seconds()
+        cf = 0. if span == 0 else (date-self.date0).total_seconds()/span
+        if out is None:
+            out = self.buffers
+        for var in variables:
+            a = self.dat0.var[var]
+            b = self.dat1.var[var]
+            if (var not in out) or (out[var].shape != a.shape):
+                out[var] = np.empty(shape=a.shape,dtype=np.result_type(a,b))
+            # a + cf*(b-a) without temporary array
+            np.subtract(b,a,out=out[var])
+            out[var] *= cf
+            out[var] += a
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self.next = None
+        self.dat0 = self.dat1 = None
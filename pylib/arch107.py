@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Columnar archive of a TRACZILLA run with random access by parcel
+
+The part_XXX files of a run directory are converted into one file per record
+(x, y, p, t, flag, ir_start, idx_back) plus a file 'active' telling which
+parcels are present at each output time. Each parcel has a fixed column given
+by idx_back - idx_orgn, and the values are stored by tiles of tblock output
+times and chunk parcels. A tile is stored raw or compressed with zlib after a
+byte shuffle. The float records can be rounded to keepbits bits of mantissa
+before compression (lossy, 23 keeps all the bits).
+The location of the tiles is stored in the meta.pkl file of the archive.
+
+The parcels absent at a time have NaN in the float records and 0 in the
+int records.
+
+Usage:
+    python arch107.py run_dir arch_dir [-l level] [-k keepbits] ...
+    arch = Arch107(arch_dir)
+    data = arch.timestep(hour)       # all the parcels at one output time
+    traj = arch.trajectory(idx_back) # all the output times for a few parcels
+
+The tiles are the unit of reading: a timestep reads one row of nchunk tiles
+and a trajectory one column of nblock tiles. The default tile is 8 times
+and 65536 parcels.
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import pickle
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from io107 import RECORDS, NTHREADS, catalog107, iterpart107
+
+ARCHMETA = 'meta.pkl'
+# number of decoded tiles kept in memory by a reader
+NCACHE = 32
+
+######################
+def build107(run_dir, arch_dir, hours=None, fields=None, chunk=1<<16, tblock=8,
+             compresslevel=1, keepbits=None, nthreads=NTHREADS, quiet=False):
+    """ Converts the part files of run_dir for the list of hours (default: all
+    the hours of the catalogue) into a columnar archive in arch_dir.
+    fields: records to be archived (default: all)
+    chunk, tblock: number of parcels and of output times of a tile
+    compresslevel: zlib level, 0 to store the tiles raw
+    keepbits: number of bits of mantissa kept in the float records (default: all)
+    The memory used is about tblock*numpart*4 bytes per field. """
+    cat = catalog107(run_dir, quiet=quiet)
+    if hours is None:
+        hours = sorted(cat)
+    hours = list(hours)
+    if fields is None:
+        fields = [var for var, dtype in RECORDS]
+    dtypes = dict([(var, np.dtype(dtype).newbyteorder('=')) for var, dtype in RECORDS])
+    for var in fields:
+        if var not in dtypes:
+            raise ValueError('UNKNOWN RECORD '+var)
+    dtypes['active'] = np.dtype(np.uint8)
+    numpart = max([cat[hour]['numpart'] for hour in hours])
+    idx_orgn = cat[hours[0]]['idx_orgn']
+    ntime = len(hours)
+    nchunk = (numpart-1)//chunk + 1
+    nblock = (ntime-1)//tblock + 1
+    allvars = list(fields) + ['active']
+    meta = {'run_dir':run_dir, 'hours':hours, 'stamp_date':cat[hours[0]]['stamp_date'],
+            'itime':[cat[hour]['itime'] for hour in hours],
+            'nact':[cat[hour]['nact'] for hour in hours],
+            'numpart':numpart, 'idx_orgn':idx_orgn, 'chunk':chunk, 'tblock':tblock,
+            'nchunk':nchunk, 'nblock':nblock, 'fields':list(fields),
+            'dtypes':dict([(var, dtypes[var].str) for var in allvars]),
+            'compresslevel':compresslevel, 'keepbits':keepbits,
+            'offsets':dict([(var, np.zeros((nblock,nchunk), dtype=np.int64)) for var in allvars]),
+            'sizes':dict([(var, np.zeros((nblock,nchunk), dtype=np.int64)) for var in allvars])}
+    if not os.path.isdir(arch_dir):
+        os.makedirs(arch_dir)
+    buf = dict([(var, np.empty((tblock,numpart), dtype=dtypes[var])) for var in allvars])
+    fouts = dict([(var, open(os.path.join(arch_dir, var+'.dat'), 'wb')) for var in allvars])
+    pool = ThreadPoolExecutor(max_workers=nthreads)
+    try:
+        t = 0
+        for hour, data in iterpart107(hours, run_dir, depth=1, fields=list(set(fields) | set(['idx_back']))):
+            if not quiet: print('build107 hour', hour)
+            tb = t % tblock
+            col = np.asarray(data['idx_back'], dtype=np.int64) - idx_orgn
+            if (len(col) > 0) and ((col.min() < 0) or (col.max() >= numpart)):
+                raise ValueError('IDX_BACK OUT OF RANGE IN HOUR '+str(hour))
+            buf['active'][tb].fill(0)
+            buf['active'][tb, col] = 1
+            for var in fields:
+                row = buf[var][tb]
+                row.fill(np.nan if row.dtype.kind == 'f' else 0)
+                row[col] = data[var]
+            del data
+            if (tb == tblock-1) or (t == ntime-1):
+                for var in allvars:
+                    _writeblock(fouts[var], buf[var][:tb+1], t//tblock, var, meta, pool)
+            t += 1
+    finally:
+        pool.shutdown(wait=True)
+        for fout in fouts.values():
+            fout.close()
+    with open(os.path.join(arch_dir, ARCHMETA), 'wb') as f:
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+    return meta
+
+######################
+def _writeblock(fout, rows, b, var, meta, pool):
+    """ Encodes the tiles of the block of times b (rows) on the threads of pool
+    and appends them to fout """
+    chunk = meta['chunk']
+    def encode(c):
+        return _encode(rows[:, c*chunk:(c+1)*chunk], meta['compresslevel'], meta['keepbits'])
+    for c, blob in enumerate(pool.map(encode, range(meta['nchunk']))):
+        meta['offsets'][var][b, c] = fout.tell()
+        meta['sizes'][var][b, c] = len(blob)
+        fout.write(blob)
+
+######################
+def _encode(tile, compresslevel, keepbits=None):
+    """ Bytes of a tile, with the float mantissa rounded to keepbits bits
+    and shuffled and compressed if compresslevel > 0 """
+    tile = np.ascontiguousarray(tile)
+    if (keepbits is not None) and (tile.dtype.kind == 'f'):
+        tile = bitround(tile, keepbits)
+    if compresslevel == 0:
+        return tile.tobytes()
+    raw = tile.view(np.uint8).reshape(-1, tile.dtype.itemsize).T.tobytes()
+    return zlib.compress(raw, compresslevel)
+
+######################
+def _decode(blob, shape, dtype, compresslevel):
+    """ Inverse of _encode (but for the rounding of the mantissa) """
+    dtype = np.dtype(dtype)
+    if compresslevel == 0:
+        return np.frombuffer(blob, dtype=dtype).reshape(shape)
+    raw = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+    raw = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    return raw.view(dtype).reshape(shape)
+
+######################
+def bitround(x, keepbits):
+    """ Rounds the float32 x to the nearest value with keepbits bits of mantissa
+    (ties to even). NaN and infinite values are unchanged. """
+    drop = 23 - keepbits
+    x = np.asarray(x, dtype=np.float32)
+    if drop <= 0:
+        return x
+    v = x.view(np.uint32)
+    half = np.uint32((1 << (drop-1)) - 1)
+    r = (v + half + ((v >> np.uint32(drop)) & np.uint32(1))) & np.uint32(~((1 << drop) - 1) & 0xFFFFFFFF)
+    return np.where(np.isfinite(x), r.view(np.float32), x)
+
+######################
+class Arch107(object):
+    """ Reader of an archive written by build107
+    arch = Arch107(arch_dir)
+    arch.hours: list of the archived hours, arch.itime: their times (s)
+    data = arch.timestep(hour, fields=['x','y'])
+    traj = arch.trajectory([idx1, idx2], fields=['p'])
+    The last NCACHE decoded tiles are kept in memory. """
+    def __init__(self, arch_dir):
+        self.arch_dir = arch_dir
+        with open(os.path.join(arch_dir, ARCHMETA), 'rb') as f:
+            self.meta = pickle.load(f)
+        self.hours = self.meta['hours']
+        self.itime = self.meta['itime']
+        self.fields = self.meta['fields']
+        self.numpart = self.meta['numpart']
+        self.idx_orgn = self.meta['idx_orgn']
+        self.fds = {}
+        self.cache = OrderedDict()
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+        self.cache.clear()
+
+    def _tile(self, var, b, c):
+        """ Decoded tile of the block of times b and chunk of parcels c """
+        key = (var, b, c)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if var not in self.fds:
+            self.fds[var] = os.open(os.path.join(self.arch_dir, var+'.dat'), os.O_RDONLY)
+        meta = self.meta
+        blob = os.pread(self.fds[var], int(meta['sizes'][var][b, c]), int(meta['offsets'][var][b, c]))
+        shape = (min(meta['tblock'], len(self.hours) - b*meta['tblock']),
+                 min(meta['chunk'], self.numpart - c*meta['chunk']))
+        tile = _decode(blob, shape, meta['dtypes'][var], meta['compresslevel'])
+        self.cache[key] = tile
+        if len(self.cache) > NCACHE:
+            self.cache.popitem(last=False)
+        return tile
+
+    def _fields(self, fields):
+        if fields is None:
+            fields = self.fields
+        for var in fields:
+            if var not in self.fields:
+                raise ValueError('FIELD NOT ARCHIVED '+var)
+        return list(fields) + ['active']
+
+    def timestep(self, hour, fields=None):
+        """ Values of the fields for all the parcels at hour, indexed by
+        idx_back - idx_orgn, with the boolean 'active' """
+        t = self.hours.index(hour)
+        b, r = divmod(t, self.meta['tblock'])
+        chunk = self.meta['chunk']
+        data = {'hour':hour, 'itime':self.itime[t], 'idx_orgn':self.idx_orgn}
+        for var in self._fields(fields):
+            out = np.empty(self.numpart, dtype=self.meta['dtypes'][var])
+            for c in range(self.meta['nchunk']):
+                out[c*chunk:(c+1)*chunk] = self._tile(var, b, c)[r]
+            data[var] = out
+        data['active'] = data['active'].astype(bool)
+        return data
+
+    def trajectory(self, idx_back, fields=None):
+        """ Values of the fields for the parcels idx_back at all the archived
+        hours, as arrays [ntime, len(idx_back)], with the boolean 'active' """
+        col = np.atleast_1d(np.asarray(idx_back, dtype=np.int64)) - self.idx_orgn
+        if (len(col) > 0) and ((col.min() < 0) or (col.max() >= self.numpart)):
+            raise ValueError('IDX_BACK OUT OF RANGE')
+        chunk = self.meta['chunk']
+        tblock = self.meta['tblock']
+        data = {'hours':self.hours, 'itime':self.itime, 'idx_back':col + self.idx_orgn}
+        cs = col // chunk
+        for var in self._fields(fields):
+            out = np.empty((len(self.hours), len(col)), dtype=self.meta['dtypes'][var])
+            for c in np.unique(cs):
+                sel = np.flatnonzero(cs == c)
+                for b in range(self.meta['nblock']):
+                    out[b*tblock:(b+1)*tblock, sel] = self._tile(var, b, c)[:, col[sel] - c*chunk]
+            data[var] = out
+        data['active'] = data['active'].astype(bool)
+        return data
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='convert a TRACZILLA run into a columnar archive')
+    parser.add_argument('run_dir', help='run directory')
+    parser.add_argument('arch_dir', help='archive directory')
+    parser.add_argument('-f', '--fields', nargs='+', help='records to be archived (default: all)')
+    parser.add_argument('-c', '--chunk', type=int, default=1<<16, help='parcels per tile')
+    parser.add_argument('-tb', '--tblock', type=int, default=8, help='output times per tile')
+    parser.add_argument('-l', '--level', type=int, default=1, help='zlib level (0: raw)')
+    parser.add_argument('-k', '--keepbits', type=int, help='bits of mantissa kept in float records')
+    parser.add_argument('-n', '--nthreads', type=int, default=NTHREADS, help='number of threads')
+    args = parser.parse_args()
+    build107(args.run_dir, args.arch_dir, fields=args.fields, chunk=args.chunk,
+             tblock=args.tblock, compresslevel=args.level, keepbits=args.keepbits,
+             nthreads=args.nthreads)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Sampling of ERA5 fields along the parcels of a TRACZILLA run
+
+augment107(run_dir, aug_dir, variables) interpolates the variables (read or
+derived, see ECMWF_N.DERIVED) to the positions of all the parcels of the part
+files of run_dir. For each part file part_XXX and each variable VAR, it writes
+the file aug_dir/part_XXX.VAR.npy (float32) whose values are in the order of
+the parcels in the part file. The parcels outside the grid or the levels of
+the data are set to MISSING (as in ECMWF_N).
+
+The date of a part file is the start date of the run plus itime (negative in
+backward runs). A part file between two ERA5 hours is interpolated linearly in
+time between them. The work is split by ERA5 hour: each task reads one hour,
+samples the part files lying within one hour of it and writes these samples,
+multiplied by their time weight, in aug_dir/partial. A part file is completed
+as soon as the tasks of its two hours are done. Thus each ERA5 hour is decoded
+once, and each of the nproc processes of the pool holds one snapshot and one
+part file at a time. The part files already augmented are skipped, so that an
+interrupted or extended run can be completed.
+
+Usage:
+    python augment107.py run_dir aug_dir -v T UDR PV -n 8 [-s 2017080100]
+    data = readaug107(hour, aug_dir, ['T','PV'])
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from io107 import catalog107, readpart107
+import ECMWF_N
+from ECMWF_N import ECMWF, MISSING
+
+PARTIAL = 'partial'
+
+def _fname(aug_dir, hour, var):
+    return os.path.join(aug_dir, 'part_{:03d}.{}.npy'.format(hour, var))
+
+def _partial(aug_dir, hour, var, date):
+    return os.path.join(aug_dir, PARTIAL, 'part_{:03d}.{}.{}.npy'.format(hour, var, date.strftime('%Y%m%d%H')))
+
+def readera5(date, project='FULL-EA', variables=['T'], exp=[None]):
+    """ ECMWF object at date with the variables read or derived, or None """
+    dat = ECMWF(project, date, exp=exp)
+    for var in variables:
+        if dat.derive(var) is None:
+            dat.close()
+            return None
+    dat.close()
+    return dat
+
+def _initworker():
+    # each ERA5 hour is read once, the cache of the fields is not needed
+    ECMWF_N.cache.set_limit(0)
+
+######################
+def plan107(cat, hours, start):
+    """ Tasks of augment107 for the part files of the list of hours, as a
+    dictionary: ERA5 hour -> list of (part file hour, time weight) """
+    tasks = {}
+    for hour in hours:
+        date = start + timedelta(seconds=int(cat[hour]['itime']))
+        h0 = datetime(date.year, date.month, date.day, date.hour)
+        w = (date-h0).total_seconds()/3600
+        tasks.setdefault(h0, []).append((hour, 1-w))
+        if w > 0:
+            tasks.setdefault(h0+timedelta(hours=1), []).append((hour, w))
+    return tasks
+
+def augment107(run_dir, aug_dir, variables=['T'], project='FULL-EA', start=None, hours=None,
+               exp=[None], nproc=1, reader=None, quiet=False):
+    """ Writes the variables sampled at the parcels of the part files of run_dir
+    for the list of hours (default: all the hours of the catalogue) in aug_dir.
+    start: start date of the run (datetime), by default the stamp_date of the files
+    reader: function date -> ECMWF_pure object with the variables, by default
+    readera5 for project and exp; it must be picklable if nproc > 1. """
+    variables = list(variables)
+    cat = catalog107(run_dir, quiet=quiet)
+    if hours is None:
+        hours = sorted(cat)
+    if start is None:
+        stamp = cat[hours[0]]['stamp_date']
+        if stamp <= 0:
+            print('stamp_date not set, the start date of the run must be given')
+            return
+        start = datetime.strptime(str(stamp), '%Y%m%d%H%M%S')
+    hours = [hour for hour in hours
+             if not all([os.path.isfile(_fname(aug_dir, hour, var)) for var in variables])]
+    if not os.path.isdir(os.path.join(aug_dir, PARTIAL)):
+        os.makedirs(os.path.join(aug_dir, PARTIAL))
+    if reader is None:
+        reader = partial(readera5, project=project, variables=variables, exp=exp)
+    tasks = plan107(cat, hours, start)
+    # ERA5 hours contributing to each part file
+    contrib = {}
+    for date in tasks:
+        for hour, w in tasks[date]:
+            contrib.setdefault(hour, []).append(date)
+    left = dict([(hour, len(contrib[hour])) for hour in contrib])
+    failed = set()
+    args = [(run_dir, aug_dir, variables, date, tasks[date], reader) for date in sorted(tasks)]
+    limit = ECMWF_N.cache.limit
+    if nproc > 1:
+        pool = Pool(nproc, initializer=_initworker)
+    else:
+        pool = None
+        _initworker()
+    try:
+        results = map(_task, args) if pool is None else pool.imap_unordered(_task, args)
+        for date, ok in results:
+            if not quiet: print('augment107 '+date.strftime('%Y-%m-%d %H'))
+            for hour, w in tasks[date]:
+                if not ok:
+                    failed.add(hour)
+                left[hour] -= 1
+                if left[hour] == 0:
+                    _finish(aug_dir, hour, variables, contrib[hour], hour not in failed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        ECMWF_N.cache.set_limit(limit)
+    if len(failed) > 0:
+        print('augment107: part files not augmented ', sorted(failed))
+    return sorted(set(hours) - failed)
+
+def _task(args):
+    """ Samples one ERA5 hour at the part files of the task """
+    run_dir, aug_dir, variables, date, parts, reader = args
+    dat = reader(date)
+    if dat is None:
+        print('cannot read '+date.strftime('%Y-%m-%d %H'))
+        return date, False
+    for hour, w in parts:
+        data = readpart107(hour, run_dir, quiet=True, fields=['x', 'y', 'p'])
+        if data['nact'] == 0:
+            values = dict([(var, np.zeros(0)) for var in variables])
+        else:
+            # the longitudes wrap around in sample on a global grid
+            values = dat.sample(data['x'], data['y'], data['p'], varList=variables)
+            if values is None:
+                return date, False
+        for var in variables:
+            # NaN for the missing values, which propagates to the sum
+            v = np.where(values[var] == MISSING, np.nan, w*values[var])
+            with open(_partial(aug_dir, hour, var, date), 'wb') as f:
+                np.save(f, v)
+    return date, True
+
+def _finish(aug_dir, hour, variables, dates, ok):
+    """ Sums the partial samples of the part file hour and removes them """
+    for var in variables:
+        names = [_partial(aug_dir, hour, var, date) for date in dates]
+        if ok:
+            values = sum([np.load(name) for name in names])
+            values[np.isnan(values)] = MISSING
+            with open(_fname(aug_dir, hour, var)+'.tmp', 'wb') as f:
+                np.save(f, values.astype(np.float32))
+            os.replace(_fname(aug_dir, hour, var)+'.tmp', _fname(aug_dir, hour, var))
+        for name in names:
+            if os.path.isfile(name):
+                os.remove(name)
+
+######################
+def readaug107(hour, aug_dir, variables, mmap=False):
+    """ Dictionary of the variables sampled at the parcels of part_XXX for hour,
+    memory-mapped if mmap is True """
+    data = {}
+    for var in variables:
+        try:
+            data[var] = np.load(_fname(aug_dir, hour, var), mmap_mode='r' if mmap else None)
+        except (IOError, OSError):
+            print(var+' not augmented for hour '+str(hour))
+            data[var] = None
+    return data
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='sample ERA5 fields along the parcels of a TRACZILLA run')
+    parser.add_argument('run_dir', help='run directory')
+    parser.add_argument('aug_dir', help='output directory')
+    parser.add_argument('-v', '--variables', nargs='+', default=['T'], help='variables, read or derived')
+    parser.add_argument('-p', '--project', default='FULL-EA', help='project as in ECMWF_N')
+    parser.add_argument('-s', '--start', help='start date of the run (yyyymmddhh), default: stamp_date')
+    parser.add_argument('-e', '--exp', nargs='+', default=[None], help='additional streams as in ECMWF_N')
+    parser.add_argument('-n', '--nproc', type=int, default=os.cpu_count() or 1, help='number of processes')
+    args = parser.parse_args()
+    start = None if args.start is None else datetime.strptime(args.start, '%Y%m%d%H')
+    augment107(args.run_dir, args.aug_dir, args.variables, args.project, start,
+               exp=args.exp, nproc=args.nproc)
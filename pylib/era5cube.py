@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Consolidated archive of ERA5 fields over a domain, indexed by time
+
+build(cube_dir, project, day0, day1, variables, latRange, lonRange) reads the
+hourly grib files through ECMWF_N once and stores, for each variable and each
+day, the fields restricted to the domain as a float32 .npy file of shape
+[24, nlev, nlat, nlon] ([24, nlat, nlon] for the surface pressure SP), with
+latitudes from South to North as in ECMWF_N. The grid, the levels and the
+hybrid coefficients are stored in the meta.pkl file of the cube. The hours
+which cannot be read are filled with NaN and listed in meta['missing'].
+The building can be interrupted and started again: the days already
+converted are skipped.
+
+Cube(cube_dir).snapshot(date, variables) returns an ECMWF_pure object for one
+hour whose fields are memory-mapped slices of the .npy files, so that only the
+pages used are read from the disk. These fields are read-only unless
+copy=True. P can be requested: it is then calculated from SP as in
+ECMWF._mkp.
+
+Usage:
+    python era5cube.py cube_dir -d0 20170801 -d1 20170930 -v T UDR -lat 0 50 -lon -10 160
+    cube = Cube(cube_dir)
+    dat = cube.snapshot(datetime(2017,8,11,18), ['T','P'])
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import pickle
+from datetime import datetime, timedelta
+import numpy as np
+from ECMWF_N import ECMWF, ECMWF_pure
+
+CUBEMETA = 'meta.pkl'
+# attributes of the ECMWF objects kept in the meta file
+ATTRS = ['levs', 'plev', 'ai', 'bi', 'am', 'bm', 'levtype']
+
+def _range(bounds):
+    # bounds as a tuple (or None), so that those given as lists (command
+    # line) and as tuples compare equal
+    return None if bounds is None else tuple([float(b) for b in bounds])
+
+def _fname(cube_dir, var, day):
+    return os.path.join(cube_dir, var, day.strftime('%Y%m%d')+'.npy')
+
+######################
+def build(cube_dir, project, day0, day1, variables, latRange=None, lonRange=None,
+          exp=[None], quiet=False, reader=None):
+    """ Stores the variables of project for the days day0 to day1 (included,
+    datetime) restricted to latRange x lonRange (bounds as in ECMWF.extract)
+    in cube_dir. SP is always stored. reader is a function date -> ECMWF
+    object, by default ECMWF(project, date, exp=exp). """
+    variables = ['SP'] + [var for var in variables if var not in ['SP', 'P']]
+    latRange = _range(latRange)
+    lonRange = _range(lonRange)
+    if reader is None:
+        reader = lambda date: ECMWF(project, date, exp=exp)
+    try:
+        with open(os.path.join(cube_dir, CUBEMETA), 'rb') as f:
+            meta = pickle.load(f)
+        # cubes built before the bounds were stored as tuples
+        meta['latRange'] = _range(meta['latRange'])
+        meta['lonRange'] = _range(meta['lonRange'])
+        if (meta['project'] != project) or (meta['latRange'] != latRange) \
+           or (meta['lonRange'] != lonRange):
+            print('the cube in '+cube_dir+' has another project or domain')
+            return
+        meta['variables'] = meta['variables'] + [var for var in variables if var not in meta['variables']]
+    except (IOError, OSError):
+        meta = {'project':project, 'latRange':latRange, 'lonRange':lonRange,
+                'exp':exp, 'variables':variables, 'days':[], 'missing':[]}
+    for var in variables:
+        if not os.path.isdir(os.path.join(cube_dir, var)):
+            os.makedirs(os.path.join(cube_dir, var))
+    day = datetime(day0.year, day0.month, day0.day)
+    while day <= day1:
+        todo = [var for var in variables if not os.path.isfile(_fname(cube_dir, var, day))]
+        if len(todo) > 0:
+            if not quiet: print('building '+day.strftime('%Y-%m-%d'), todo)
+            _buildday(cube_dir, meta, day, todo, reader)
+            if day not in meta['days']:
+                meta['days'].append(day)
+                meta['days'].sort()
+            with open(os.path.join(cube_dir, CUBEMETA+'.tmp'), 'wb') as f:
+                pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(os.path.join(cube_dir, CUBEMETA+'.tmp'), os.path.join(cube_dir, CUBEMETA))
+        day += timedelta(days=1)
+    return meta
+
+def _buildday(cube_dir, meta, day, variables, reader):
+    """ Reads the 24 hours of day and writes the files of the variables """
+    out = {}
+    for hour in range(24):
+        date = day + timedelta(hours=hour)
+        dat = reader(date)
+        dat._readmeta()
+        if 'lons' not in dat.attr.keys():
+            print('cannot read '+date.strftime('%Y-%m-%d %H'))
+            if date not in meta['missing']: meta['missing'].append(date)
+            dat.close()
+            continue
+        j0, j1, i0, i1 = dat._window(meta['latRange'], meta['lonRange'])
+        if 'lons' not in meta:
+            meta['lons'] = dat.attr['lons'][i0:i1]
+            meta['lats'] = dat.attr['lats'][j0:j1]
+            meta['dlo'] = dat.attr['dlo']
+            meta['dla'] = dat.attr['dla']
+        for var in variables:
+            if var == 'SP':
+                field = np.array(dat.var['SP'][j0:j1, i0:i1], dtype=np.float32)
+            else:
+                if 'levs' not in meta:
+                    # the levels are defined by the first full read
+                    dat._get_var(var)
+                    if 'levs' in dat.attr.keys():
+                        for key in ATTRS:
+                            meta[key] = dat.attr[key]
+                field = dat.get_var(var, meta['latRange'], meta['lonRange'], dtype=np.float32)
+            if field is None:
+                if date not in meta['missing']: meta['missing'].append(date)
+                continue
+            if var not in out:
+                out[var] = np.lib.format.open_memmap(_fname(cube_dir, var, day)+'.tmp', mode='w+',
+                                                     dtype=np.float32, shape=(24,)+field.shape)
+                out[var][...] = np.nan
+            if field.shape != out[var].shape[1:]:
+                print('inconsistent shape of '+var+' at '+date.strftime('%Y-%m-%d %H'))
+                continue
+            out[var][hour] = field
+        dat.close()
+    for var in out:
+        out[var].flush()
+    names = list(out)
+    out.clear()
+    for var in names:
+        os.replace(_fname(cube_dir, var, day)+'.tmp', _fname(cube_dir, var, day))
+
+class Cube(object):
+    """ Reader of a cube built by build """
+    def __init__(self, cube_dir):
+        self.cube_dir = cube_dir
+        with open(os.path.join(cube_dir, CUBEMETA), 'rb') as f:
+            self.meta = pickle.load(f)
+        self.maps = {}
+
+    def dates(self):
+        """ Hours available in the cube """
+        missing = set(self.meta['missing'])
+        return [day + timedelta(hours=h) for day in self.meta['days'] for h in range(24)
+                if day + timedelta(hours=h) not in missing]
+
+    def field(self, var, date):
+        """ Memory-mapped field var at the hour date, or None """
+        day = datetime(date.year, date.month, date.day)
+        key = (var, day)
+        if key not in self.maps:
+            try:
+                self.maps[key] = np.load(_fname(self.cube_dir, var, day), mmap_mode='r')
+            except (IOError, OSError):
+                print(var+' not in the cube for '+day.strftime('%Y-%m-%d'))
+                return None
+        return self.maps[key][date.hour]
+
+    def snapshot(self, date, variables=None, copy=False):
+        """ ECMWF_pure object with the variables (default: all) at the hour date """
+        if variables is None:
+            variables = self.meta['variables']
+        if date in self.meta['missing']:
+            print('missing hour '+date.strftime('%Y-%m-%d %H'))
+            return None
+        dat = ECMWF_pure()
+        dat.project = self.meta['project']
+        dat.date = date
+        for key in ATTRS + ['lons', 'lats', 'dlo', 'dla']:
+            if key in self.meta:
+                dat.attr[key] = self.meta[key]
+        dat.attr['valDate'] = int(date.strftime('%Y%m%d'))
+        dat.attr['valTime'] = int(date.strftime('%H%M'))
+        dat.attr['Lo1'] = dat.attr['lons'][0]
+        dat.attr['Lo2'] = dat.attr['lons'][-1]
+        dat.attr['La1'] = dat.attr['lats'][0]
+        dat.attr['La2'] = dat.attr['lats'][-1]
+        dat.nlon = len(dat.attr['lons'])
+        dat.nlat = len(dat.attr['lats'])
+        if 'levs' in dat.attr:
+            dat.nlev = len(dat.attr['levs'])
+        for var in variables:
+            if var == 'P':
+                continue
+            field = self.field(var, date)
+            if field is None:
+                return None
+            dat.var[var] = np.array(field) if copy else field
+        if 'P' in variables:
+            sp = self.field('SP', date)
+            levs = dat.attr['levs']
+            dat.var['P'] = (dat.attr['am'][levs-1][:, None, None]
+                            + dat.attr['bm'][levs-1][:, None, None]*sp[None, :, :]).astype(np.float32)
+        return dat
+
+    def close(self):
+        self.maps = {}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='build a consolidated ERA5 cube')
+    parser.add_argument('cube_dir', help='cube directory')
+    parser.add_argument('-p', '--project', default='FULL-EA', help='project as in ECMWF_N')
+    parser.add_argument('-d0', '--day0', required=True, help='first day (yyyymmdd)')
+    parser.add_argument('-d1', '--day1', required=True, help='last day (yyyymmdd)')
+    parser.add_argument('-v', '--variables', nargs='+', default=['T'], help='variables (SP is always stored)')
+    parser.add_argument('-lat', '--latRange', type=float, nargs=2, help='latitude range')
+    parser.add_argument('-lon', '--lonRange', type=float, nargs=2, help='longitude range')
+    parser.add_argument('-e', '--exp', nargs='+', default=[None], help='additional streams as in ECMWF_N')
+    args = parser.parse_args()
+    build(args.cube_dir, args.project, datetime.strptime(args.day0, '%Y%m%d'),
+          datetime.strptime(args.day1, '%Y%m%d'), args.variables, args.latRange,
+          args.lonRange, args.exp)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Size-bounded cache of numpy fields shared within a process
+
+The values are numpy arrays or tuples of numpy arrays (and other small
+objects). They are copied when stored and when returned, so that the callers
+can modify the fields they get without altering the cache. The least recently
+used entries are discarded when the total size exceeds the limit (bytes).
+
+Example (as used by ECMWF_N):
+    cache = FieldCache(1 << 30)
+    field = cache.get(key)
+    if field is None:
+        field = read(...)
+        cache.put(key, field)
+    print(cache.stats())
+    cache.set_limit(0)   # disables the cache
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class FieldCache(object):
+    """ LRU cache of fields bounded by a total size in bytes """
+    def __init__(self, limit=1 << 30):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Copy of the value stored for key, or None """
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+        # the stored values are never modified, so that they can be copied
+        # outside the lock
+        return _copy(value)
+
+    def put(self, key, value):
+        """ Stores a copy of value for key if it fits in the limit """
+        nbytes = _nbytes(value)
+        if nbytes > self.limit:
+            return
+        value = _copy(value)
+        with self.lock:
+            if key in self.items:
+                self.size -= _nbytes(self.items.pop(key))
+            self.items[key] = value
+            self.size += nbytes
+            self._evict()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def _evict(self):
+        while self.size > self.limit:
+            key, value = self.items.popitem(last=False)
+            self.size -= _nbytes(value)
+
+    def set_limit(self, limit):
+        """ Changes the size limit (bytes), 0 disables the cache """
+        with self.lock:
+            self.limit = limit
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Number of hits and misses, number of entries, size and limit (bytes) """
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses, 'entries':len(self.items),
+                    'size':self.size, 'limit':self.limit}
+
+def _copy(value):
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple([_copy(v) for v in value])
+    return value
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum([_nbytes(v) for v in value])
+    return 0
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Persistent index of the messages of a grib file
+
+GribIndex(path) scans the grib file once with pygrib and records, for each
+message, its position and length in the file and the keys used to select
+the messages in ECMWF_N (shortName, name, validityDate, validityTime, level,
+step, iterationNumber, dataDate, dataTime). The index is saved in path+'.gidx', or in
+~/.cache/gribidx when the directory of the file is not writable, and is
+reused as long as the grib file keeps the same size and modification time.
+
+opengrib(path) returns the GribIndex of path from a pool shared by the whole
+process (and thus by all the ECMWF objects), so that a file read for several
+hours is opened and indexed once. The pool keeps the POOLSIZE last used files.
+
+GribIndex.select(**kwargs) has the behaviour of pygrib.open(path).select:
+it returns the list of the matching messages in the order of the file, and
+raises ValueError if there is none, but only the matching messages are read
+and decoded. The messages are found through a table keyed on (shortName,
+validityTime, level), so that selecting some levels of a variable at a time
+does not scan the index.
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+import pygrib
+
+# keys stored in the index
+KEYS = ('shortName', 'name', 'validityDate', 'validityTime', 'level', 'step', 'iterationNumber',
+        'dataDate', 'dataTime')
+# version of the index files
+VERSION = 2
+CACHEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'gribidx')
+# maximum number of files kept in the pool of opengrib
+POOLSIZE = 32
+_pool = OrderedDict()
+_poollock = threading.Lock()
+
+def opengrib(path, quiet=True):
+    """ GribIndex of path taken from the pool of the process, or opened and
+    added to the pool. The index is rebuilt if the file has been modified. """
+    key = os.path.abspath(path)
+    st = os.stat(path)
+    with _poollock:
+        idx = _pool.get(key)
+        if (idx is not None) and (idx.mtime == st.st_mtime) and (idx.size == st.st_size):
+            _pool.move_to_end(key)
+            return idx
+    # opened outside the lock as indexing a new file may be long
+    idx = GribIndex(path, quiet)
+    with _poollock:
+        _pool[key] = idx
+        _pool.move_to_end(key)
+        # the evicted indexes are closed when no more used
+        while len(_pool) > POOLSIZE:
+            _pool.popitem(last=False)
+    return idx
+
+def clearpool():
+    """ Empties the pool of opengrib """
+    with _poollock:
+        _pool.clear()
+
+class GribIndex(object):
+    """ Indexed access to the messages of a grib file """
+    def __init__(self, path, quiet=True):
+        self.path = path
+        st = os.stat(path)
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.fd = None
+        self.lock = threading.Lock()
+        if not self._load():
+            if not quiet: print('indexing '+path)
+            self._build()
+            self._save()
+
+    def _idxnames(self):
+        """ Possible locations of the index file """
+        flat = os.path.abspath(self.path).replace(os.sep, '%')
+        return [self.path+'.gidx', os.path.join(CACHEDIR, flat+'.gidx')]
+
+    def _load(self):
+        for name in self._idxnames():
+            try:
+                with open(name, 'rb') as f:
+                    idx = pickle.load(f)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                continue
+            if (idx['version'] == VERSION) and (idx['mtime'] == self.mtime) \
+               and (idx['size'] == self.size):
+                self.offsets = idx['offsets']
+                self.lengths = idx['lengths']
+                self.keys = idx['keys']
+                self._hash()
+                return True
+        return False
+
+    def _hash(self):
+        """ Table of the message numbers for each (shortName, validityTime, level),
+        as a dictionary (shortName, validityTime) -> {level: message numbers} """
+        self.table = {}
+        for i in range(len(self.keys)):
+            key = self.keys[i]
+            self.table.setdefault((key[0], key[3]), {}).setdefault(key[4], []).append(i)
+
+    def _build(self):
+        """ Scans the file, the messages being assumed to follow each other """
+        offsets = []
+        lengths = []
+        keys = []
+        off = 0
+        grbs = pygrib.open(self.path)
+        with open(self.path, 'rb') as f:
+            for grb in grbs:
+                length = grb['totalLength']
+                f.seek(off)
+                # skip possible padding between messages
+                while f.read(4) != b'GRIB':
+                    off += 1
+                    f.seek(off)
+                    if off >= self.size:
+                        raise IOError('CANNOT LOCATE MESSAGES IN '+self.path)
+                offsets.append(off)
+                lengths.append(length)
+                key = []
+                for k in KEYS:
+                    try:
+                        key.append(grb[k])
+                    except (RuntimeError, KeyError, ValueError):
+                        key.append(None)
+                keys.append(tuple(key))
+                off += length
+        grbs.close()
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.keys = keys
+        self._hash()
+
+    def _save(self):
+        idx = {'version':VERSION, 'path':self.path, 'mtime':self.mtime, 'size':self.size,
+               'offsets':self.offsets, 'lengths':self.lengths, 'keys':self.keys}
+        for name in self._idxnames():
+            try:
+                if not os.path.isdir(os.path.dirname(name)):
+                    os.makedirs(os.path.dirname(name))
+                with open(name+'.tmp', 'wb') as f:
+                    pickle.dump(idx, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(name+'.tmp', name)
+                return
+            except (IOError, OSError):
+                continue
+        print('cannot save the index of '+self.path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def message(self, i):
+        """ Message i (from 0) of the file, as a pygrib message """
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            fd = self.fd
+        return pygrib.fromstring(os.pread(fd, int(self.lengths[i]), int(self.offsets[i])))
+
+    def find(self, **kwargs):
+        """ Numbers of the messages whose indexed keys match kwargs
+        (values, lists of values or functions returning a boolean) """
+        tests = [(KEYS.index(k), _matcher(v)) for k, v in kwargs.items() if k in KEYS]
+        key = (kwargs.get('shortName'), kwargs.get('validityTime'))
+        if (None in key) or callable(key[0]) or callable(key[1]) \
+           or isinstance(key[0], (list, tuple)) or isinstance(key[1], (list, tuple)):
+            candidates = range(len(self.keys))
+        else:
+            bylevel = self.table.get(key, {})
+            level = kwargs.get('level')
+            if (level is None) or callable(level):
+                candidates = sorted([i for msgs in bylevel.values() for i in msgs])
+            elif isinstance(level, (list, tuple)):
+                candidates = sorted([i for lev in set(level) for i in bylevel.get(lev, [])])
+            else:
+                candidates = bylevel.get(level, [])
+        return [i for i in candidates if all([t(self.keys[i][j]) for j, t in tests])]
+
+    def select(self, **kwargs):
+        """ List of the messages matching kwargs, as pygrib.open(path).select """
+        others = [(k, _matcher(v)) for k, v in kwargs.items() if k not in KEYS]
+        grbs = []
+        for i in self.find(**kwargs):
+            grb = self.message(i)
+            try:
+                if all([t(grb[k]) for k, t in others]):
+                    grbs.append(grb)
+            except (RuntimeError, KeyError, ValueError):
+                continue
+        if len(grbs) == 0:
+            raise ValueError('no matches found')
+        return grbs
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except (AttributeError, OSError):
+            pass
+
+def _matcher(v):
+    """ Test of a key value against v as in pygrib select """
+    if callable(v):
+        return v
+    if isinstance(v, (list, tuple)):
+        return lambda x: x in v
+    return lambda x: x == v
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 -*-
+"""
+Matching of parcels between two outputs of TRACZILLA from their idx_back.
+
+The parcel numbers idx_back are unique within an output and dense, as they
+run from idx_orgn to idx_orgn+numpart-1. The membership masks are thus
+obtained in linear time by marking the numbers of one list in a table covering
+the range of both lists, instead of the sort used by np.in1d.
+
+idxin(a,b) gives the same mask as np.in1d(a,b) (with or without assume_unique)
+idxmatch(a,b) gives the pair np.in1d(a,b), np.in1d(b,a) used in the backward
+loops to keep the parcels present at two successive times.
+When the range of the values is much larger than the number of elements (e.g.
+undefined idx_back of new parcels), the table would be too large and np.isin
+is used instead.
+
+@author Bernard Legras
+@licence CeCILL-C
+"""
+import numpy as np
+from numba import jit
+
+# maximum size of the table relative to the number of elements
+SPAN_FACTOR = 16
+
+@jit(nopython=True,cache=True)
+def _mark(a,b,lo,table,kept):
+    """ Sets kept to the presence of the elements of a in b,
+    table is a boolean array of size covering the range of a and b from lo """
+    for j in range(len(b)):
+        table[b[j]-lo] = True
+    for i in range(len(a)):
+        kept[i] = table[a[i]-lo]
+    # reset of the table for the next use
+    for j in range(len(b)):
+        table[b[j]-lo] = False
+
+def _bounds(a,b):
+    """ Common range of a and b, or None if it is too large for a table """
+    lo, hi = min(a.min(),b.min()), max(a.max(),b.max())
+    if int(hi)-int(lo) > SPAN_FACTOR*(len(a)+len(b)):
+        return None
+    return lo, hi
+
+def idxin(a,b):
+    """ Boolean mask of the elements of a which are found in b """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    kept = np.zeros(len(a),dtype=np.bool_)
+    if (len(a) == 0) | (len(b) == 0):
+        return kept
+    bounds = _bounds(a,b)
+    if bounds is None:
+        return np.isin(a,b)
+    lo,hi = bounds
+    table = np.zeros(int(hi)-int(lo)+1,dtype=np.bool_)
+    _mark(a,b,lo,table,kept)
+    return kept
+
+def idxmatch(a,b):
+    """ Masks of the elements of a found in b and of the elements of b found
+    in a, using the same table for the two passes """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    kept_a = np.zeros(len(a),dtype=np.bool_)
+    kept_b = np.zeros(len(b),dtype=np.bool_)
+    if (len(a) == 0) | (len(b) == 0):
+        return kept_a, kept_b
+    bounds = _bounds(a,b)
+    if bounds is None:
+        return np.isin(a,b), np.isin(b,a)
+    lo,hi = bounds
+    table = np.zeros(int(hi)-int(lo)+1,dtype=np.bool_)
+    _mark(a,b,lo,table,kept_a)
+    _mark(b,a,lo,table,kept_b)
+    return kept_a, kept_b
@@ -6,24 +6,53 @@ Reads and write 107 format used by TRACZILLA
 For both python 2 and python 3
 It can read and write both normal and gzipped files. The fname is always the 
 name of the file without .gz suffix
+Gzipped files recompressed with gzip107 (python io107.py run_dir) are
+decompressed in parallel by readidx107.
 @authors Ann'Sophie Tissier and Bernard Legras (legras@lmd;ens.fr)
 @licence CeCILL-C
 """
 from __future__ import absolute_import, division, print_function
 from __future__ import unicode_literals
 import os
-from struct import unpack, pack
+from struct import unpack, pack, Struct
+from struct import error as struct_error
 from numpy import asarray,amin,amax
+import numpy as np
 import gzip
+import pickle
+import re
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Records of the body of a 107 file following the header, in the order of the file,
+# with their big-endian type (record 10 idx_back is defined in readidx107)
+RECORDS = (('flag','>i4'),('ir_start','>i4'),('x','>f4'),('y','>f4'),
+           ('p','>f4'),('t','>f4'),('idx_back','>i4'))
+# Number of values converted at once when writing a record
+WCHUNK = 1 << 20
+# Name of the catalogue file in a run directory and pattern of the part files
+CATALOG107 = 'CATALOG107'
+PARTNAME = re.compile(r'^part_(\d{3,})(\.gz)?$')
+# Layout of the gzip files written by gzip107: size of the uncompressed blocks,
+# header of each member with the extra field 'ST' holding the member size,
+# and default number of decompression threads
+GZBLOCK = 1 << 23
+GZHEAD = Struct('<BBBB6xHBBHL')
+NTHREADS = min(8, os.cpu_count() or 1)
+# Bit-fields of the flag word: name -> (shift, mask applied after the shift)
+FLAG_FIELDS = {'sat':(0,0xF), 'mod':(4,0x1), 'time_style':(5,0x1), 'vert_coord':(6,0x1),
+               'source_region':(7,0x3F), 'exit':(13,0xF), 'cloud_type':(24,0xFF)}
 
 ################################
-def readpart107(hour, part_dir, quiet=False):
+def readpart107(hour, part_dir, quiet=False, **kwargs):
     """ readpart107 reads 'part'
     files generated by traczilla routine partout_stc
     data = readpart(hour,dir) reads the part file for hour
     in the directory dir using 107 format
     As the format is common with index files, readpart107 calls
     readidx107. See below for the 107 format.
+    The other keyword arguments (fields, lazy, mmap) are passed to readidx107.
 
     A.-S. Tissier/ B. Legras May 2016 : Python version
     """
@@ -32,11 +61,46 @@ def readpart107(hour, part_dir, quiet=False):
     #print hourfile_str
     hourfile_tot = os.path.join(part_dir, "part_" + hourfile_str)
     #print hourfile_tot
-    dato = readidx107(hourfile_tot, quiet)
+    dato = readidx107(hourfile_tot, quiet, **kwargs)
     return dato
 
 ######################
-def readidx107(fname, quiet=False):
+def iterpart107(hours, part_dir, depth=1, maxmem=None, quiet=True, **kwargs):
+    """ Iterator over the part files of part_dir for the list of hours
+    for hour, data in iterpart107(range(6,1825,6), dir): ...
+    yields the hour and the output of readpart107(hour, part_dir, quiet, **kwargs)
+    while the next depth files are read and decoded in background threads.
+    maxmem (bytes): if set, limits the size of the records read in advance,
+    estimated from the headers; at least the next file is always read.
+    The data yielded at the previous iteration are not counted. """
+    hours = list(hours)
+    nrec = len(kwargs.get('fields') or RECORDS)
+    pool = ThreadPoolExecutor(max_workers=max(depth,1))
+    pending = deque()
+    nsub = 0
+    try:
+        for hour in hours:
+            # submit the current hour and up to depth hours in advance
+            while (nsub < len(hours)) and (len(pending) < depth+1):
+                size = 0
+                if maxmem is not None:
+                    fname = os.path.join(part_dir, 'part_{:03d}'.format(hours[nsub]))
+                    size = 4*nrec*readhead107(fname)['nact']
+                    if (len(pending) > 1) and (sum([p[1] for p in pending]) + size > maxmem):
+                        break
+                pending.append((hours[nsub], size,
+                    pool.submit(readpart107, hours[nsub], part_dir, quiet, **kwargs)))
+                nsub += 1
+            hour, size, future = pending.popleft()
+            yield hour, future.result()
+    finally:
+        for p in pending:
+            p[2].cancel()
+        pool.shutdown(wait=True)
+
+######################
+def readidx107(fname, quiet=False, fields=None, lazy=False, mmap=False, nthreads=NTHREADS,
+               where=None):
     """ readpart107 reads 'part'
     files generated by traczilla routine partout_stc
     data = readpart(hour,dir) reads the part file for hour
@@ -92,20 +156,261 @@ def readidx107(fname, quiet=False):
                           with first old parcels at time t-12h, then 
                           new parcels at time t-12h (both with their idx_orgn)
 
+    The records 4 to 10 are returned as numpy arrays of type int64 or float64,
+    as by the former reader, when all the records are read (fields not set)
+    without mmap. Otherwise (fields, lazy, mmap or where), they keep the type of
+    the file, int32 or float32, which halves the memory; the calculations made
+    with them are then in single precision unless they are converted.
+
+    Selection of the records:
+    fields: list of the records to be read, e.g. ['p','t','idx_back'], the other
+            records are skipped on disk (default: all the records)
+    lazy: if True, the records not in fields are read from the file at their first
+          access, e.g. data['x'], and data is then a Part107 dictionary
+    mmap: if True and the file is not gzipped, the records are mapped from the file
+          (copy on write) instead of being read in memory. The arrays are then in the
+          big-endian byte order of the file, which numba does not accept.
+    nthreads: number of threads used to decompress the gzipped files written by gzip107
+              (other gzipped files are decompressed by a single thread)
+
+    Selection of the parcels:
+    where: dictionary of conditions, all of which must be satisfied
+           'flags_on': mask, all the bits of mask are set in flag
+           'flags_off': mask, none of the bits of mask is set in flag
+           a bit-field of FLAG_FIELDS, e.g. 'cloud_type': value or list of values
+           a record, e.g. 'p': (lo, hi) selects lo <= p < hi, a bound may be None;
+           for 'x', lo > hi selects a box across the date line
+           Example: where={'cloud_type':[8,9,13], 'p':(None,27000), 'x':(60,100)}
+           The records are then returned for the selected parcels only, and
+           data['sel'] holds their indices in the file, data['nsel'] their number
+           (data['nact'] is still the number of parcels in the file).
+           The records are read by blocks of WCHUNK parcels, so that the memory
+           used depends on the number of selected parcels.
+    The returned data is then a Part107 dictionary, like with lazy=True.
+    The bit-fields of FLAG_FIELDS (e.g. data['cloud_type']) of a Part107
+    dictionary are decoded from the flag at their first access.
+
     A.-S. Tissier/ B. Legras May 2016 : Python version
     """
 
     # Initialization :
-    data = {}
+    wide = (fields is None) and not (lazy or mmap)
+    if fields is None:
+        fields = [var for var, dtype in RECORDS]
+    for var in fields:
+        if var not in dict(RECORDS):
+            raise ValueError('UNKNOWN RECORD '+var)
+    if where is not None:
+        return _readwhere(fname, quiet, fields, where, nthreads)
 
     # Open the binary file :
     print('open '+fname)
+    fid, gz = _open107(fname, quiet)
+    members = None
+    if gz:
+        members = _members107(fid.name)
+    if lazy:
+        data = Part107(fid.name, gz, mmap, members)
+    else:
+        data = {}
+
+    # Get the header
+    _readhead(fid, data, quiet)
+
+     # case provided to read part_000 of M10
+    if data['nact']==0:
+           print("empty trajectory set")
+           data['flag']=[]
+           data['ir_start']=[]
+           data['x']=[]
+           data['y']=[]
+           data['p']=[]
+           data['t']=[]
+           data['idx_back']=[]
+           fid.close()
+           return data 
+    # Get the selected records of the body
+    # Each record is read in a single block and decoded by numpy in place, which is
+    # much faster than unpacking nact values through struct.
+    # The arrays keep the type of the file (int32 or float32) in the native byte order,
+    # and are widened to int64 or float64 when all the records are read.
+    # Reading stops after the last selected record.
+    last = max([k for k in range(len(RECORDS)) if RECORDS[k][0] in fields] + [-1,])
+    for k in range(last+1):
+        var, dtype = RECORDS[k]
+        if var not in fields:
+            if members is None: fid.seek(4*data['nact']+8, 1)
+        elif mmap and not gz:
+            data[var] = _maprec(fid.name, data['nact'], k, dtype)
+            fid.seek(4*data['nact']+8, 1)
+        elif members is not None:
+            data[var] = _memberrec(members, data['nact'], k, dtype, nthreads)
+        else:
+            data[var] = _readrec(fid, data['nact'], dtype)
+        if wide:
+            data[var] = data[var].astype(np.float64 if 'f' in dtype else np.int64)
+    if not quiet:
+        if 'flag' in fields: print('flag', data['flag'][0], data['flag'][data['nact']-1])
+        if 'ir_start' in fields: print('ir', amin(data['ir_start'])/86400., amax(data['ir_start'])/86400.)
+        for var in ['x','y','p','t']:
+            if var in fields: print(var, amin(data[var]),amax(data[var]))
+        if 'idx_back' in fields: print('idx', data['idx_back'][0], data['idx_back'][data['nact']-1])
+
+    # the flag is not decoded here, see decodeflag and FLAG_FIELDS
+
+    # Close the binary file
+    fid.close()
+
+    return data
+
+######################
+def iterslab107(fname, nslab=WCHUNK, fields=None, quiet=True, nthreads=NTHREADS,
+                start=0, stop=None):
+    """ Iterator over the slabs of nslab consecutive parcels of a 107 file
+    (fname or fname.gz), from parcel start to parcel stop-1 (default: nact-1)
+    for data in iterslab107(fname, 10**6, fields=['x','y','p']): ...
+    Each data is a dictionary with the header of the file, i0 and i1 such
+    that the slab holds the parcels i0 to i1-1, and the records of fields
+    (default: all the records) for these parcels, in native byte order.
+    Only the bytes of the slab are read from plain files and from the gzipped
+    files written by gzip107; other gzipped files are decompressed once,
+    forward, with one stream per record. The memory used depends on nslab only. """
+    if fields is None:
+        fields = [var for var, dtype in RECORDS]
+    for var in fields:
+        if var not in dict(RECORDS):
+            raise ValueError('UNKNOWN RECORD '+var)
+    head = readhead107(fname, quiet)
+    del head['offsets']
+    nact = head['nact']
+    if stop is None: stop = nact
+    if (start < 0) or (stop > nact) or (start > stop) or (nslab < 1):
+        raise ValueError('WRONG SLAB')
+    ks = [k for k in range(len(RECORDS)) if RECORDS[k][0] in fields]
+    members = None
+    fids = {}
+    if head['gz']:
+        members = _members107(head['fname'])
+        if members is None:
+            for k in ks:
+                fids[k] = gzip.open(head['fname'], 'rb')
+    else:
+        fid = open(head['fname'], 'rb')
+        for k in ks:
+            fids[k] = fid
     try:
-        fid = open(fname, 'rb')
-    except IOError:
-        if not quiet: print("try gzipped version")
-        fid=gzip.open(fname+".gz",'rb')
+        for i0 in range(start, stop, nslab):
+            i1 = min(i0+nslab, stop)
+            data = dict(head)
+            data['i0'] = i0
+            data['i1'] = i1
+            for k in ks:
+                data[RECORDS[k][0]] = _readslab(fids.get(k), members, nact, k, i0, i1, nthreads)
+            yield data
+    finally:
+        for fid in set(fids.values()):
+            fid.close()
+
+######################
+def readslab107(fname, i0, i1, fields=None, quiet=True, nthreads=NTHREADS):
+    """ Reads the records fields (default: all) of the parcels i0 to i1-1 of
+    a 107 file (fname or fname.gz), see iterslab107
+    Example: data = readslab107(fname, 0, 10**6, fields=['p','t']) """
+    slabs = iterslab107(fname, max(i1-i0,1), fields, quiet, nthreads, i0, i1)
+    try:
+        for data in slabs:
+            return data
+    finally:
+        slabs.close()
+    # empty slab
+    data = readhead107(fname, quiet)
+    del data['offsets']
+    data['i0'] = data['i1'] = i0
+    for var, dtype in RECORDS:
+        if (fields is None) or (var in fields):
+            data[var] = np.empty(0, dtype=np.dtype(dtype).newbyteorder('='))
+    return data
+
+######################
+def _readwhere(fname, quiet, fields, where, nthreads=NTHREADS):
+    """ Reads the records fields of the parcels of fname satisfying the conditions
+    of where (see readidx107).
+    The records used in the conditions are first scanned by blocks of WCHUNK
+    parcels to build the selection, skipping the blocks where no parcel remains,
+    then the selected values of the fields are extracted block by block. """
+    tests = _conditions(where)
+    print('open '+fname)
+    fid, gz = _open107(fname, quiet)
+    members = None
+    if gz:
+        members = _members107(fid.name)
+    data = Part107(fid.name, gz, members=members)
+    _readhead(fid, data, quiet)
+    nact = data['nact']
+    keep = np.ones(nact, dtype=np.bool_)
+    for k in sorted(tests):
+        for i0 in range(0, nact, WCHUNK):
+            i1 = min(i0+WCHUNK, nact)
+            if not keep[i0:i1].any(): continue
+            slab = _readslab(fid, members, nact, k, i0, i1, nthreads)
+            for test in tests[k]:
+                keep[i0:i1] &= test(slab)
+    data.sel = np.flatnonzero(keep)
+    del keep
+    data['sel'] = data.sel
+    data['nsel'] = len(data.sel)
+    for k in range(len(RECORDS)):
+        if RECORDS[k][0] in fields:
+            data[RECORDS[k][0]] = _readsel(fid, members, nact, k, data.sel, nthreads)
+    fid.close()
+    if not quiet: print('selected', data['nsel'], 'parcels among', nact)
+    return data
+
+######################
+def _conditions(where):
+    """ Translates the conditions of where into tests on blocks of records,
+    returned as a dictionary indexed by the record number """
+    recs = [rec[0] for rec in RECORDS]
+    tests = {}
+    for key, val in where.items():
+        k = 0
+        if key == 'flags_on':
+            test = lambda v, m=val: (v & m) == m
+        elif key == 'flags_off':
+            test = lambda v, m=val: (v & m) == 0
+        elif key in FLAG_FIELDS:
+            test = lambda v, name=key, vals=val: np.isin(decodeflag(v, name), vals)
+        elif key in recs:
+            k = recs.index(key)
+            lo, hi = val
+            test = lambda v, lo=lo, hi=hi, wrap=(key=='x'): _inrange(v, lo, hi, wrap)
+        else:
+            raise ValueError('UNKNOWN SELECTION '+key)
+        tests.setdefault(k, []).append(test)
+    return tests
 
+######################
+def _inrange(v, lo, hi, wrap=False):
+    """ Mask of lo <= v < hi, a bound being ignored if None.
+    If wrap is True and lo > hi, the interval wraps (v >= lo or v < hi) """
+    if wrap and (lo is not None) and (hi is not None) and (lo > hi):
+        return (v >= lo) | (v < hi)
+    ok = np.ones(len(v), dtype=np.bool_)
+    if lo is not None: ok &= (v >= lo)
+    if hi is not None: ok &= (v < hi)
+    return ok
+
+######################
+def decodeflag(flag, name):
+    """ Decodes the bit-field name of FLAG_FIELDS (sat, mod, time_style, vert_coord,
+    source_region, exit, cloud_type) from the flag word
+    Example: ct = decodeflag(data['flag'], 'cloud_type') """
+    shift, mask = FLAG_FIELDS[name]
+    return (asarray(flag) >> shift) & mask
+
+######################
+def _readhead(fid, data, quiet=False):
+    """ Reads the three header records of a 107 file into the dictionary data """
     # Get lhead, outnfmt (format) and mode (=0, index_file; =1, historical file)
     fid.read(4)  # first fortran record word (normaly 4 characters, char)
     data['lhead'] = unpack('>l', fid.read(4))[0]
@@ -141,84 +446,376 @@ def readidx107(fname, quiet=False):
     if not quiet:     
         print(data['numpart'], data['nact'], data['idx_orgn'])
         print(data['nact_lastO'],data['nact_lastNM'],data['nact_lastNH'])
-     
-     # case provided to read part_000 of M10
-    if data['nact']==0:
-           print("empty trajectory set")
-           data['flag']=[]
-           data['ir_start']=[]
-           data['x']=[]
-           data['y']=[]
-           data['p']=[]
-           data['t']=[]
-           data['idx_back']=[]
-           fid.close()
-           return data 
-    # Get flag
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['flag'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('flag', data['flag'][0], data['flag'][data['nact']-1])
 
-    # Get ir_start (launch time)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['ir_start'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    #print('ir', data['ir_start'][0], data['ir_start'][data['nact']-1])
-    if not quiet: print('ir', amin(data['ir_start'])/86400., amax(data['ir_start'])/86400.)
+######################
+def readhead107(fname, quiet=True):
+    """ Reads only the header of a 107 file (fname or fname.gz)
+    Returns a dictionary with the header fields (lhead, outnfmt, mode, stamp_date,
+    itime, step, numpart, nact, idx_orgn, nact_lastO, nact_lastNM, nact_lastNH),
+    the path of the file, whether it is gzipped and the offsets (in bytes,
+    in the uncompressed stream) of the first value of each body record. """
+    fid, gz = _open107(fname, quiet)
+    head = {}
+    _readhead(fid, head, quiet)
+    head['fname'] = fid.name
+    head['gz'] = gz
+    fid.close()
+    head['offsets'] = dict([(RECORDS[k][0], _recoffset(head['nact'], k)+4) for k in range(len(RECORDS))])
+    return head
 
-    # Get longitude (in degree)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['x'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('x', amin(data['x']),amax(data['x']))
+######################
+def catalog107(part_dir, save=True, quiet=True):
+    """ Catalogue of the part_XXX files (plain or gzipped) of a TRACZILLA output
+    directory, built from their headers only.
+    Returns a dictionary indexed by the hour XXX, each entry being the output
+    of readhead107 for that file. When both part_XXX and part_XXX.gz exist, the
+    plain file is retained, as in readidx107.
+    The catalogue is saved in part_dir/CATALOG107 (if save is True and the
+    directory is writable) and updated incrementally: at the next call,
+    only the new or modified files are read.
+    Example: hours = sorted(catalog107(dir)); nmax = max([c['nact'] for c in cat.values()])
+    """
+    catname = os.path.join(part_dir, CATALOG107)
+    try:
+        with open(catname, 'rb') as f:
+            old = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        old = {}
+    # list the part files
+    found = {}
+    for name in os.listdir(part_dir):
+        match = PARTNAME.match(name)
+        if match is None: continue
+        hour = int(match.group(1))
+        if (hour in found) and (match.group(2) is not None): continue
+        found[hour] = name
+    cat = {}
+    for hour in sorted(found):
+        path = os.path.join(part_dir, found[hour])
+        st = os.stat(path)
+        entry = old.get(hour)
+        if (entry is not None) and (entry['fname'] == path) and \
+           (entry['mtime'] == st.st_mtime) and (entry['size'] == st.st_size):
+            cat[hour] = entry
+            continue
+        if not quiet: print('catalog107 reads '+path)
+        try:
+            entry = readhead107(os.path.join(part_dir, 'part_'+PARTNAME.match(found[hour]).group(1)), quiet=True)
+        except (IOError, EOFError, ValueError, struct_error):
+            # file being written or not in 107 format
+            print('catalog107: cannot read header of '+path)
+            continue
+        entry['mtime'] = st.st_mtime
+        entry['size'] = st.st_size
+        cat[hour] = entry
+    # the unreadable files are not in the catalogue, and do not cause it to be rewritten
+    changed = (set(cat) != set(old)) or any([cat[hour] is not old[hour] for hour in cat])
+    if changed and save:
+        try:
+            with open(catname+'.tmp', 'wb') as f:
+                pickle.dump(cat, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(catname+'.tmp', catname)
+        except (IOError, OSError):
+            print('catalog107: cannot write '+catname)
+    return cat
 
-    # Get latitude (in degree)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['y'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('y', amin(data['y']),amax(data['y']))
+######################
+class _Members(object):
+    """ Index of the members of a gzip file written by gzip107.
+    Each member holds a block of the uncompressed file and carries its total
+    size in an extra field 'ST' of its header, which allows to locate all the
+    members without decompressing and to decompress them in parallel.
+    The file remains a standard gzip file (RFC 1952) that gunzip reads. """
+    def __init__(self, path):
+        self.path = path
+        self.coff = []
+        self.csize = []
+        self.usize = []
+        fsize = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            off = 0
+            while off < fsize:
+                f.seek(off)
+                head = f.read(GZHEAD.size)
+                if len(head) < GZHEAD.size: raise ValueError('NOT A GZIP107 FILE')
+                id1, id2, cm, flg, xlen, si1, si2, slen, msize = GZHEAD.unpack(head)
+                if (id1, id2, cm, flg, xlen, si1, si2, slen) != (31, 139, 8, 4, 8, 83, 84, 4):
+                    raise ValueError('NOT A GZIP107 FILE')
+                f.seek(off+msize-4)
+                self.coff.append(off)
+                self.csize.append(msize)
+                self.usize.append(unpack('<L', f.read(4))[0])
+                off += msize
+        self.uoff = np.concatenate(([0,], np.cumsum(self.usize)))
+
+    def _inflate(self, fd, m):
+        """ Decompresses member m and checks its crc """
+        cdata = os.pread(fd, self.csize[m], self.coff[m])
+        udata = zlib.decompressobj(-15).decompress(cdata[GZHEAD.size:-8])
+        crc, isize = unpack('<LL', cdata[-8:])
+        if (len(udata) != isize) or (zlib.crc32(udata) & 0xffffffff != crc):
+            raise IOError('CORRUPTED MEMBER IN '+self.path)
+        return udata
+
+    def read(self, offset, out, nthreads=NTHREADS):
+        """ Fills the writable uint8 array out with the uncompressed bytes starting
+        at offset, decompressing the members which contain them on nthreads threads """
+        end = offset + len(out)
+        if end > self.uoff[-1]:
+            raise IOError('TRUNCATED RECORD')
+        m0 = np.searchsorted(self.uoff, offset, side='right') - 1
+        m1 = np.searchsorted(self.uoff, end, side='left')
+        fd = os.open(self.path, os.O_RDONLY)
+        def job(m):
+            udata = self._inflate(fd, m)
+            u0 = max(self.uoff[m], offset)
+            u1 = min(self.uoff[m+1], end)
+            out[u0-offset:u1-offset] = np.frombuffer(udata, dtype=np.uint8,
+                                                     count=u1-u0, offset=u0-self.uoff[m])
+        try:
+            if (m1 - m0 == 1) or (nthreads <= 1):
+                for m in range(m0, m1): job(m)
+            else:
+                with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                    list(pool.map(job, range(m0, m1)))
+        finally:
+            os.close(fd)
+        return out
 
-    # Get the pressure (in Pascal)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['p'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('p', amin(data['p']),amax(data['p']))
+######################
+def _members107(path):
+    """ Returns the member index of path if it is written with gzip107, else None """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(GZHEAD.size)
+        if (len(head) < GZHEAD.size) or (head[3:4] != b'\x04') or (head[12:14] != b'ST'):
+            return None
+        return _Members(path)
+    except (IOError, OSError, ValueError):
+        return None
 
-    # Get the temperature (in Kelvin)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['t'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('t', amin(data['t']),amax(data['t']))
+######################
+def gzip107(fname, out=None, block=GZBLOCK, compresslevel=6, nthreads=NTHREADS):
+    """ Compresses the file fname (plain or gzipped, any content) into out
+    (default fname.gz, or fname itself if it is gzipped) as a series of gzip
+    members of block uncompressed bytes, compressed on nthreads threads.
+    The result is a standard gzip file which readidx107 decompresses in parallel.
+    The file is written under a temporary name and renamed at the end. """
+    if fname.endswith('.gz'):
+        fin = gzip.open(fname, 'rb')
+        if out is None: out = fname
+    else:
+        fin = open(fname, 'rb')
+        if out is None: out = fname + '.gz'
+    def deflate(udata):
+        comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        cdata = comp.compress(udata) + comp.flush()
+        msize = GZHEAD.size + len(cdata) + 8
+        # mtime=0, xfl=0, os=255 (unknown)
+        head = pack('<BBBBLBBHBBHL', 31, 139, 8, 4, 0, 0, 255, 8, 83, 84, 4, msize)
+        return head + cdata + pack('<LL', zlib.crc32(udata) & 0xffffffff, len(udata))
+    pool = ThreadPoolExecutor(max_workers=nthreads)
+    pending = deque()
+    try:
+        with open(out+'.tmp', 'wb') as fout:
+            while True:
+                udata = fin.read(block)
+                if len(udata) == 0: break
+                pending.append(pool.submit(deflate, udata))
+                # keep at most 2*nthreads blocks in memory
+                while len(pending) >= 2*nthreads:
+                    fout.write(pending.popleft().result())
+            while pending:
+                fout.write(pending.popleft().result())
+    finally:
+        fin.close()
+        pool.shutdown(wait=True)
+    os.replace(out+'.tmp', out)
+    return out
 
-    # Get idx_back
-    # (mode 0 : index of old parcels in the list at stamp_date -12h;
-    # undefined for new parcels)
-    # (mode 1 : index of current active parcels among the list of parcels at
-    # stamp_date)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['idx_back'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
+######################
+def gzip107run(part_dir, keep=False, quiet=False, **kwargs):
+    """ Recompresses all the part files of the directory part_dir with gzip107,
+    plain files into part_XXX.gz (removed unless keep is True) and gzipped files
+    in place. Files already written by gzip107 are skipped.
+    Other keyword arguments (block, compresslevel, nthreads) are passed to gzip107. """
+    for name in sorted(os.listdir(part_dir)):
+        if PARTNAME.match(name) is None: continue
+        path = os.path.join(part_dir, name)
+        if name.endswith('.gz'):
+            if _members107(path) is not None: continue
+        elif os.path.isfile(path+'.gz'):
+            print('gzip107run: both '+name+' and '+name+'.gz exist, '+name+' skipped')
+            continue
+        if not quiet: print('gzip107 '+path)
+        gzip107(path, **kwargs)
+        if not (keep or name.endswith('.gz')):
+            os.remove(path)
+
+######################
+class Part107(dict):
+    """ Dictionary of the content of a 107 file returned by readidx107 with lazy=True.
+    The records which have not been read at opening are read from the file at their
+    first access, e.g. data['x'].
+    For a gzipped file, the file is decompressed again up to the record, unless
+    it has been written by gzip107.
+    When the parcels have been selected (readidx107 with where), sel holds their
+    indices in the file and only the selected values of the records are read.
+    The bit-fields of FLAG_FIELDS are decoded from the flag at their first access. """
+    def __init__(self, fname, gz, mmap=False, members=None, sel=None):
+        dict.__init__(self)
+        self.fname = fname
+        self.gz = gz
+        self.mmap = mmap
+        self.members = members
+        self.sel = sel
+
+    def __missing__(self, var):
+        if var in FLAG_FIELDS:
+            self[var] = decodeflag(self['flag'], var)
+            return self[var]
+        recs = [rec[0] for rec in RECORDS]
+        if (var not in recs) or (self.get('nact',0) == 0):
+            raise KeyError(var)
+        k = recs.index(var)
+        if self.sel is not None:
+            fid = None
+            if self.members is None:
+                fid = gzip.open(self.fname, 'rb') if self.gz else open(self.fname, 'rb')
+            self[var] = _readsel(fid, self.members, self['nact'], k, self.sel)
+            if fid is not None: fid.close()
+        elif self.mmap and not self.gz:
+            self[var] = _maprec(self.fname, self['nact'], k, RECORDS[k][1])
+        elif self.members is not None:
+            self[var] = _memberrec(self.members, self['nact'], k, RECORDS[k][1])
+        else:
+            if self.gz:
+                fid = gzip.open(self.fname, 'rb')
+            else:
+                fid = open(self.fname, 'rb')
+            fid.seek(_recoffset(self['nact'], k))
+            self[var] = _readrec(fid, self['nact'], RECORDS[k][1])
+            fid.close()
+        return self[var]
+
+######################
+def _open107(fname, quiet=False):
+    """ Opens fname or, if it does not exist, fname.gz
+    Returns the file object and whether it is gzipped """
+    try:
+        fid = open(fname, 'rb')
+        gz = False
+    except IOError:
+        if not quiet: print("try gzipped version")
+        fid=gzip.open(fname+".gz",'rb')
+        gz = True
+    return fid, gz
+
+######################
+def _recoffset(nact, k):
+    """ Offset in bytes of the beginning of the body record k (0 for flag, ...,
+    6 for idx_back), including its first control word.
+    The header is made of 3 records of 12, 16 and 24 bytes (76 bytes with
+    the control words) and the body records have nact 4-byte values. """
+    return 76 + k*(4*nact+8)
+
+######################
+def _maprec(fname, nact, k, dtype):
+    """ Maps the body record k of an uncompressed file fname as a copy-on-write
+    memmap with the big-endian type dtype """
+    return np.memmap(fname, dtype=dtype, mode='c', offset=_recoffset(nact, k)+4, shape=(nact,))
+
+######################
+def _writerec(fid, values, nact, dtype):
+    """ Writes the nact values as a Fortran record of big-endian type dtype.
+    The conversion is made by blocks of WCHUNK values. """
+    values = asarray(values)
+    if len(values) != nact:
+        raise ValueError('RECORD LENGTH DIFFERS FROM NACT')
+    cwd = pack('>l', nact*4)
+    fid.write(cwd)
+    for i0 in range(0, nact, WCHUNK):
+        block = values[i0:i0+WCHUNK]
+        # ints which do not fit in 32 bits are rejected, as struct would do
+        if (np.dtype(dtype).kind == 'i') and (block.dtype.itemsize > 4) and (len(block) > 0):
+            if (block.min() < -2**31) or (block.max() >= 2**31):
+                raise ValueError('VALUE OUT OF INT32 RANGE')
+        fid.write(block.astype(dtype).tobytes())
+    fid.write(cwd)
+
+######################
+def _readrec(fid, nact, dtype):
+    """ Reads a Fortran record of nact values of type dtype from fid and returns
+    it as a numpy array in native byte order.
+    The data are read directly into the array buffer and swapped in place,
+    so that no intermediate copy is made for plain files. """
+    fid.read(4)  # first fortran record word
+    buf = np.empty(nact, dtype=dtype)
+    _readinto(fid, buf.view(np.uint8))
     fid.read(4)  # last fortran record word
-    if not quiet: print('idx', data['idx_back'][0], data['idx_back'][data['nact']-1])
+    return _native(buf)
 
-    # decode flag (commented out as not needed and slowing the reading)
-    #data['sat'] = asarray(data['flag']) & 0xF
-    #data['mod'] = (asarray(data['flag']) & 0x10) >> 4
-    #data['time_style'] = (asarray(data['flag']) & 0x20) >> 5
-    #data['vert_coord'] = (asarray(data['flag']) & 0x40) >> 6
-    #data['source_region'] = (asarray(data['flag']) & 0x1F80) >> 7
-    #print 'vert_coord', data['vert_coord'][0], data['vert_coord'][data['nact']-1]
+######################
+def _readinto(fid, raw):
+    """ Fills the uint8 array raw from the current position of fid """
+    # loop as gzip streams may return less than requested
+    nread = 0
+    while nread < raw.size:
+        n = fid.readinto(raw[nread:])
+        if not n:
+            raise IOError('TRUNCATED RECORD')
+        nread += n
 
-    # Close the binary file
-    fid.close()
+######################
+def _readslab(fid, members, nact, k, i0, i1, nthreads=NTHREADS):
+    """ Reads the values of the parcels i0 to i1-1 of the body record k, from the
+    members of a file written by gzip107 if members is not None, or else from
+    the open file fid, and returns them in native byte order """
+    buf = np.empty(i1-i0, dtype=RECORDS[k][1])
+    offset = _recoffset(nact, k) + 4 + 4*i0
+    if members is not None:
+        members.read(offset, buf.view(np.uint8), nthreads)
+    else:
+        fid.seek(offset)
+        _readinto(fid, buf.view(np.uint8))
+    return _native(buf)
 
-    return data
+######################
+def _readsel(fid, members, nact, k, sel, nthreads=NTHREADS):
+    """ Reads the values of the parcels of indices sel (sorted) of the body record k
+    Only the part of each block of WCHUNK parcels spanned by sel is read. """
+    out = np.empty(len(sel), dtype=np.dtype(RECORDS[k][1]).newbyteorder('='))
+    for i0 in range(0, nact, WCHUNK):
+        j0, j1 = np.searchsorted(sel, [i0, i0+WCHUNK])
+        if j0 == j1: continue
+        slab = _readslab(fid, members, nact, k, sel[j0], sel[j1-1]+1, nthreads)
+        out[j0:j1] = slab[sel[j0:j1]-sel[j0]]
+    return out
+
+######################
+def _memberrec(members, nact, k, dtype, nthreads=NTHREADS):
+    """ Reads the body record k of a file written by gzip107 from its members
+    and returns it as a numpy array in native byte order.
+    The members are decompressed directly into the array buffer. """
+    buf = np.empty(nact, dtype=dtype)
+    members.read(_recoffset(nact, k)+4, buf.view(np.uint8), nthreads)
+    return _native(buf)
+
+######################
+def _native(buf):
+    """ Swaps in place a big-endian array to the native byte order """
+    if not buf.dtype.isnative:
+        buf = buf.byteswap(inplace=True).view(buf.dtype.newbyteorder('='))
+    return buf
 
 #############################
-def writeidx107(fname, data,cmp=False):
+def writeidx107(fname, data,cmp=False,compresslevel=9):
     """ writeidx107 writes file under 107 format
     usage: writeidx107(fname,data)
     data is a dictionary containing the data
+    If cmp is True, the file fname is gzipped with compresslevel.
+    The records are converted and written from the numpy buffers by blocks of
+    WCHUNK values, so that the extra memory does not depend on nact.
 
     Description of format 107
     Fortran 32bits binary file is made of records with one control
@@ -233,7 +830,7 @@ def writeidx107(fname, data,cmp=False):
 
     # Open the binary file:
     if cmp:
-        fid=gzip.open(fname,'wb')
+        fid=gzip.open(fname,'wb',compresslevel=compresslevel)
     else:    
         fid = open(fname, 'wb')
 
@@ -263,40 +860,31 @@ def writeidx107(fname, data,cmp=False):
            data['nact_lastO'],data['nact_lastNM'],data['nact_lastNH'])
     fid.write(cwd+rec+cwd)
 
-    # Write flag
-    cwd = pack('>l', data['nact']*4)
-    rec = pack('>'+str(data['nact'])+'l', *data['flag'])
-    fid.write(cwd+rec+cwd)
-
-    # Write ir_start (launch time)
-    rec = pack('>'+str(data['nact'])+'l', *data['ir_start'])
-    fid.write(cwd+rec+cwd)
-
-    # Write longitude (in degree)
-    rec = pack('>'+str(data['nact'])+'f', *data['x'])
-    fid.write(cwd+rec+cwd)
-
-    # Write latitude (in degree)
-    rec = pack('>'+str(data['nact'])+'f', *data['y'])
-    fid.write(cwd+rec+cwd)
-
-    # Write the pressure (in Pascal)
-    rec = pack('>'+str(data['nact'])+'f', *data['p'])
-    fid.write(cwd+rec+cwd)
-
-    # Write the temperature (in Kelvin)
-    rec = pack('>'+str(data['nact'])+'f', *data['t'])
-    fid.write(cwd+rec+cwd)
-
-    # Write idx_back
+    # Write the seven records of the body (flag, ir_start, x, y, p, t, idx_back)
+    # idx_back:
     # (mode 0 : index of old parcels in the list at stamp_date -12h;
     # undefined for new parcels)
     # (mode 1 : index of current active parcels among the list of
     # parcels at stamp_date)
-    rec = pack('>'+str(data['nact'])+'l', *data['idx_back'])
-    fid.write(cwd+rec+cwd)
+    for var, dtype in RECORDS:
+        _writerec(fid, data[var], data['nact'], dtype)
 
     # Close the file
     fid.close()
 
     return
+
+if __name__ == '__main__':
+    # Archival tool: python io107.py run_dir [run_dir ...]
+    # recompresses the part files with gzip107 for parallel decompression
+    import argparse
+    parser = argparse.ArgumentParser(description='recompress TRACZILLA part files for parallel decompression')
+    parser.add_argument('dirs', nargs='+', help='run directories')
+    parser.add_argument('-l', '--level', type=int, default=6, help='compression level')
+    parser.add_argument('-b', '--block', type=int, default=GZBLOCK >> 20, help='block size (MB)')
+    parser.add_argument('-n', '--nthreads', type=int, default=NTHREADS, help='number of threads')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the plain files')
+    args = parser.parse_args()
+    for part_dir in args.dirs:
+        gzip107run(part_dir, keep=args.keep, block=args.block << 20,
+                   compresslevel=args.level, nthreads=args.nthreads)
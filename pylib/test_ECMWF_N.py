@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of ECMWF_N on synthetic ECMWF objects built without files (see
+synthetic): derived variables, calculation by columns, cache of the process,
+vertical interpolations, sampling at points, tropopauses.
+
+Can be run with pytest or as a script.
+"""
+import gzip
+import math
+import os
+import pickle
+import tempfile
+from datetime import datetime
+import numpy as np
+import constants as cst
+import ECMWF_N
+from ECMWF_N import ECMWF, ECMWF_pure
+
+DATE = datetime(2017, 8, 11, 18)
+# hybrid coefficients of 6 levels from about 20 hPa to the ground
+AM = np.array([2000., 6000., 12000., 15000., 10000., 0.])
+BM = np.array([0., 0., 0.1, 0.4, 0.75, 1.])
+AI = np.array([0., 4000., 8000., 16000., 14000., 6000., 0.])
+BI = np.array([0., 0., 0., 0.2, 0.6, 0.9, 1.])
+
+def synthetic(date=DATE, seed=0):
+    """ ECMWF object of project STC at date on a 6 x 5 x 8 grid with random
+    SP, T, U, V, VO and Q, as if they had been read from the files """
+    rng = np.random.default_rng(seed)
+    dat = ECMWF.__new__(ECMWF)
+    ECMWF_pure.__init__(dat)
+    dat.var = ECMWF_N._MetaDict(dat._readmeta)
+    dat.attr = ECMWF_N._MetaDict(dat._readmeta)
+    dat.project = 'STC'
+    dat.date = date
+    dat.step = 0
+    dat.exp = [None]
+    dat.x4I_expected = False
+    dat.globalGrid = False
+    dat.rootdir = ''
+    dat.rb = {}
+    dat.meta_read = True
+    dat.cachekey = ('STC', date, (None,))
+    dat._loaded = {}
+    dat.colvar = {}
+    dat.coldone = {}
+    dat.nlev, dat.nlat, dat.nlon = 6, 5, 8
+    dat.attr.update({'lons':np.arange(0., 80., 10.), 'lats':np.arange(0., 50., 10.),
+                     'Lo1':0., 'La1':0., 'dlo':10., 'dla':10., 'levtype':'hybrid',
+                     'levs':np.arange(1, 7), 'am':AM, 'bm':BM, 'ai':AI, 'bi':BI,
+                     'plev':AM + BM*cst.pref})
+    shape = (dat.nlev, dat.nlat, dat.nlon)
+    dat.var['SP'] = rng.uniform(9.e4, 1.02e5, shape[1:])
+    dat.var['T'] = np.linspace(200., 290., 6)[:, None, None] + rng.normal(0., 3., shape)
+    dat.var['U'] = rng.normal(0., 10., shape)
+    dat.var['V'] = rng.normal(0., 10., shape)
+    dat.var['VO'] = rng.normal(0., 1.e-5, shape)
+    dat.var['Q'] = rng.uniform(0., 0.01, shape)
+    return dat
+
+def cached(date=DATE, seed=0):
+    """ synthetic object whose fields are in the cache of the process, as
+    stored by _get_var and _readmeta, the surface pressure being read """
+    dat = synthetic(date, seed)
+    for var in ['T', 'U', 'V', 'VO', 'Q']:
+        ECMWF_N.cache.put(dat.cachekey+(var,), (dat.var.pop(var), dat.attr['levs'], dat.attr['plev']))
+    dat._keep('SP', dat.var['SP'])
+    return dat
+
+def theta(T, SP):
+    return T*(cst.p0/(AM[:, None, None] + BM[:, None, None]*SP))**cst.kappa
+
+def former(dat, Z0):
+    """ P, PT, Z and PV calculated as by the former _mkp, _mkthet, _mkz and
+    _mkpv methods """
+    var = dat.var
+    attr = dat.attr
+    nlev = dat.nlev
+    P = np.empty(var['T'].shape)
+    for i in range(nlev):
+        lev = attr['levs'][i]
+        P[i] = attr['am'][lev-1] + attr['bm'][lev-1]*var['SP']
+    PT = var['T'] * (cst.p0/P)**cst.kappa
+    Z = np.empty(var['T'].shape)
+    uu = - np.log(P)
+    uusp = - np.log(var['SP'])
+    Z[nlev-1] = Z0 + (cst.R/cst.g) * var['T'][nlev-1] * (uu[nlev-1]-uusp)
+    for i in range(nlev-2, -1, -1):
+        Z[i] = Z[i+1] + 0.5*(cst.R/cst.g) * (var['T'][i] + var['T'][i+1]) * (uu[i]-uu[i+1])
+    dlat = np.deg2rad(attr['dla'])*cst.REarth
+    dPTdPhi = np.empty(PT.shape)
+    dPTdPhi[:, 1:-1, :] = 0.5*(PT[:, 2:, :]-PT[:, :-2, :])/dlat
+    dPTdPhi[:, 0, :] = (PT[:, 1, :]-PT[:, 0, :])/dlat
+    dPTdPhi[:, -1, :] = (PT[:, -1, :]-PT[:, -2, :])/dlat
+    dlon = np.deg2rad(attr['dlo'])*cst.REarth
+    coslat = np.cos(np.deg2rad(attr['lats']))
+    dPTdLam = np.empty(PT.shape)
+    if dat.globalGrid:
+        dPTdLam[:, 1:-1, 1:-1] = 0.5*(PT[:, 1:-1, 2:]-PT[:, 1:-1, :-2])/dlon
+        dPTdLam[:, 1:-1, 0] = 0.5*(PT[:, 1:-1, 1]-PT[:, 1:-1, -1])/dlon
+        dPTdLam[:, 1:-1, -1] = 0.5*(PT[:, 1:-1, 0]-PT[:, 1:-1, -2])/dlon
+        dPTdLam[:, 1:-1, :] /= coslat[np.newaxis, 1:-1, np.newaxis]
+        dPTdLam[:, 0, :] = dPTdLam[:, 1, :]
+        dPTdLam[:, -1, :] = dPTdLam[:, -2, :]
+    else:
+        dPTdLam[..., 1:-1] = 0.5*(PT[..., 2:]-PT[..., :-2])/dlon
+        dPTdLam[..., 0] = (PT[..., 1]-PT[..., 0])/dlon
+        dPTdLam[..., -1] = (PT[..., -1]-PT[..., -2])/dlon
+        dPTdLam /= coslat[np.newaxis, :, np.newaxis]
+    logP = np.log(P)
+    def ddp(F):
+        dFdP = np.empty(F.shape)
+        dFdP[1:-1] = (F[2:]-F[:-2])/(P[1:-1]*(logP[2:]-logP[:-2]))
+        dFdP[0] = dFdP[1]
+        dFdP[-1] = dFdP[-2]
+        return dFdP
+    flat = 2*cst.Omega * np.sin(np.deg2rad(attr['lats']))
+    PV = - cst.g * (ddp(PT) * (var['VO'] + flat[np.newaxis, :, np.newaxis])
+                    + ddp(var['U']) * dPTdPhi - ddp(var['V']) * dPTdLam)
+    return {'P':P, 'PT':PT, 'Z':Z, 'PV':PV}
+
+def writeZ0(rootdir, Z0, mtime):
+    path = os.path.join(rootdir, 'EN-true', 'Z0_STC.pkl')
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with gzip.open(path, 'wb') as f:
+        pickle.dump(Z0, f)
+    os.utime(path, (mtime, mtime))
+
+def test_derive():
+    rng = np.random.default_rng(4)
+    with tempfile.TemporaryDirectory() as tmp:
+        Z0 = rng.uniform(0., 3000., (5, 8))
+        writeZ0(tmp, Z0, 1.e9)
+        for globalGrid in [False, True]:
+            dat = synthetic()
+            dat.rootdir = tmp
+            dat.globalGrid = globalGrid
+            ref = former(dat, Z0)
+            PV, Z = dat.derive(['PV', 'Z'])
+            assert (PV is dat.var['PV']) and (Z is dat.var['Z'])
+            for var in ['P', 'PT', 'Z', 'PV']:
+                assert np.allclose(dat.var[var], ref[var], rtol=1.e-12, atol=1.e-18), var
+            assert np.array_equal(dat.var['Z0'], Z0)
+            # the former methods give the same fields
+            old = synthetic()
+            old.rootdir = tmp
+            old.globalGrid = globalGrid
+            for mk in ['_mkp', '_mkthet', '_mkz', '_mkpv']:
+                getattr(old, mk)()
+            for var in ['P', 'PT', 'Z', 'PV']:
+                assert np.array_equal(old.var[var], dat.var[var]), var
+        # a new ground geopotential file is read again
+        writeZ0(tmp, Z0 + 100., 2.e9)
+        dat = synthetic()
+        dat.rootdir = tmp
+        assert np.allclose(dat.derive('Z'), ref['Z'] + 100., rtol=1.e-12)
+        assert np.array_equal(dat.var['Z0'], Z0 + 100.)
+    ECMWF_N._Z0.clear()
+
+def test_columns():
+    full = synthetic()
+    full._mkp()
+    full._mkrho()
+    dat = synthetic()
+    # repeated columns
+    jy = np.array([0, 2, 2, 4, 0])
+    ix = np.array([1, 3, 3, 7, 1])
+    rho = dat.columns('RHO', jy, ix)
+    assert rho.shape == full.var['RHO'].shape and 'RHO' not in dat.var and 'P' not in dat.var
+    done = np.zeros(rho.shape[1:], dtype=bool)
+    done[jy, ix] = True
+    assert np.array_equal(dat.coldone['RHO'], done) and np.array_equal(dat.coldone['P'], done)
+    assert np.array_equal(rho[:, done], full.var['RHO'][:, done])
+    assert np.isnan(rho[:, ~done]).all()
+    # new columns are added, the others are kept
+    rho[0, 0, 1] = -1.
+    assert dat.columns('RHO', np.array([0, 1]), np.array([1, 5])) is rho
+    done[1, 5] = True
+    assert np.array_equal(dat.coldone['RHO'], done) and rho[0, 0, 1] == -1.
+    assert np.array_equal(rho[:, 1, 5], full.var['RHO'][:, 1, 5])
+    assert np.array_equal(dat.colvar['P'][:, done], full.var['P'][:, done])
+    # moist density, from the columns of P already calculated
+    full._mkrhoq()
+    rhoq = dat.columns('RHOQ', jy, ix)
+    assert np.allclose(rhoq[:, jy, ix], full.var['RHO'][:, jy, ix], rtol=1.e-14)
+    # fields already calculated on the whole grid, and other variables
+    assert dat.columns('T', jy, ix) is dat.var['T']
+    assert dat.columns('PV', jy, ix) is None
+
+def test_cache():
+    cache = ECMWF_N.cache
+    assert ECMWF_N.CACHE_LIMIT == 0
+    try:
+        # the cache is off by default
+        dat = synthetic()
+        assert dat.derive('PT') is dat.var['PT']
+        assert cache.stats()['entries'] == 0
+        ref = dat.var['PT']
+        assert np.allclose(ref, theta(dat.var['T'], dat.var['SP']), rtol=1.e-14)
+        cache.set_limit(1 << 20)
+        cache.clear()
+        # first derivation: T is taken from the cache, PT and P are stored
+        d1 = cached()
+        hits = cache.stats()['hits']
+        assert np.array_equal(d1.derive('PT'), ref)
+        assert cache.stats()['hits'] == hits + 1
+        assert (d1.cachekey+('PT',) in cache) and (d1.cachekey+('P',) in cache)
+        # the fields can be modified without altering the cache
+        d1.var['T'] -= 1.
+        d1.var['PT'][...] = 0.
+        # second object: T, P and PT are taken from the cache
+        d2 = cached()
+        hits = cache.stats()['hits']
+        assert np.array_equal(d2.derive('PT'), ref)
+        assert cache.stats()['hits'] == hits + 3
+        # T modified in place: PT is calculated from it and not cached
+        d3 = cached()
+        d3._get_var('T')
+        d3.var['T'] -= 10.
+        pt = d3.derive('PT')
+        assert np.allclose(pt, theta(synthetic().var['T'] - 10., d3.var['SP']), rtol=1.e-14)
+        assert np.array_equal(cached().derive('PT'), ref)
+        # P replaced: PT is calculated from it
+        d4 = cached()
+        d4.var['P'] = 2*d4.derive('P')
+        assert np.allclose(d4.derive('PT'), ref*0.5**cst.kappa, rtol=1.e-14)
+        assert np.array_equal(cache.get(d4.cachekey+('PT',))[0], ref)
+    finally:
+        cache.set_limit(ECMWF_N.CACHE_LIMIT)
+        cache.clear()
+
+def test_cache_callers():
+    """ Sequence of convsrc2Back (read, _mkp, _mkrho, then division in place)
+    repeated with the cache on """
+    cache = ECMWF_N.cache
+    udr = np.random.default_rng(3).uniform(0., 1., (6, 5, 8))
+    ref = synthetic()
+    ref.var['UDR'] = udr.copy()
+    ref._mkp()
+    ref._mkrho()
+    ref.var['UDR'] /= ref.var['RHO']
+    try:
+        cache.set_limit(1 << 20)
+        cache.clear()
+        for i in range(2):
+            dat = cached()
+            if i == 0:
+                cache.put(dat.cachekey+('UDR',), (udr, dat.attr['levs'], dat.attr['plev']))
+            dat._get_var('T')
+            dat._get_var('UDR')
+            dat._mkp()
+            dat._mkrho()
+            dat.var['UDR'] /= dat.var['RHO']
+            for var in ['P', 'RHO', 'UDR']:
+                assert np.allclose(dat.var[var], ref.var[var], rtol=1.e-14)
+        assert np.array_equal(cache.get(dat.cachekey+('UDR',))[0], udr)
+        assert np.allclose(cache.get(dat.cachekey+('RHO',))[0], ref.var['RHO'], rtol=1.e-14)
+    finally:
+        cache.set_limit(ECMWF_N.CACHE_LIMIT)
+        cache.clear()
+
+def columns(coord, field, targets):
+    """ Baseline of the vertical interpolations: np.interp on each column
+    sorted in coord """
+    out = np.empty((len(targets),)+coord.shape[1:])
+    for jy in range(coord.shape[1]):
+        for ix in range(coord.shape[2]):
+            order = np.argsort(coord[:, jy, ix], kind='mergesort')
+            out[:, jy, ix] = np.interp(targets, coord[order, jy, ix], field[order, jy, ix])
+    return out
+
+def test_vinterp():
+    rng = np.random.default_rng(1)
+    dat = synthetic()
+    P = dat.derive('P')
+    shape = P.shape
+    # potential temperature decreasing with the level index, with inversions
+    PT = np.linspace(600., 300., 6)[:, None, None] + rng.normal(0., 10., shape)
+    PT[2:4, 1, :4] = PT[3:1:-1, 1, :4]
+    PT[0, 3, 2], PT[5, 3, 2] = PT[5, 3, 2], PT[0, 3, 2]
+    Z = np.cumsum(rng.uniform(500., 4000., shape)[::-1], axis=0)[::-1]
+    dat.var.update({'PT':PT, 'Z':Z})
+    assert (np.diff(PT, axis=0) > 0).any()
+    # targets out of order, out of the columns, and on a level
+    p = [5000., 100., 2.e5, 30000., float(P[2, 1, 1])]
+    new = dat.interpolP(p, ['T', 'U'])
+    assert new.var['T'].shape == (5,)+shape[1:] and new.attr['levtype'] == 'pressure'
+    for var in ['T', 'U']:
+        assert np.allclose(new.var[var], columns(np.log(P), dat.var[var], np.log(p)), rtol=1.e-13)
+    assert new.var['T'][4, 1, 1] == dat.var['T'][2, 1, 1]
+    pt = [350., 800., 200., 450., 330.]
+    new = dat.interpolPT(pt, ['T', 'U', 'P'], latRange=[10., 30.], lonRange=[20., 60.])
+    assert new.var['T'].shape == (5, 3, 5)
+    for var in ['T', 'U', 'P']:
+        ref = columns(-PT, dat.var[var], -np.array(pt))[:, 1:4, 2:7]
+        assert np.allclose(new.var[var], ref, rtol=1.e-13)
+    z = [10000., -50., 3.e4, 1000.]
+    new = dat.interpolZ(z, ['T'])
+    assert np.allclose(new.var['T'], columns(-Z, dat.var['T'], -np.array(z)), rtol=1.e-13)
+
+def snapshot(lons, Ti, date, dT=0.):
+    """ synthetic object on the longitudes lons with a uniform surface pressure
+    and T = Ti[lon] + 0.5 lat + 10 log(P) + dT, which is exactly interpolated
+    in latitude and log(p) """
+    dat = synthetic(date)
+    dat.nlon = len(lons)
+    dat.attr.update({'lons':lons, 'Lo1':lons[0], 'dlo':lons[1]-lons[0]})
+    dat.var = {'SP':np.full((dat.nlat, dat.nlon), 1.e5)}
+    P = dat.derive('P')
+    dat.var['T'] = Ti[None, None, :] + 0.5*dat.attr['lats'][None, :, None] + 10.*np.log(P) + dT
+    return dat
+
+def test_sample():
+    rng = np.random.default_rng(5)
+    later = datetime(2017, 8, 11, 19)
+    for lons in [np.arange(0., 80., 10.), np.arange(0., 360., 10.)]:
+        periodic = len(lons) == 36
+        Ti = rng.normal(250., 10., len(lons))
+        dat0 = snapshot(lons, Ti, DATE)
+        dat1 = snapshot(lons, Ti, later, dT=6.)
+        # points inside, on the edges, outside the grid or the levels
+        x = np.concatenate((rng.uniform(0., 70., 20), [0., 70., 35., 70., 75., -0.5, 355., -5., 365., 359.9]))
+        y = np.concatenate((rng.uniform(0., 40., 20), [0., 40., -1., 40.5, 20., 20., 20., 10., 30., 0.]))
+        p = np.concatenate((np.exp(rng.uniform(np.log(2000.), np.log(1.e5), 20)),
+                            [2000., 1.e5, 3.e4, 3.e4, 1500., 1.01e5, 3.e4, 3.e4, 3.e4, 5.e4]))
+        t = np.concatenate((rng.uniform(0., 3600., 20), [0., 3600., 0., 0., 0., 0., 1800., -1., 3601., 900.]))
+        ref = np.interp(x, lons, Ti, period=360. if periodic else None) + 0.5*y + 10.*np.log(p) + 6.*t/3600.
+        outside = (y < 0.) | (y > 40.) | (p < 2000.) | (p > 1.e5) | (t < 0.) | (t > 3600.)
+        if not periodic:
+            outside |= (x < 0.) | (x > 70.)
+        assert outside.sum() == (6 if periodic else 8)
+        T = dat0.sample(x, y, p, t, dat1, ['T'])['T']
+        assert np.all(T[outside] == ECMWF_N.MISSING)
+        assert np.allclose(T[~outside], ref[~outside], rtol=1.e-12)
+        # at the date of the first snapshot only
+        T = dat0.sample(x[:20], y[:20], p[:20], varList='T')['T']
+        assert np.allclose(T, ref[:20] - 6.*t[:20]/3600., rtol=1.e-12)
+        assert np.array_equal(dat0.interpol_part(p[:20], x[:20], y[:20], ['T'])['T'], T)
+
+def profiles(seed=2):
+    """ ECMWF_pure object of project STC with 100 levels between 1 and
+    1000 hPa, a tropopause near 100 hPa, shallow inversions, and clear sky
+    heating rates with 0 to 3 zero crossings in the levels 60 to 70 """
+    rng = np.random.default_rng(seed)
+    dat = ECMWF_pure()
+    dat.project = 'STC'
+    dat.nlev, dat.nlat, dat.nlon = 100, 6, 7
+    shape = (dat.nlev, dat.nlat, dat.nlon)
+    dat.attr['levs'] = np.arange(1, 101)
+    dat.attr['lats'] = np.linspace(-75., 75., 6)
+    P = np.logspace(2., 5., 100)[:, None, None]*rng.uniform(0.97, 1., shape[1:])
+    # altitudes from the scale height, then temperatures with a lapse rate of
+    # 6.5 K/km below the tropopause and of -2 K/km above, and noise
+    Z = -7000.*np.log(P/1.e5)
+    ztrop = rng.uniform(12000., 18000., shape[1:])
+    T = 290. - 0.0065*np.minimum(Z, ztrop) + 0.002*np.maximum(Z-ztrop, 0.) + rng.normal(0., 0.5, shape)
+    T[40:45, 2, :3] += np.linspace(0., 6., 5)[:, None]
+    # columns without tropopause
+    T[:, 4:, 5] = 400. - 0.0065*Z[:, 4:, 5]
+    dat.var.update({'P':P, 'T':T, 'Z':Z})
+    levels = np.arange(100)[:, None, None]
+    csh = np.sin((levels - rng.uniform(40., 80., shape[1:]))*rng.uniform(0.3, 1.5, shape[1:]))
+    csh[:, 0, 0] = -1.
+    dat.var['CSSWR'] = 0.5*csh + rng.normal(0., 0.01, shape)
+    dat.var['CSLWR'] = 0.5*csh
+    dat.var['ASSWR'] = rng.normal(0., 1., shape)
+    dat.var['ASLWR'] = rng.normal(0., 1., shape)
+    return dat
+
+def cold(dat):
+    """ Baseline of _CPT """
+    nc = np.argmin(dat.var['T'][10:90], axis=0) + 10
+    return [np.array([[dat.var[v][nc[jy, ix], jy, ix] for ix in range(dat.nlon)]
+                      for jy in range(dat.nlat)]) for v in ['P', 'T', 'Z']]
+
+def wmo(dat, highlatOffset):
+    """ Baseline of _WMO, NaN where there is no tropopause """
+    T = dat.var['T']
+    logp = np.log(dat.var['P'])
+    dz = cst.R/cst.g * T[1:] * (logp[1:]-logp[:-1])
+    lapse = - cst.g/cst.R * (1/T[11:85]) * (T[10:84] - T[11:85]) / (logp[10:84]-logp[11:85])
+    out = [np.full((dat.nlat, dat.nlon), np.nan) for v in ['P', 'T', 'Z']]
+    for jy in range(dat.nlat):
+        offset = -0.003 if highlatOffset and (abs(dat.attr['lats'][jy]) > 60) else -0.002
+        for ix in range(dat.nlon):
+            slope = list(np.where(lapse[:, jy, ix] > offset)[0])
+            while len(slope) > 0:
+                lev0 = slope.pop()+11
+                lev = lev0-1
+                Deltaz = dz[lev, jy, ix]
+                search = True
+                while Deltaz < 2000:
+                    lev -= 1
+                    Deltaz += dz[lev, jy, ix]
+                    if (T[lev, jy, ix]-T[lev0, jy, ix])/Deltaz < offset:
+                        search = False
+                        break
+                if search:
+                    for o, v in zip(out, ['P', 'T', 'Z']):
+                        o[jy, ix] = dat.var[v][lev0, jy, ix]
+                    break
+    return out
+
+def lzrh(dat):
+    """ Baseline of _lzrh, NaN where there is no crossing """
+    out = [np.full((dat.nlat, dat.nlon), np.nan) for i in range(3)]
+    P = dat.var['P']
+    for jy in range(dat.nlat):
+        for ix in range(dat.nlon):
+            csh = dat.var['CSSWR'][59:70, jy, ix] + dat.var['CSLWR'][59:70, jy, ix]
+            lp = (csh > 0).astype(np.int64)
+            pos = np.where(lp[1:]-lp[:-1] == -1)[0]
+            if (len(pos) == 0) or (np.max(csh[:11]) < 0):
+                continue
+            px = [csh[i]/(csh[i]-csh[i+1]) for i in pos]
+            pzk = np.array([math.exp(x*math.log(P[i+1, jy, ix])+(1-x)*math.log(P[i, jy, ix]))
+                            for x, i in zip(px, pos)])
+            k = 0
+            if (len(pos) > 1) and (jy > 0):
+                avpzt = np.mean(out[0][jy-1, ix:ix+2])
+                if np.isnan(avpzt):
+                    idx = [0, 1]
+                else:
+                    idx = np.argsort((pzk-avpzt)**2, kind='stable')
+                k = idx[0]
+                if (pzk[k] < 9500) and (pzk[idx[1]] > 12000):
+                    k = idx[1]
+            i = pos[k]
+            tz = px[k]*dat.var['T'][i+1, jy, ix] + (1-px[k])*dat.var['T'][i, jy, ix]
+            out[0][jy, ix] = pzk[k]
+            out[1][jy, ix] = tz * (cst.p0/pzk[k])**cst.kappa
+            out[2][jy, ix] = sum([px[k]*dat.var[v][i+1, jy, ix] + (1-px[k])*dat.var[v][i, jy, ix]
+                                  for v in ['ASSWR', 'ASLWR']])
+    return out
+
+def test_tropopause():
+    dat = profiles()
+    dat._CPT()
+    for v, ref in zip(['pcold', 'Tcold', 'zcold'], cold(dat)):
+        assert np.array_equal(dat.d2d[v], ref)
+    for highlatOffset in [False, True]:
+        dat._WMO(highlatOffset)
+        pwmo, Twmo, zwmo = wmo(dat, highlatOffset)
+        # pwmo and Twmo are masked, zwmo is NaN, where there is no tropopause
+        assert np.array_equal(dat.d2d['pwmo'].mask, np.isnan(pwmo))
+        assert np.array_equal(dat.d2d['pwmo'].filled(np.nan), pwmo, equal_nan=True)
+        assert np.array_equal(dat.d2d['Twmo'].filled(np.nan), Twmo, equal_nan=True)
+        assert np.array_equal(dat.d2d['zwmo'], zwmo, equal_nan=True)
+    assert np.isnan(zwmo).any() and not np.isnan(zwmo).all()
+    dat._lzrh()
+    refs = lzrh(dat)
+    assert np.isnan(refs[0]).any() and not np.isnan(refs[0]).all()
+    for v, ref in zip(['plzrh', 'ptlzrh', 'aslzrh'], refs):
+        assert np.array_equal(dat.d2d[v].mask, np.isnan(ref))
+        assert np.isnan(dat.d2d[v].data[dat.d2d[v].mask]).all()
+        assert np.allclose(dat.d2d[v].filled(np.nan), ref, rtol=1.e-13, equal_nan=True)
+
+if __name__ == '__main__':
+    test_derive()
+    test_columns()
+    test_cache()
+    test_cache_callers()
+    test_vinterp()
+    test_sample()
+    test_tropopause()
+    print('test_ECMWF_N passed')
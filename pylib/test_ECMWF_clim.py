@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of ECMWF_clim on random synthetic snapshots with missing values and a
+missing date. The statistics merged over the chunks of dates are compared
+with those of numpy over the stacked fields.
+
+Can be run with pytest or as a script.
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import ECMWF_clim
+from ECMWF_N import ECMWF_pure
+
+DATE0 = datetime(2017, 6, 1)
+NDATES = 30
+BINS = np.linspace(-3., 3., 13)
+
+def field(date):
+    hour = int((date - DATE0).total_seconds()//3600)
+    rng = np.random.default_rng(hour)
+    T = rng.normal(hour % 7, 1., (2, 5, 8))
+    T[rng.random(T.shape) < 0.1] = np.nan
+    return T
+
+def reader(date):
+    if date == DATE0 + timedelta(hours=11):
+        return None
+    dat = ECMWF_pure()
+    dat.date = date
+    dat.attr['lats'] = np.arange(0., 21., 5.)
+    dat.attr['lons'] = np.arange(0., 71., 10.)
+    dat.attr['levs'] = [360., 380.]
+    dat.attr['levtype'] = 'potential temperature'
+    dat.var['T'] = field(date)
+    return dat
+
+def test_climato():
+    dates = [DATE0 + timedelta(hours=h) for h in range(NDATES) if h != 11]
+    ref = np.array([field(date) for date in dates])
+    clim = ECMWF_clim.climato('FULL-EA', ['T'], DATE0, DATE0 + timedelta(hours=NDATES-1),
+                              hist={'T':BINS}, reader=reader, quiet=True)
+    stat = clim.stat['T']
+    assert clim.attr['missing'] == [DATE0 + timedelta(hours=11)]
+    assert np.array_equal(stat['n'], np.sum(np.isfinite(ref), axis=0))
+    assert np.allclose(clim.var['T'], np.nanmean(ref, axis=0), rtol=1.e-12, atol=1.e-12)
+    assert np.allclose(stat['var'], np.nanvar(ref, axis=0), rtol=1.e-12, atol=1.e-12)
+    assert np.array_equal(stat['min'], np.nanmin(ref, axis=0))
+    assert np.array_equal(stat['max'], np.nanmax(ref, axis=0))
+    hist = np.apply_along_axis(lambda x: np.histogram(x[np.isfinite(x)], BINS)[0], 0, ref)
+    assert np.array_equal(stat['hist'], hist)
+
+if __name__ == '__main__':
+    test_climato()
+    print('test_ECMWF_clim passed')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of ECMWF_series on synthetic ECMWF objects (see test_ECMWF_N): read of
+the snapshots with their derived variables, interpolation in time over a
+backward period and period of a single date.
+
+Can be run with pytest or as a script.
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import ECMWF_series
+from ECMWF_series import ECMWF_series as Series
+from test_ECMWF_N import synthetic, theta
+
+DATE0 = datetime(2017, 8, 11, 18)
+
+def reader(date):
+    return synthetic(date, seed=date.hour)
+
+def test_read_snapshot():
+    ECMWF = ECMWF_series.ECMWF
+    try:
+        ECMWF_series.ECMWF = lambda project, date, step, exp: reader(date)
+        dat = ECMWF_series.read_snapshot('STC', DATE0, ['PT', 'T', 'RHO'])
+    finally:
+        ECMWF_series.ECMWF = ECMWF
+    ref = reader(DATE0)
+    assert np.allclose(dat.var['PT'], theta(ref.var['T'], ref.var['SP']), rtol=1.e-14)
+    assert np.array_equal(dat.var['RHO'], ref.derive('RHO'))
+
+def test_series():
+    # backward period of 3 hours
+    series = Series('STC', DATE0, DATE0 - timedelta(hours=2), ['T', 'U'], reader=reader)
+    out = {}
+    for minutes in [0, 20, 60, 90, 120]:
+        date = DATE0 - timedelta(minutes=minutes)
+        h0 = DATE0 - timedelta(hours=minutes//60)
+        h1 = h0 - timedelta(hours=1)
+        w = (minutes % 60)/60.
+        fields = series.interp(date, out=out)
+        assert fields is out
+        for var in ['T', 'U']:
+            ref = (1-w)*reader(h0).var[var] + w*reader(h1).var[var] if w > 0 else reader(h0).var[var]
+            assert np.allclose(fields[var], ref, rtol=1.e-14)
+    assert series.interp(DATE0 - timedelta(hours=3)) is None
+    series.close()
+    # period of a single date
+    series = Series('STC', DATE0, DATE0, ['T'], reader=reader)
+    assert series.dat0 is series.dat1
+    assert np.array_equal(series.interp(DATE0)['T'], reader(DATE0).var['T'])
+    assert series.interp(DATE0 + timedelta(minutes=10)) is None
+    assert len(list(series)) == 1
+    series.close()
+
+if __name__ == '__main__':
+    test_read_snapshot()
+    test_series()
+    print('test_ECMWF_series passed')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of arch107 on a synthetic run written in a temporary directory.
+The timesteps and trajectories read from the archive are compared with the
+part files.
+
+Can be run with pytest or as a script.
+"""
+import os
+import tempfile
+import numpy as np
+import io107
+import arch107
+from test_io107 import make_part
+
+def make_run(run_dir, hours, nact=3000):
+    """ Writes part files where a random subset of parcels is active at each hour """
+    parts = {}
+    rng = np.random.default_rng(1)
+    for hour in hours:
+        part = make_part(nact=nact, seed=hour)
+        sel = np.sort(rng.choice(nact, nact-10*hour, replace=False))
+        for var, dtype in io107.RECORDS:
+            part[var] = part[var][sel]
+        part['nact'] = len(sel)
+        part['itime'] = -3600*hour
+        io107.writeidx107(os.path.join(run_dir, 'part_{:03d}'.format(hour)), part)
+        parts[hour] = part
+    return parts
+
+def test_arch107():
+    hours = list(range(0, 66, 6))
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = make_run(tmp, hours)
+        numpart = parts[0]['numpart']
+        for level, keepbits in [(0, None), (1, None), (6, 10)]:
+            arch_dir = os.path.join(tmp, 'arch{:d}'.format(level))
+            arch107.build107(tmp, arch_dir, chunk=700, tblock=4, compresslevel=level,
+                             keepbits=keepbits, quiet=True)
+            arch = arch107.Arch107(arch_dir)
+            assert arch.hours == hours
+            for hour in [0, 30, 60]:
+                data = arch.timestep(hour)
+                col = parts[hour]['idx_back'] - 1
+                assert data['active'].sum() == parts[hour]['nact'] and data['active'][col].all()
+                assert np.array_equal(data['flag'][col], parts[hour]['flag'])
+                ref = parts[hour]['p'] if keepbits is None else arch107.bitround(parts[hour]['p'], keepbits)
+                assert np.array_equal(data['p'][col], ref)
+                assert np.isnan(data['x'][~data['active']]).all()
+            idx = np.array([1, 5, 777, numpart])
+            traj = arch.trajectory(idx, fields=['t'])
+            assert traj['t'].shape == (len(hours), len(idx))
+            for t, hour in enumerate(hours):
+                ib = list(parts[hour]['idx_back'])
+                for j in range(len(idx)):
+                    assert traj['active'][t, j] == (idx[j] in ib)
+                    if traj['active'][t, j]:
+                        ref = parts[hour]['t'][ib.index(idx[j])]
+                        if keepbits is not None: ref = arch107.bitround(ref, keepbits)
+                        assert traj['t'][t, j] == ref
+            arch.close()
+    x = np.array([1.0, 1.00048828125, 3.14159265, np.nan, np.inf, -2.5e-7], dtype=np.float32)
+    r = arch107.bitround(x, 10)
+    assert (r[0] == 1.0) and (r[1] == 1.0) and np.isnan(r[3]) and np.isinf(r[4])
+    assert np.abs(r[2]/x[2]-1) < 2.**-11 and np.abs(r[5]/x[5]-1) < 2.**-11
+
+if __name__ == '__main__':
+    test_arch107()
+    print('test_arch107 passed')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of augment107 on a synthetic run written in a temporary directory, with
+synthetic snapshots where T is linear in longitude, latitude and time, so that
+the interpolated values are exact.
+
+Can be run with pytest or as a script.
+"""
+import os
+import tempfile
+from datetime import datetime
+import numpy as np
+import augment107
+import ECMWF_N
+from ECMWF_N import ECMWF_pure
+from test_arch107 import make_run
+
+START = datetime(2017, 8, 11, 18, 30)
+READ = []
+
+def reader(date):
+    """ Snapshot with 4 levels between 20 and 600 hPa """
+    # the cache is disabled during the run
+    assert ECMWF_N.cache.limit == 0
+    READ.append(date)
+    dat = ECMWF_pure()
+    dat.date = date
+    lons = np.arange(-10., 161., 10.)
+    lats = np.arange(0., 51., 5.)
+    dat.attr.update({'lons':lons, 'lats':lats, 'Lo1':-10., 'La1':0., 'dlo':10., 'dla':5.,
+                     'levs':np.arange(1, 5), 'am':np.array([2000., 10000., 30000., 60000.]),
+                     'bm':np.zeros(4)})
+    dat.nlon = len(lons)
+    dat.nlat = len(lats)
+    dat.var['SP'] = np.full((dat.nlat, dat.nlon), 1.e5)
+    hours = (date - START).total_seconds()/3600
+    T = 200 + 0.1*lons[np.newaxis, :] + 0.2*lats[:, np.newaxis] + hours
+    dat.var['T'] = np.repeat(T[np.newaxis, :, :], 4, axis=0)
+    return dat
+
+def test_augment107():
+    hours = list(range(0, 30, 6))
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = make_run(tmp, hours)
+        aug_dir = os.path.join(tmp, 'aug')
+        # the cache is disabled during the run (as in the processes of the pool
+        # by the same initializer) and restored after
+        ECMWF_N.cache.set_limit(1 << 20)
+        try:
+            done = augment107.augment107(tmp, aug_dir, ['T'], start=START, reader=reader, quiet=True)
+            assert ECMWF_N.cache.limit == 1 << 20
+            augment107._initworker()
+            assert ECMWF_N.cache.limit == 0
+        finally:
+            ECMWF_N.cache.set_limit(ECMWF_N.CACHE_LIMIT)
+        assert done == hours
+        # the part files are between two hours and each hour is read once
+        assert len(READ) == 2*len(hours) and len(set(READ)) == len(READ)
+        assert os.listdir(os.path.join(aug_dir, augment107.PARTIAL)) == []
+        for hour in hours:
+            part = parts[hour]
+            T = augment107.readaug107(hour, aug_dir, ['T'])['T']
+            ref = 200 + 0.1*part['x'].astype(np.float64) + 0.2*part['y'] + part['itime']/3600
+            assert T.dtype == np.float32 and len(T) == part['nact']
+            assert np.abs(T - ref).max() < 1.e-3
+        # the part files already augmented are skipped
+        del READ[:]
+        assert augment107.augment107(tmp, aug_dir, ['T'], start=START, reader=reader, quiet=True) == []
+        assert READ == []
+
+if __name__ == '__main__':
+    test_augment107()
+    print('test_augment107 passed')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of era5cube: build of a cube from synthetic ECMWF objects (see
+test_ECMWF_N), extension by a new day and a new variable with the domain
+given as tuples instead of lists, and snapshots compared with the fields.
+
+Can be run with pytest or as a script.
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+import era5cube
+from test_ECMWF_N import synthetic
+
+DAY0 = datetime(2017, 8, 11)
+MISSING_HOUR = DAY0 + timedelta(hours=5)
+
+def reader(date):
+    dat = synthetic(date, seed=date.day*24 + date.hour)
+    if date == MISSING_HOUR:
+        del dat.attr['lons']
+    return dat
+
+def test_era5cube():
+    with tempfile.TemporaryDirectory() as tmp:
+        meta = era5cube.build(tmp, 'STC', DAY0, DAY0, ['T'], [10, 30], [10., 50.],
+                              quiet=True, reader=reader)
+        assert meta['latRange'] == (10., 30.) and meta['missing'] == [MISSING_HOUR]
+        # extension by one day and one variable, the domain given as tuples
+        meta = era5cube.build(tmp, 'STC', DAY0, DAY0 + timedelta(days=1), ['T', 'U'],
+                              (10., 30.), (10, 50), quiet=True, reader=reader)
+        assert meta is not None
+        assert meta['days'] == [DAY0, DAY0 + timedelta(days=1)]
+        assert meta['variables'] == ['SP', 'T', 'U']
+        # another domain is refused
+        assert era5cube.build(tmp, 'STC', DAY0, DAY0, ['T'], (0., 30.), (10., 50.),
+                              quiet=True, reader=reader) is None
+        cube = era5cube.Cube(tmp)
+        assert len(cube.dates()) == 47 and MISSING_HOUR not in cube.dates()
+        assert cube.snapshot(MISSING_HOUR) is None
+        assert np.isnan(cube.field('U', MISSING_HOUR)).all()
+        for date in [DAY0 + timedelta(hours=4), DAY0 + timedelta(hours=23+18)]:
+            ref = reader(date)
+            dat = cube.snapshot(date, ['T', 'U', 'P'])
+            assert np.array_equal(dat.attr['lats'], [10., 20., 30.])
+            assert np.array_equal(dat.attr['lons'], [10., 20., 30., 40., 50.])
+            assert dat.attr['La1'] == 10. and dat.attr['Lo1'] == 10. and dat.nlev == 6
+            for var in ['T', 'U']:
+                assert dat.var[var].dtype == np.float32 and not dat.var[var].flags.writeable
+                assert np.array_equal(dat.var[var], ref.var[var][:, 1:4, 1:6].astype(np.float32))
+            P = ref.derive('P')[:, 1:4, 1:6]
+            assert np.allclose(dat.var['P'], P, rtol=1.e-6)
+        cube.close()
+        assert sorted(os.listdir(os.path.join(tmp, 'U'))) == ['20170811.npy', '20170812.npy']
+
+if __name__ == '__main__':
+    test_era5cube()
+    print('test_era5cube passed')
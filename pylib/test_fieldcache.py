@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of fieldcache: size limit, eviction of the least recently used entries,
+copies given and stored, and statistics.
+
+Can be run with pytest or as a script.
+"""
+import numpy as np
+from fieldcache import FieldCache
+
+def test_fieldcache():
+    a = np.arange(10.)       # 80 bytes
+    b = np.ones(10)
+    c = np.zeros(10)
+    cache = FieldCache(200)
+    assert cache.get('a') is None
+    cache.put('a', a)
+    cache.put('b', (b, np.arange(3, dtype=np.int8), 'levs'))
+    assert cache.stats() == {'hits':0, 'misses':1, 'entries':2, 'size':163, 'limit':200}
+    # copies are stored and returned
+    a[0] = -1.
+    x = cache.get('a')
+    assert x[0] == 0. and np.array_equal(x[1:], a[1:])
+    x[1] = -1.
+    assert cache.get('a')[1] == 1.
+    y, i, s = cache.get('b')
+    assert np.array_equal(y, b) and (y is not b) and i.dtype == np.int8 and s == 'levs'
+    # 'a' has been used after 'b' which is evicted first
+    cache.get('a')
+    cache.put('c', c)
+    assert ('b' not in cache) and ('a' in cache) and ('c' in cache)
+    assert cache.stats()['size'] == 160
+    # replacement of an entry
+    cache.put('c', np.zeros(5))
+    assert cache.stats()['size'] == 120 and len(cache.get('c')) == 5
+    # a value larger than the limit is not stored
+    cache.put('d', np.zeros(30))
+    assert 'd' not in cache and cache.stats()['entries'] == 2
+    cache.set_limit(100)
+    assert ('a' not in cache) and ('c' in cache) and cache.stats()['size'] == 40
+    cache.set_limit(0)
+    assert cache.stats()['entries'] == 0 and cache.stats()['size'] == 0
+    cache.put('a', a)
+    assert cache.get('a') is None
+    cache.set_limit(200)
+    cache.put('a', a)
+    cache.clear()
+    assert cache.get('a') is None and cache.stats()['size'] == 0
+
+if __name__ == '__main__':
+    test_fieldcache()
+    print('test_fieldcache passed')
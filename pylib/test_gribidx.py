@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of gribidx on a small GRIB1 file written in a temporary directory:
+building and saving of the index, reload, selection compared with pygrib and
+rebuild after a modification of the file.
+
+Can be run with pytest or as a script.
+"""
+import os
+import tempfile
+import numpy as np
+import pygrib
+import gribidx
+
+NI, NJ = 4, 3
+
+def message(param, level, hour, value):
+    """ GRIB1 message on a 4x3 regular grid at level (hPa) and hour of 2017-08-11,
+    with values value + 0..11 packed on 8 bits """
+    pds = bytes([0,0,28, 128, 98, 145, 255, 0x80, param, 100]) + level.to_bytes(2, 'big') \
+        + bytes([17, 8, 11, hour, 0, 1, 0, 0, 0, 0,0, 0, 21, 0, 0,0])
+    gds = bytes([0,0,32, 0, 255, 0]) + NI.to_bytes(2, 'big') + NJ.to_bytes(2, 'big') \
+        + (20000).to_bytes(3, 'big') + (0).to_bytes(3, 'big') + bytes([0x80]) \
+        + (0).to_bytes(3, 'big') + (30000).to_bytes(3, 'big') \
+        + (10000).to_bytes(2, 'big') + (10000).to_bytes(2, 'big') + bytes([0, 0,0,0,0])
+    # reference value value (integer < 2**24) in IBM format, scale 1
+    e, m = 70, value
+    while m >= 1 << 24:
+        m //= 16
+        e += 1
+    while (m > 0) and (m < 1 << 20):
+        m *= 16
+        e -= 1
+    ref = bytes([e]) + m.to_bytes(3, 'big') if value > 0 else bytes(4)
+    data = bytes(range(NI*NJ))
+    bds = (11+len(data)+1).to_bytes(3, 'big') + bytes([8]) + bytes(2) + ref + bytes([8]) + data + bytes(1)
+    total = 8 + len(pds) + len(gds) + len(bds) + 4
+    return b'GRIB' + total.to_bytes(3, 'big') + b'\x01' + pds + gds + bds + b'7777'
+
+def write(fname, hours):
+    with open(fname, 'wb') as f:
+        for hour in hours:
+            for param in [130, 131]:
+                for level in [100, 200, 300]:
+                    f.write(message(param, level, hour, 1000*param + level + hour))
+
+def test_gribidx():
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'EN17081100')
+        write(fname, [0, 6])
+        idx = gribidx.GribIndex(fname)
+        assert len(idx) == 12 and os.path.isfile(fname+'.gidx')
+        ref = pygrib.open(fname).select(shortName='t', validityTime=600, level=[100, 300])
+        for sel in [idx, gribidx.GribIndex(fname)]:
+            grbs = sel.select(shortName='t', validityTime=600, level=[300, 100])
+            assert [g['level'] for g in grbs] == [100, 300]
+            for g, r in zip(grbs, ref):
+                assert np.array_equal(g['values'], r['values'])
+            assert g['values'][0, 0] == 130000 + 300 + 6
+            assert [g['level'] for g in sel.select(shortName='u', validityTime=0)] == [100, 200, 300]
+            assert sel.find(shortName='u', validityTime=0, level=200) == [4]
+            assert sel.find(shortName='u', validityTime=0, level=lambda l: l > 150) == [4, 5]
+            assert sel.find(shortName='t', level=200) == [1, 7]
+            try:
+                sel.select(shortName='t', validityTime=1200)
+                assert False
+            except ValueError:
+                pass
+        idx.close()
+        # the index is rebuilt when the file changes, and the pool follows
+        assert gribidx.opengrib(fname) is gribidx.opengrib(fname)
+        write(fname, [0, 6, 12])
+        os.utime(fname, (1, 1))
+        idx = gribidx.opengrib(fname)
+        assert len(idx) == 18
+        assert idx.select(shortName='t', validityTime=1200, level=100)[0]['values'][0, 0] == 130000 + 100 + 12
+        gribidx.clearpool()
+
+if __name__ == '__main__':
+    test_gribidx()
+    print('test_gribidx passed')
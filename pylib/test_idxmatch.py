@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of idxmatch against np.isin on random, overlapping, empty and sparse
+inputs.
+
+Can be run with pytest or as a script.
+"""
+import numpy as np
+import idxmatch
+
+def check(a, b):
+    assert np.array_equal(idxmatch.idxin(a, b), np.isin(a, b))
+    kept_a, kept_b = idxmatch.idxmatch(a, b)
+    assert np.array_equal(kept_a, np.isin(a, b))
+    assert np.array_equal(kept_b, np.isin(b, a))
+
+def test_idxmatch():
+    rng = np.random.default_rng(0)
+    for dtype in [np.int32, np.int64]:
+        # overlapping dense lists, as two successive outputs
+        a = np.sort(rng.choice(10000, 7000, replace=False)).astype(dtype) + 1
+        b = rng.choice(12000, 5000, replace=False).astype(dtype) + 1
+        check(a, b)
+        # with repeated and negative values
+        check(rng.integers(-50, 50, 300).astype(dtype), rng.integers(-20, 80, 100).astype(dtype))
+        # disjoint
+        check(a, a + 20000)
+        # empty inputs
+        check(a[:0], b)
+        check(a, b[:0])
+        check(a[:0], b[:0])
+    # sparse values (undefined idx_back): np.isin is used without a large table
+    a = np.array([1, 5, 2**31-1, -2**31], dtype=np.int32)
+    b = np.array([5, -2**31, 7], dtype=np.int32)
+    check(a, b)
+    check(np.array([1, 10**15]), np.array([10**15]))
+
+if __name__ == '__main__':
+    test_idxmatch()
+    print('test_idxmatch passed')
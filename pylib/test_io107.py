@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of io107 on a synthetic set of parcels written in a temporary directory.
+The decoded records are compared with a direct struct decoding of the file.
+
+Can be run with pytest or as a script.
+"""
+import os
+import gzip
+import tempfile
+from struct import unpack, pack
+import numpy as np
+import io107
+
+def make_part(nact=1000, seed=0):
+    """ Generates a synthetic part dictionary with nact active parcels """
+    rng = np.random.default_rng(seed)
+    part = {'lhead':3, 'outnfmt':107, 'mode':1, 'stamp_date':20170801000000,
+            'itime':-21600, 'step':450, 'numpart':nact+10, 'nact':nact,
+            'idx_orgn':1, 'nact_lastO':3, 'nact_lastNM':4, 'nact_lastNH':5}
+    part['flag'] = rng.integers(-2**31, 2**31-1, nact).astype(np.int32)
+    part['ir_start'] = rng.integers(-10**7, 10**7, nact).astype(np.int32)
+    part['x'] = rng.uniform(-10, 160, nact).astype(np.float32)
+    part['y'] = rng.uniform(0, 50, nact).astype(np.float32)
+    part['p'] = rng.uniform(3000, 50000, nact).astype(np.float32)
+    part['t'] = rng.uniform(180, 300, nact).astype(np.float32)
+    part['idx_back'] = np.sort(rng.choice(nact+10, nact, replace=False)).astype(np.int32) + 1
+    return part
+
+def struct_records(fname, nact):
+    """ Decodes the body records of fname with struct as a reference """
+    recs = {}
+    with open(fname, 'rb') as fid:
+        fid.seek(76)
+        for var, dtype in io107.RECORDS:
+            fid.read(4)
+            fmt = '>' + str(nact) + ('f' if 'f' in dtype else 'l')
+            recs[var] = np.asarray(unpack(fmt, fid.read(4*nact)))
+            fid.read(4)
+    return recs
+
+def test_read():
+    part = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, part)
+        ref = struct_records(fname, part['nact'])
+        data = io107.readidx107(fname, quiet=True)
+        for var, dtype in io107.RECORDS:
+            # same types as the former reader when all the records are read
+            assert data[var].dtype == (np.float64 if 'f' in dtype else np.int64)
+            assert np.array_equal(data[var], ref[var])
+        data = io107.readidx107(fname, quiet=True, fields=[var for var, dtype in io107.RECORDS])
+        for var, dtype in io107.RECORDS:
+            assert data[var].dtype == np.dtype(dtype).newbyteorder('=')
+            assert np.array_equal(data[var], ref[var])
+        for var in ['stamp_date', 'itime', 'step', 'numpart', 'nact', 'idx_orgn']:
+            assert data[var] == part[var]
+
+def test_read_gz():
+    part = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_006')
+        io107.writeidx107(fname, part)
+        ref = io107.readidx107(fname, quiet=True)
+        io107.writeidx107(fname+'.gz', part, cmp=True)
+        os.remove(fname)
+        data = io107.readidx107(fname, quiet=True)
+        for var, dtype in io107.RECORDS:
+            assert np.array_equal(data[var], ref[var])
+
+def test_fields_lazy_mmap():
+    part = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, part)
+        ref = io107.readidx107(fname, quiet=True)
+        data = io107.readidx107(fname, quiet=True, fields=['p','t'])
+        assert set(['p','t']).issubset(data.keys()) and 'x' not in data
+        assert np.array_equal(data['t'], ref['t'])
+        data = io107.readidx107(fname, quiet=True, fields=['idx_back'], lazy=True)
+        assert 'x' not in data
+        assert np.array_equal(data['x'], ref['x'])
+        assert np.array_equal(data['idx_back'], ref['idx_back'])
+        data = io107.readidx107(fname, quiet=True, mmap=True)
+        assert isinstance(data['y'], np.memmap)
+        for var, dtype in io107.RECORDS:
+            assert np.array_equal(data[var], ref[var])
+        io107.writeidx107(fname+'.gz', part, cmp=True)
+        os.remove(fname)
+        data = io107.readidx107(fname, quiet=True, fields=['flag'], lazy=True, mmap=True)
+        assert np.array_equal(data['p'], ref['p'])
+
+def test_write():
+    part = make_part(nact=2500)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        wchunk = io107.WCHUNK
+        io107.WCHUNK = 1000
+        try:
+            io107.writeidx107(fname, part)
+        finally:
+            io107.WCHUNK = wchunk
+        nact = part['nact']
+        ref = pack('>l3ll', 12, 3, 107, 1, 12)
+        ref += pack('>lqlll', 16, part['stamp_date'], part['itime'], part['step'], 16)
+        ref += pack('>l6ll', 24, part['numpart'], nact, part['idx_orgn'],
+                    part['nact_lastO'], part['nact_lastNM'], part['nact_lastNH'], 24)
+        for var, dtype in io107.RECORDS:
+            fmt = '>' + str(nact) + ('f' if 'f' in dtype else 'l')
+            ref += pack('>l', 4*nact) + pack(fmt, *part[var]) + pack('>l', 4*nact)
+        with open(fname, 'rb') as fid:
+            assert fid.read() == ref
+
+def test_catalog():
+    part = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        io107.writeidx107(os.path.join(tmp, 'part_000'), part)
+        io107.writeidx107(os.path.join(tmp, 'part_006.gz'), part, cmp=True)
+        cat = io107.catalog107(tmp)
+        assert sorted(cat) == [0, 6]
+        assert cat[6]['gz'] and (cat[6]['nact'] == part['nact'])
+        assert os.path.isfile(os.path.join(tmp, io107.CATALOG107))
+        part['nact'] = 10
+        for var, dtype in io107.RECORDS:
+            part[var] = part[var][:10]
+        io107.writeidx107(os.path.join(tmp, 'part_012'), part)
+        cat = io107.catalog107(tmp)
+        assert sorted(cat) == [0, 6, 12]
+        assert cat[12]['nact'] == 10
+        assert cat[12]['offsets']['flag'] == 80
+        # an unreadable file is skipped without rewriting the catalogue at each call
+        with open(os.path.join(tmp, 'part_018'), 'wb') as f:
+            f.write(b'partial')
+        assert sorted(io107.catalog107(tmp)) == [0, 6, 12]
+        os.utime(os.path.join(tmp, io107.CATALOG107), (0, 0))
+        assert sorted(io107.catalog107(tmp)) == [0, 6, 12]
+        assert os.stat(os.path.join(tmp, io107.CATALOG107)).st_mtime == 0
+
+def test_iterpart():
+    part = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        for hour in range(0, 30, 6):
+            part['itime'] = -3600*hour
+            io107.writeidx107(os.path.join(tmp, 'part_{:03d}'.format(hour)), part)
+        hours = []
+        for hour, data in io107.iterpart107(range(0, 30, 6), tmp, depth=2, maxmem=10**5,
+                                            fields=['x','idx_back']):
+            assert data['itime'] == -3600*hour
+            assert np.array_equal(data['x'], part['x']) and 'y' not in data
+            hours.append(hour)
+        assert hours == list(range(0, 30, 6))
+
+def test_gzip107():
+    part = make_part(nact=5000)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, part)
+        ref = io107.readidx107(fname, quiet=True)
+        with open(fname, 'rb') as fid:
+            raw = fid.read()
+        io107.gzip107(fname, block=4096, nthreads=3)
+        os.remove(fname)
+        with gzip.open(fname+'.gz', 'rb') as fid:
+            assert fid.read() == raw
+        assert len(io107._members107(fname+'.gz').coff) == (len(raw)-1)//4096 + 1
+        data = io107.readidx107(fname, quiet=True, nthreads=3)
+        for var, dtype in io107.RECORDS:
+            assert np.array_equal(data[var], ref[var])
+
+def test_where():
+    part = make_part(nact=5000)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, part)
+        ref = io107.readidx107(fname, quiet=True)
+        ct = ref['flag'] >> 24
+        sel = np.isin(ct, [8, 9, 13]) & (ref['p'] < 27000) & ((ref['x'] >= 150) | (ref['x'] < 0))
+        wchunk = io107.WCHUNK
+        io107.WCHUNK = 700
+        try:
+            for name in ['part_000', 'part_000.gz']:
+                if name.endswith('.gz'):
+                    io107.writeidx107(fname+'.gz', part, cmp=True)
+                    os.remove(fname)
+                data = io107.readidx107(fname, quiet=True, fields=['p'],
+                                        where={'cloud_type':[8,9,13], 'p':(None,27000), 'x':(150,0)})
+                assert np.array_equal(data['sel'], np.flatnonzero(sel))
+                assert np.array_equal(data['p'], ref['p'][sel]) and 'y' not in data
+                assert np.array_equal(data['y'], ref['y'][sel])
+                assert np.array_equal(data['cloud_type'], ct[sel] & 0xFF)
+            mask = 0x400000 + 0x10
+            data = io107.readidx107(fname, quiet=True, where={'flags_on':mask, 'sat':[1,2]})
+            sel = ((ref['flag'] & mask) == mask) & np.isin(ref['flag'] & 0xF, [1,2])
+            assert np.array_equal(data['idx_back'], ref['idx_back'][sel])
+            io107.gzip107(fname+'.gz', block=4096)
+            data = io107.readidx107(fname, quiet=True, where={'flags_off':mask, 't':(200,250)})
+            sel = ((ref['flag'] & mask) == 0) & (ref['t'] >= 200) & (ref['t'] < 250)
+            assert np.array_equal(data['x'], ref['x'][sel])
+        finally:
+            io107.WCHUNK = wchunk
+
+def test_slab():
+    part = make_part(nact=5000)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, part)
+        ref = io107.readidx107(fname, quiet=True)
+        for fmt in ['plain', 'gz', 'gzip107']:
+            if fmt == 'gz':
+                io107.writeidx107(fname+'.gz', part, cmp=True)
+                os.remove(fname)
+            elif fmt == 'gzip107':
+                io107.gzip107(fname+'.gz', block=4096)
+            i1 = 0
+            for data in io107.iterslab107(fname, 1200, fields=['x','idx_back'], start=100):
+                assert data['i0'] == max(i1, 100) and 'p' not in data
+                i0, i1 = data['i0'], data['i1']
+                assert np.array_equal(data['x'], ref['x'][i0:i1])
+                assert np.array_equal(data['idx_back'], ref['idx_back'][i0:i1])
+            assert i1 == part['nact']
+            data = io107.readslab107(fname, 2000, 2345)
+            for var, dtype in io107.RECORDS:
+                assert np.array_equal(data[var], ref[var][2000:2345])
+            assert len(io107.readslab107(fname, 10, 10)['t']) == 0
+
+if __name__ == '__main__':
+    test_read()
+    test_read_gz()
+    test_fields_lazy_mmap()
+    test_write()
+    test_catalog()
+    test_iterpart()
+    test_gzip107()
+    test_where()
+    test_slab()
+    print('test_io107 passed')
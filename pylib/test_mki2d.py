@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of mki2d: the hybrid level locator is exact at the model levels, NaN
+outside the columns, and close to the former CloughTocher interpolator on
+the (ps, sigma) grid within its domain.
+
+Can be run with pytest or as a script.
+"""
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator
+import mki2d
+
+def former(fhyb):
+    """ Former interpolator of the level in (-log(sigma), -log(ps)), built on
+    ps from 450 to 1100 hPa every 5 hPa and sigma between 0.009 and 1 """
+    ps = np.arange(45000, 110100, 500, dtype=np.float64)
+    sig = fhyb.al[np.newaxis, :]/ps[:, np.newaxis] + fhyb.bl[np.newaxis, :]
+    hyb = np.broadcast_to(np.arange(len(fhyb.al)), sig.shape)
+    psm = np.broadcast_to(ps[:, np.newaxis], sig.shape)
+    filt = (sig > 0.009) & (sig < 1)
+    return CloughTocher2DInterpolator(np.transpose([-np.log(sig[filt]), -np.log(psm[filt])]), hyb[filt])
+
+def test_hyblocator():
+    rng = np.random.default_rng(0)
+    for rea, bound in [('ERA5', 0.025), ('ERAI', 0.04)]:
+        fhyb, scorhyb = mki2d.tohyb(rea)
+        nlev = len(fhyb.al)
+        assert nlev == (137 if rea == 'ERA5' else 60) and not scorhyb.any()
+        # exact at the model levels
+        ps = rng.uniform(45000., 110000., 5)
+        p = fhyb.al[:, np.newaxis] + fhyb.bl[:, np.newaxis]*ps[np.newaxis, :]
+        assert np.allclose(fhyb.level(p, ps), np.arange(nlev)[:, np.newaxis], rtol=0., atol=1.e-9)
+        assert np.isnan(fhyb.level([0.5*p[0, 0], 1.01*ps[0]], ps[0])).all()
+        # random points in the domain of the former interpolator
+        ps = rng.uniform(45500., 109500., 20000)
+        sig = np.exp(rng.uniform(np.log(0.012), np.log(0.98), 20000))
+        pts = np.transpose([-np.log(sig), -np.log(ps)])
+        hyb = fhyb(pts)
+        ref = former(fhyb)(pts)
+        assert np.isfinite(hyb).all() and np.isfinite(ref).all()
+        assert np.allclose(hyb, fhyb.level(sig*ps, ps), rtol=1.e-12)
+        assert np.abs(hyb - ref).max() < bound
+    try:
+        mki2d.tohyb('JRA55')
+        assert False
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_hyblocator()
+    print('test_mki2d passed')